@@ -5,12 +5,24 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+The live family event streams (``/families/<id>/events/``) are long-lived
+responses. Serve them from this module with an ASGI server, e.g.
+``uvicorn common.asgi:application``, so that each idle stream costs a
+suspended coroutine instead of a worker thread. With DEBUG on, static
+files are served too, as runserver would.
 """
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'common.settings')
 
 application = get_asgi_application()
+
+if settings.DEBUG:
+    from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+
+    application = ASGIStaticFilesHandler(application)
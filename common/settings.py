@@ -60,10 +60,14 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "expense.middleware.CompressionMiddleware",
+    "expense.middleware.ReplicaStickinessMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "expense.middleware.ShardMiddleware",
+    "expense.profiling.ProfilingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -102,6 +106,287 @@ DATABASES = {
     }
 }
 
+# Read replicas (see expense/routers.py)
+# DATABASE_REPLICAS: comma-separated host:port list of streaming replicas of
+# the database above, e.g. "db_replica:5432". Reads go to a replica unless
+# the user wrote within DATABASE_STICKY_SECONDS.
+
+DATABASE_REPLICAS = [r for r in os.getenv("DATABASE_REPLICAS", "").split(",") if r]
+DATABASE_STICKY_SECONDS = int(os.getenv("DATABASE_STICKY_SECONDS", "5"))
+
+for number, replica in enumerate(DATABASE_REPLICAS, start=1):
+    host, _, port = replica.partition(":")
+    DATABASES[f"replica{number}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": port or "5432",
+        # Tests run against the default database only.
+        "TEST": {"MIRROR": "default"},
+    }
+
+# Sharding (see expense/sharding.py)
+# DATABASE_SHARDS: comma-separated host:port/name list of databases that
+# families can be placed on besides the one above, e.g.
+# "db:5432/expense-shard1,db:5432/expense-shard2". Users, sessions, jobs and
+# the shard directory stay on the one above, which holds families too.
+
+DATABASE_SHARDS = [s for s in os.getenv("DATABASE_SHARDS", "").split(",") if s]
+SHARD_DIRECTORY_CACHE_SECONDS = int(os.getenv("SHARD_DIRECTORY_CACHE_SECONDS", "60"))
+
+for number, shard in enumerate(DATABASE_SHARDS, start=1):
+    address, _, name = shard.partition("/")
+    host, _, port = address.partition(":")
+    DATABASES[f"shard{number}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": port or "5432",
+        "NAME": name or DATABASES["default"]["NAME"],
+    }
+
+SHARDS = ["default"] + [f"shard{number}" for number in range(1, len(DATABASE_SHARDS) + 1)]
+
+DATABASE_ROUTERS = (["expense.routers.ShardRouter"] if DATABASE_SHARDS else []) + (
+    ["expense.routers.ReplicaRouter"] if DATABASE_REPLICAS else []
+)
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# CACHE_BACKEND: "locmem" (default, per process) or "file" (shared between
+# workers on one host, stored under CACHE_LOCATION).
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "locmem")
+
+if CACHE_BACKEND == "file":
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.getenv("CACHE_LOCATION", str(BASE_DIR / ".cache")),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "django-expense",
+        }
+    }
+
+# Whether every process sees the same cache. Caches that other processes
+# must be able to invalidate (rendered record pages, users) are only used
+# when it is.
+CACHE_SHARED = CACHE_BACKEND != "locmem"
+
+
+# Sessions
+# https://docs.djangoproject.com/en/5.2/topics/http/sessions/
+# SESSION_MODE: "db" (Django default), "cached_db" (cache in front of the
+# django_session table) or "signed_cookies" (no server-side storage).
+
+SESSION_MODE = os.getenv("SESSION_MODE", "cached_db")
+
+SESSION_ENGINE = {
+    "db": "django.contrib.sessions.backends.db",
+    "cached_db": "django.contrib.sessions.backends.cached_db",
+    "signed_cookies": "django.contrib.sessions.backends.signed_cookies",
+}.get(SESSION_MODE, "django.contrib.sessions.backends.cached_db")
+
+# Only write the session back when it actually changed.
+SESSION_SAVE_EVERY_REQUEST = False
+
+# Authentication
+# AUTH_CACHE_USERS keeps the User loaded by AuthenticationMiddleware in the
+# cache for AUTH_USER_CACHE_TIMEOUT seconds instead of querying auth_user on
+# every request. On by default only with a shared cache (CACHE_SHARED):
+# otherwise a password change or deactivation would not reach the copies
+# cached by other workers.
+
+AUTH_CACHE_USERS = os.getenv("AUTH_CACHE_USERS", "1" if CACHE_SHARED else "0") == "1"
+AUTH_USER_CACHE_TIMEOUT = int(os.getenv("AUTH_USER_CACHE_TIMEOUT", "300"))
+
+AUTHENTICATION_BACKENDS = [
+    (
+        "expense.backends.CachedModelBackend"
+        if AUTH_CACHE_USERS
+        else "django.contrib.auth.backends.ModelBackend"
+    ),
+]
+
+
+# Live family events (server-sent events, served by common.asgi)
+# EVENTS_BACKEND: "local" (single process) or "postgres" (LISTEN/NOTIFY,
+# shared by every web process).
+
+EVENTS_BACKEND = {
+    "local": "expense.events.LocalBackend",
+    "postgres": "expense.events.PostgresBackend",
+}.get(os.getenv("EVENTS_BACKEND", "local"), "expense.events.LocalBackend")
+EVENTS_HEARTBEAT_SECONDS = int(os.getenv("EVENTS_HEARTBEAT_SECONDS", "25"))
+
+
+# Record partitioning (Postgres only, see expense/partitioning.py)
+# RECORD_PARTITIONING: "" (off), "yearly" or "monthly". Old partitions are
+# archived to gzip'd CSV files under RECORD_ARCHIVE_DIR.
+
+RECORD_PARTITIONING = os.getenv("RECORD_PARTITIONING", "")
+RECORD_ARCHIVE_DIR = os.getenv("RECORD_ARCHIVE_DIR", str(BASE_DIR / "archive"))
+
+
+# Currency conversion (see expense/currency.py)
+# Rates are loaded from files with `manage.py load_exchange_rates` and
+# expressed as units of each currency per one EXCHANGE_RATE_BASE. Each
+# process checks the table for changes at most every
+# EXCHANGE_RATE_CHECK_SECONDS.
+
+EXCHANGE_RATE_BASE = os.getenv("EXCHANGE_RATE_BASE", "USD")
+EXCHANGE_RATE_CHECK_SECONDS = float(os.getenv("EXCHANGE_RATE_CHECK_SECONDS", "1"))
+
+
+# Budgets (see expense/budgets.py)
+# Fractions of a budget at which a BudgetAlert is raised, e.g. "0.8,1".
+
+BUDGET_ALERT_THRESHOLDS = [
+    float(t) for t in os.getenv("BUDGET_ALERT_THRESHOLDS", "0.8,1").split(",") if t
+]
+
+
+# Forecasts (see expense/forecasting.py)
+# Seconds a family's forecast is cached, if CACHE_SHARED. Record writes drop
+# it sooner.
+
+FORECAST_CACHE_SECONDS = int(os.getenv("FORECAST_CACHE_SECONDS", "300"))
+
+
+# Category suggestions (see expense/categorizer.py)
+# Family models kept in memory per process, and how long (seconds) a model
+# is used before it is retrained from the database.
+
+CATEGORY_MODEL_CACHE_SIZE = int(os.getenv("CATEGORY_MODEL_CACHE_SIZE", "256"))
+CATEGORY_MODEL_MAX_AGE = int(os.getenv("CATEGORY_MODEL_MAX_AGE", "600"))
+
+
+# Background jobs (see expense/jobs.py)
+# Worker pool of `manage.py run_jobs`: JOB_POOL is "thread" or "process".
+# Failed jobs retry after JOB_RETRY_BACKOFF seconds, doubling up to
+# JOB_RETRY_BACKOFF_MAX; running jobs locked longer than JOB_LOCK_TIMEOUT
+# are assumed lost and run again. Finished jobs are kept JOB_KEEP_DAYS.
+
+JOB_POOL = os.getenv("JOB_POOL", "thread")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", "10"))
+JOB_RETRY_BACKOFF_MAX = float(os.getenv("JOB_RETRY_BACKOFF_MAX", "3600"))
+JOB_LOCK_TIMEOUT = int(os.getenv("JOB_LOCK_TIMEOUT", "600"))
+JOB_KEEP_DAYS = int(os.getenv("JOB_KEEP_DAYS", "7"))
+
+
+# Request profiling (see expense/profiling.py)
+# Staff can profile a request with ?_profile=1 or an X-Profile header.
+# Reports are kept under PROFILE_DIR, the newest PROFILE_MAX_REPORTS of them.
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", str(BASE_DIR / ".profiles"))
+PROFILE_MAX_REPORTS = int(os.getenv("PROFILE_MAX_REPORTS", "200"))
+
+
+# Rate limiting (see expense/ratelimit.py)
+# RATE_LIMIT_STORE: "memory" (per process) or "cache" (the cache above, shared
+# between processes when CACHE_BACKEND is). Rates are "<count>/<s|m|h|d>";
+# concurrency is the number of requests per group in flight per process
+# before the rest get a 503. Behind a proxy, set RATE_LIMIT_TRUST_FORWARDED
+# so clients are told apart by X-Forwarded-For.
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+RATE_LIMITS = {
+    # Login / registration: each attempt hashes a password.
+    "auth": {
+        "rate": os.getenv("RATE_LIMIT_AUTH", "10/m"),
+        "keys": ["ip", "username"],
+        "methods": ["POST"],
+        "concurrency": int(os.getenv("RATE_LIMIT_AUTH_CONCURRENCY", "4")),
+    },
+    "api": {
+        "rate": os.getenv("RATE_LIMIT_API", "120/m"),
+        "keys": ["user", "ip"],
+        "concurrency": int(os.getenv("RATE_LIMIT_API_CONCURRENCY", "32")),
+    },
+    # Category suggestions are requested as the user types; their own bucket
+    # keeps typing from using up the tokens that saving the record needs.
+    "suggestions": {
+        "rate": os.getenv("RATE_LIMIT_SUGGESTIONS", "600/m"),
+        "keys": ["user", "ip"],
+    },
+    # Anomaly detection and forecasts load a family's whole history.
+    "analysis": {
+        "rate": os.getenv("RATE_LIMIT_ANALYSIS", "20/m"),
+        "keys": ["user", "ip"],
+        "concurrency": int(os.getenv("RATE_LIMIT_ANALYSIS_CONCURRENCY", "4")),
+    },
+    # Live event streams are long-lived; only the connection rate is limited.
+    "events": {
+        "rate": os.getenv("RATE_LIMIT_EVENTS", "30/m"),
+        "keys": ["user", "ip"],
+    },
+}
+
+
+# Response compression (see expense/middleware.py)
+# brotli (if the Brotli package is installed) or gzip, whichever the client
+# prefers, for text, JSON and JS responses of at least COMPRESSION_MIN_SIZE
+# bytes. Levels favour speed: these are compressed on every request.
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))
+
+
+# Records page (see expense/record_pages.py)
+# RECORDS_RENDERING: "server" (first page rendered into the page, more loaded
+# as HTML fragments on scroll) or "client" (the page fetches every record
+# from the JSON API). Rendered pages are cached until a record write, if
+# CACHE_SHARED.
+
+RECORDS_RENDERING = os.getenv("RECORDS_RENDERING", "server")
+RECORDS_PAGE_SIZE = int(os.getenv("RECORDS_PAGE_SIZE", "30"))
+RECORDS_PAGE_CACHE_SECONDS = int(os.getenv("RECORDS_PAGE_CACHE_SECONDS", "600"))
+
+
+# Duplicate records (see expense/duplicates.py)
+# A new record with the same family, name, amount and currency as one
+# created within DUPLICATE_WINDOW_SECONDS of it is rejected as a duplicate
+# unless the client confirms it.
+
+DUPLICATE_WINDOW_SECONDS = int(os.getenv("DUPLICATE_WINDOW_SECONDS", "120"))
+
+
+# Idempotency keys (see expense/idempotency.py)
+# Responses to requests sent with an Idempotency-Key header are replayed to
+# retries for IDEMPOTENCY_KEY_TTL seconds. A retry arriving while the first
+# request still runs waits up to IDEMPOTENCY_WAIT_SECONDS for it.
+
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))
+
+
+# Monthly statements (see expense/statements.py)
+# Rendered for every family by `manage.py generate_statements`, run early
+# each month from cron. A statement never changes once its month is over,
+# so browsers may cache it for STATEMENT_CACHE_SECONDS.
+
+STATEMENT_LARGEST_EXPENSES = int(os.getenv("STATEMENT_LARGEST_EXPENSES", "10"))
+STATEMENT_CACHE_SECONDS = int(os.getenv("STATEMENT_CACHE_SECONDS", "86400"))
+
+
+# Ledger snapshots (see expense/snapshots.py)
+# One memory-mapped file of record columns per family, read by the stats
+# endpoint. Record writes refresh it SNAPSHOT_REFRESH_DELAY seconds later
+# (batched per family), so stats can be that much behind.
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", str(BASE_DIR / "snapshots"))
+SNAPSHOT_REFRESH_DELAY = int(os.getenv("SNAPSHOT_REFRESH_DELAY", "30"))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -141,6 +426,17 @@ STATIC_URL = "/static/"
 STATIC_ROOT = BASE_DIR / "staticfiles"
 STATICFILES_DIRS = [BASE_DIR / "static"]
 
+# Content-hashed file names so built CSS/JS (static/build/, produced by
+# `npm run build`) can be cached by browsers indefinitely.
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.ManifestStaticFilesStorage",
+    },
+}
+
 # Media files (user uploads)
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
@@ -0,0 +1,9 @@
+#!/bin/sh
+# Runs once when the primary's data directory is created: creates the shard
+# databases named in SHARD_DATABASES (comma-separated), so DATABASE_SHARDS
+# can point at them locally. Migrate them with manage.py startup.
+set -e
+for name in $(echo "${SHARD_DATABASES:-}" | tr ',' ' '); do
+    psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname postgres \
+        -c "CREATE DATABASE \"$name\""
+done
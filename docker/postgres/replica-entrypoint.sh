@@ -0,0 +1,14 @@
+#!/bin/sh
+# Starts a hot standby of $PRIMARY_HOST, cloning it on first start.
+set -e
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+    mkdir -p "$PGDATA"
+    chown postgres "$PGDATA"
+    chmod 0700 "$PGDATA"
+    until gosu postgres pg_basebackup -h "$PRIMARY_HOST" -U "$POSTGRES_USER" \
+        -D "$PGDATA" -R -X stream; do
+        echo "Waiting for $PRIMARY_HOST..."
+        sleep 2
+    done
+fi
+exec gosu postgres postgres -c hot_standby=on
@@ -3,17 +3,26 @@ set -e
 
 # Wait for database to be ready
 echo "Waiting for database..."
-while ! pg_isready -h $DATABASE_HOST -p $DATABASE_PORT -U $POSTGRES_USER; do
+while ! pg_isready -h "${DATABASE_HOST:-localhost}" -p "${DATABASE_PORT:-8006}" -U "${POSTGRES_USER:-root}"; do
     sleep 1
 done
 
 echo "Database is ready!"
 
-# Run migrations
-python manage.py migrate
-
-# Collect static files
-python manage.py collectstatic --noinput
+# STARTUP_MODE:
+#   fast (default) - migrate / collectstatic only when something changed
+#   full           - always run both
+#   none           - skip both (e.g. for workers next to a web container)
+case "${STARTUP_MODE:-fast}" in
+    full)
+        python manage.py startup --force
+        ;;
+    none)
+        ;;
+    *)
+        python manage.py startup
+        ;;
+esac
 
 # Execute main command
-exec "$@"
\ No newline at end of file
+exec "$@"
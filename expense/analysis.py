@@ -0,0 +1,236 @@
+"""Vectorized spending anomaly detection.
+
+Record history is loaded straight from a database cursor into NumPy
+arrays: amount converted to the family currency, category code, member,
+month index and timestamp. No model instances are built. All statistics
+are then computed over whole arrays at once:
+
+* record outliers: each expense is compared with the mean and standard
+  deviation of the *earlier* expenses in the same family and category (an
+  expanding window, so nothing is judged against its own future), and
+  with the median absolute deviation of the whole category;
+* monthly spikes: a category's monthly total is compared with the mean of
+  its previous SPIKE_WINDOW months with spending.
+"""
+
+from collections import defaultdict
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Case, FloatField, Func, IntegerField, Value, When
+from django.db.models.functions import Coalesce, ExtractMonth, ExtractYear
+
+from .currency import converted_amount
+from .models import CATEGORIES, Family, Record
+
+CATEGORY_CODES = {key: code for code, key in enumerate(CATEGORIES)}
+CATEGORY_KEYS = list(CATEGORY_CODES)
+
+# An expense needs this many earlier expenses in its category to be scored.
+MIN_HISTORY = 5
+Z_THRESHOLD = 3.0
+MAD_THRESHOLD = 3.5
+SPIKE_WINDOW = 6
+SPIKE_MIN_MONTHS = 3
+SPIKE_FACTOR = 2.0
+
+HISTORY_DTYPE = np.dtype(
+    [
+        ("family", np.int64),
+        ("id", np.int64),
+        ("amount", np.float64),
+        ("category", np.int16),
+        ("member", np.int64),
+        ("month", np.int32),
+        ("ts", np.float64),
+    ]
+)
+
+
+class Epoch(Func):
+    template = "EXTRACT(EPOCH FROM %(expressions)s)"
+    output_field = FloatField()
+
+
+def category_code():
+    """Expression for a record's CATEGORY_CODES code (-1 if uncategorized)."""
+    return Case(
+        *[When(category=key, then=Value(code)) for key, code in CATEGORY_CODES.items()],
+        default=Value(-1),
+        output_field=IntegerField(),
+    )
+
+
+def month_index():
+    """Expression for ``year * 12 + month - 1`` of created_at, in TIME_ZONE."""
+    tz = ZoneInfo(settings.TIME_ZONE)
+    return (
+        ExtractYear("created_at", tzinfo=tz) * 12 + ExtractMonth("created_at", tzinfo=tz) - 1
+    )
+
+
+def _history_queryset(family_ids, currency):
+    return (
+        Record.objects.filter(family_id__in=family_ids)
+        .annotate(
+            amount_fc=converted_amount(currency),
+            category_code=category_code(),
+            member=Coalesce("who_id", 0),
+            month=month_index(),
+            ts=Epoch("created_at"),
+        )
+        .values_list("family_id", "id", "amount_fc", "category_code", "member", "month", "ts")
+    )
+
+
+def load_history(family_ids=None):
+    """Return a structured array (HISTORY_DTYPE) of the families' records."""
+    families = Family.objects.all()
+    if family_ids is not None:
+        families = families.filter(id__in=family_ids)
+    by_currency = defaultdict(list)
+    for family_id, currency in families.values_list("id", "currency"):
+        by_currency[currency].append(family_id)
+
+    chunks = []
+    for currency, ids in by_currency.items():
+        sql, params = _history_queryset(ids, currency).query.sql_with_params()
+        with connections[router.db_for_read(Record)].cursor() as cursor:
+            cursor.execute(sql, params)
+            # Rows go from the cursor into the array without model instances.
+            chunks.append(
+                np.fromiter(
+                    (tuple(row) for row in cursor), dtype=HISTORY_DTYPE, count=-1
+                )
+            )
+    if not chunks:
+        return np.empty(0, dtype=HISTORY_DTYPE)
+    return np.concatenate(chunks)
+
+
+def _group_starts(keys):
+    """Index of the first element of each element's group in sorted ``keys``."""
+    boundary = np.empty(len(keys), dtype=bool)
+    boundary[:1] = True
+    boundary[1:] = keys[1:] != keys[:-1]
+    return np.maximum.accumulate(np.where(boundary, np.arange(len(keys)), 0))
+
+
+def _exclusive_window_sum(values, starts, window=None):
+    """Sum of the previous ``window`` values in the same group (all if None)."""
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    index = np.arange(len(values))
+    lower = starts if window is None else np.maximum(starts, index - window)
+    return csum[index] - csum[lower], index - lower
+
+
+def _group_median(values, groups):
+    """Per-element median of its group, for ``groups`` sorted ascending."""
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    sorted_groups = groups[order]
+    first = np.searchsorted(sorted_groups, sorted_groups, side="left")
+    last = np.searchsorted(sorted_groups, sorted_groups, side="right") - 1
+    median_sorted = (
+        sorted_values[(first + last) // 2] + sorted_values[(first + last + 1) // 2]
+    ) / 2
+    median = np.empty_like(values)
+    median[order] = median_sorted
+    return median
+
+
+def _group_key(family, category):
+    """One int64 per (family, category); category codes are shifted by one
+    so uncategorized (-1) doesn't borrow from the family part."""
+    return family.astype(np.int64) * 1000 + category.astype(np.int64) + 1
+
+
+def _split_group_key(group):
+    """``(family_id, category code)`` of a ``_group_key`` value."""
+    return int(group // 1000), int(group % 1000) - 1
+
+
+def detect_outliers(history):
+    """Return the unusual expenses in ``history`` with their scores."""
+    if not len(history):
+        return []
+    order = np.lexsort((history["ts"], history["category"], history["family"]))
+    h = history[order]
+    group = _group_key(h["family"], h["category"])
+    starts = _group_starts(group)
+    amount = h["amount"]
+
+    prior_sum, prior_n = _exclusive_window_sum(amount, starts)
+    prior_sq, _ = _exclusive_window_sum(amount * amount, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = prior_sum / prior_n
+        std = np.sqrt(np.maximum(prior_sq / prior_n - mean * mean, 0))
+        z = (amount - mean) / std
+
+    median = _group_median(amount, group)
+    mad = _group_median(np.abs(amount - median), group)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        robust_z = 0.6745 * (amount - median) / mad
+
+    z_flag = (prior_n >= MIN_HISTORY) & np.isfinite(z) & (z > Z_THRESHOLD)
+    mad_flag = np.isfinite(robust_z) & (robust_z > MAD_THRESHOLD)
+    flagged = np.nonzero(z_flag | mad_flag)[0]
+
+    return [
+        {
+            "record_id": int(h["id"][i]),
+            "family_id": int(h["family"][i]),
+            "category": _category_key(h["category"][i]),
+            "amount": float(amount[i]),
+            "z_score": float(z[i]) if np.isfinite(z[i]) else None,
+            "robust_z": float(robust_z[i]) if np.isfinite(robust_z[i]) else None,
+            "typical": float(median[i]),
+        }
+        for i in flagged
+    ]
+
+
+def detect_spikes(history):
+    """Return months where a category's total jumped above its recent average."""
+    if not len(history):
+        return []
+    group = _group_key(history["family"], history["category"])
+    key = group * 100000 + history["month"]
+    keys, inverse = np.unique(key, return_inverse=True)
+    totals = np.bincount(inverse, weights=history["amount"])
+    groups = keys // 100000
+    months = keys % 100000
+
+    starts = _group_starts(groups)
+    prior_sum, prior_n = _exclusive_window_sum(totals, starts, SPIKE_WINDOW)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        baseline = prior_sum / prior_n
+    flagged = np.nonzero(
+        (prior_n >= SPIKE_MIN_MONTHS) & (baseline > 0) & (totals > SPIKE_FACTOR * baseline)
+    )[0]
+
+    spikes = []
+    for i in flagged:
+        family_id, category = _split_group_key(groups[i])
+        spikes.append(
+            {
+                "family_id": family_id,
+                "category": _category_key(category),
+                "month": f"{months[i] // 12:04d}-{months[i] % 12 + 1:02d}",
+                "total": float(totals[i]),
+                "baseline": float(baseline[i]),
+            }
+        )
+    return spikes
+
+
+def _category_key(code):
+    code = int(code)
+    return CATEGORY_KEYS[code] if 0 <= code < len(CATEGORY_KEYS) else ""
+
+
+def family_anomalies(family_ids=None):
+    history = load_history(family_ids)
+    return {"outliers": detect_outliers(history), "spikes": detect_spikes(history)}
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+
+def _user_cache_key(user_id):
+    return f"auth:user:{user_id}"
+
+
+def invalidate_cached_user(user_id):
+    cache.delete(_user_cache_key(user_id))
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend that serves ``get_user`` from the cache.
+
+    AuthenticationMiddleware calls ``get_user`` on every request; with this
+    backend the ``auth_user`` lookup only hits the database on a cache miss.
+    Cached entries are dropped whenever the user is saved (which includes
+    password changes) or deleted, and on logout. Other processes only see
+    that with a shared cache, so this backend is only enabled by default
+    when CACHE_SHARED.
+    """
+
+    def get_user(self, user_id):
+        key = _user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            UserModel = get_user_model()
+            try:
+                user = UserModel._default_manager.get(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            cache.set(key, user, settings.AUTH_USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
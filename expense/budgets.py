@@ -0,0 +1,231 @@
+"""Incremental budget evaluation.
+
+Every record write adds its amount (converted to the family currency) to
+the running BudgetTotal rows of its month: the (category, member) row plus
+the category-wide, member-wide and family-wide rows. That is at most four
+rows, written in one upsert, so each write costs the same no matter how
+many records the month already has. Budget status is read straight from
+these rows and never scans records.
+
+Crossing one of BUDGET_ALERT_THRESHOLDS of a budget creates a BudgetAlert,
+once per budget, month and threshold, and publishes a ``budget.alert``
+family event.
+
+``rebuild_totals`` recomputes the rows from records, for the migration
+that adds them, ``manage.py rebuild_budget_totals`` and currency changes.
+"""
+
+from collections import defaultdict
+from zoneinfo import ZoneInfo
+
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .currency import conversion_factor, converted_amount
+from .events import publish_family_event
+from .forecasting import invalidate as invalidate_forecasts
+from .models import Budget, BudgetAlert, BudgetTotal, Family
+
+
+def period_of(moment):
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return timezone.localtime(moment).date().replace(day=1)
+
+
+def total_keys(category, member_id):
+    category, member_id = category or "", member_id or 0
+    return {(category, member_id), (category, 0), ("", member_id), ("", 0)}
+
+
+def record_deltas(family_id, family_currency, old=None, new=None):
+    """Return ``{(family_id, period, category, member_id): delta}`` for a write.
+
+    ``old`` and ``new`` are dicts with amount, currency, category, who_id and
+    created_at: the values before and after the write (None for a create /
+    delete).
+    """
+    deltas = defaultdict(float)
+    for values, sign in ((old, -1), (new, 1)):
+        if not values:
+            continue
+        amount = float(values["amount"] or 0) * conversion_factor(
+            values.get("currency"), family_currency
+        )
+        period = period_of(values["created_at"])
+        for category, member_id in total_keys(values["category"], values["who_id"]):
+            deltas[(family_id, period, category, member_id)] += sign * amount
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def apply_deltas(deltas):
+    """Add ``deltas`` to the running totals and raise any threshold alerts."""
+    if not deltas:
+        return
+    table = BudgetTotal._meta.db_table
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * len(deltas))
+    params = []
+    for (family_id, period, category, member_id), delta in deltas.items():
+        params += [family_id, period, category, member_id, delta]
+    # The family's shard (see expense/sharding.py)
+    using = router.db_for_write(BudgetTotal)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (family_id, period, category, member_id, total) "
+            f"VALUES {placeholders} "
+            "ON CONFLICT (family_id, period, category, member_id) "
+            f"DO UPDATE SET total = {table}.total + EXCLUDED.total "
+            "RETURNING family_id, period, category, member_id, total",
+            params,
+        )
+        totals = {tuple(row[:4]): row[4] for row in cursor.fetchall()}
+    family_ids = {key[0] for key in deltas}
+    transaction.on_commit(lambda: invalidate_forecasts(family_ids), using=using)
+    _check_alerts(deltas, totals)
+
+
+def _check_alerts(deltas, totals):
+    family_ids = {key[0] for key in deltas}
+    budgets = Budget.objects.filter(family_id__in=family_ids)
+    alerts = []
+    for budget in budgets:
+        for key, delta in deltas.items():
+            family_id, period, category, member_id = key
+            if (family_id, category, member_id) != (
+                budget.family_id,
+                budget.category,
+                budget.member_key,
+            ):
+                continue
+            total = totals.get(key)
+            if total is None or delta <= 0 or budget.amount <= 0:
+                continue
+            before = total - delta
+            for threshold in settings.BUDGET_ALERT_THRESHOLDS:
+                limit = threshold * budget.amount
+                if before < limit <= total:
+                    alerts.append(
+                        BudgetAlert(
+                            budget=budget, period=period, threshold=threshold, total=total
+                        )
+                    )
+    if not alerts:
+        return
+    BudgetAlert.objects.bulk_create(alerts, ignore_conflicts=True)
+    for alert in alerts:
+        publish_family_event(
+            alert.budget.family_id,
+            {
+                "type": "budget.alert",
+                "budget_id": alert.budget_id,
+                "threshold": alert.threshold,
+                "total": alert.total,
+                "amount": alert.budget.amount,
+            },
+        )
+
+
+def record_values(record):
+    return {
+        "amount": record.amount,
+        "currency": record.currency,
+        "category": record.category,
+        "who_id": record.who_id,
+        "created_at": record.created_at,
+    }
+
+
+def apply_records(records):
+    """Add newly inserted records, e.g. from a bulk_create, to the totals."""
+    records = list(records)
+    if not records:
+        return
+    currencies = dict(
+        Family.objects.filter(id__in={r.family_id for r in records}).values_list(
+            "id", "currency"
+        )
+    )
+    deltas = defaultdict(float)
+    for record in records:
+        for key, delta in record_deltas(
+            record.family_id, currencies.get(record.family_id), new=record_values(record)
+        ).items():
+            deltas[key] += delta
+    apply_deltas(deltas)
+
+
+def rebuild_totals(using, family_ids=None, apps=global_apps):
+    """Recompute the BudgetTotal rows of the families on ``using`` from records.
+
+    ``family_ids`` limits the rebuild to those families. Migrations pass
+    their historical ``apps``. Returns the number of rows written.
+    """
+    Family = apps.get_model("expense", "Family")
+    Record = apps.get_model("expense", "Record")
+    BudgetTotal = apps.get_model("expense", "BudgetTotal")
+
+    families = Family.objects.using(using)
+    if family_ids is not None:
+        families = families.filter(id__in=family_ids)
+    by_currency = defaultdict(list)
+    for family_id, currency in families.values_list("id", "currency"):
+        by_currency[currency].append(family_id)
+
+    tz = ZoneInfo(settings.TIME_ZONE)
+    rows = 0
+    for currency, ids in by_currency.items():
+        # One grouped query per family currency; the rollups to the
+        # category-wide / member-wide / family-wide rows happen on the
+        # (much smaller) grouped result.
+        grouped = (
+            Record.objects.using(using)
+            .filter(family_id__in=ids)
+            .annotate(period=TruncMonth("created_at", tzinfo=tz))
+            .values("family_id", "period", "category", "who_id")
+            .annotate(total=Sum(converted_amount(currency)))
+        )
+        totals = defaultdict(float)
+        for row in grouped.iterator():
+            period = row["period"].date()
+            for category, member_id in total_keys(row["category"], row["who_id"]):
+                totals[(row["family_id"], period, category, member_id)] += row["total"] or 0
+
+        with transaction.atomic(using=using):
+            BudgetTotal.objects.using(using).filter(family_id__in=ids).delete()
+            BudgetTotal.objects.using(using).bulk_create(
+                [
+                    BudgetTotal(
+                        family_id=family_id,
+                        period=period,
+                        category=category,
+                        member_id=member_id,
+                        total=total,
+                    )
+                    for (family_id, period, category, member_id), total in totals.items()
+                ],
+                batch_size=1000,
+            )
+        rows += len(totals)
+    return rows
+
+
+def budget_status(family, period=None):
+    """Return each budget of ``family`` with its spend for ``period``.
+
+    Reads one BudgetTotal row per budget; no records are scanned.
+    """
+    period = period or period_of(timezone.now())
+    budgets = list(Budget.objects.filter(family=family).select_related("member"))
+    totals = {
+        (t.category, t.member_id): t.total
+        for t in BudgetTotal.objects.filter(family=family, period=period)
+    }
+    status = []
+    for budget in budgets:
+        spent = totals.get((budget.category, budget.member_key), 0)
+        status.append((budget, spent, spent / budget.amount if budget.amount else None))
+    return status
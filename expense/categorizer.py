@@ -0,0 +1,230 @@
+"""Category suggestions from a record's name and description.
+
+A multinomial naive Bayes model is kept per family, plus one global model
+trained on the most recent labeled records of every family. Suggestions
+mix the two, trusting the family model more as it sees more records, so a
+new family still gets sensible suggestions.
+
+Models live in process memory: family models in an LRU of
+CATEGORY_MODEL_CACHE_SIZE entries. Every record save in this process
+updates the loaded models in place (see ``learn``); models are retrained
+from the database after CATEGORY_MODEL_MAX_AGE seconds so writes made by
+other processes are picked up too. A prediction only touches the tokens of
+the input, so it takes microseconds.
+
+Training never happens in a request: a missing or expired model is
+retrained in a background thread, one per model at a time, while
+requests keep using the model they have (or none, for a cold family).
+"""
+
+import contextvars
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import connections
+
+from .models import CATEGORIES, Record
+
+# Family records needed before the family model counts as much as the
+# global one.
+FAMILY_WEIGHT_RECORDS = 20
+GLOBAL_TRAINING_LIMIT = 50000
+
+logger = logging.getLogger(__name__)
+
+# Runs of letters and digits; CJK text has no spaces, so each of its
+# characters is a token of its own.
+TOKEN_RE = re.compile(r"[\u3400-\u9fff]|[^\W_\u3400-\u9fff]+")
+
+
+def tokenize(*texts):
+    return [token for text in texts for token in TOKEN_RE.findall((text or "").lower())]
+
+
+class NaiveBayes:
+    def __init__(self):
+        self.documents = Counter()
+        self.token_totals = Counter()
+        self.token_counts = defaultdict(Counter)
+        self.loaded_at = time.monotonic()
+        # Records with a smaller id were left out of training.
+        self.min_id = 0
+
+    @property
+    def size(self):
+        return sum(self.documents.values())
+
+    def update(self, tokens, category, weight=1):
+        """Add (``weight=1``) or remove (``weight=-1``) one labeled record.
+
+        Counts stop at zero: a record written by another process since the
+        model was trained may be removed without ever having been added.
+        """
+        if category not in CATEGORIES:
+            return
+        self.documents[category] = max(self.documents[category] + weight, 0)
+        for token in tokens:
+            if weight < 0 and self.token_counts.get(token, {}).get(category, 0) <= 0:
+                continue
+            self.token_counts[token][category] += weight
+            self.token_totals[category] = max(self.token_totals[category] + weight, 0)
+
+    def probabilities(self, tokens):
+        """Return ``{category: probability}``, empty for an untrained model."""
+        total = self.size
+        if total <= 0:
+            return {}
+        vocabulary = len(self.token_counts) + 1
+        scores = {}
+        for category, documents in self.documents.items():
+            if documents <= 0:
+                continue
+            denominator = self.token_totals[category] + vocabulary
+            score = math.log(documents / total)
+            for token in tokens:
+                counts = self.token_counts.get(token)
+                score += math.log(((counts[category] if counts else 0) + 1) / denominator)
+            scores[category] = score
+        if not scores:
+            return {}
+        # Softmax over the log scores.
+        top = max(scores.values())
+        exp = {category: math.exp(score - top) for category, score in scores.items()}
+        norm = sum(exp.values())
+        return {category: value / norm for category, value in exp.items()}
+
+
+def _train(queryset, limit=None):
+    """Model of ``queryset``'s records, or of its newest ``limit`` records."""
+    model = NaiveBayes()
+    rows = queryset.order_by("-id").values_list("id", "name", "description", "category")
+    if limit is not None:
+        rows = rows[:limit]
+    count = 0
+    for record_id, name, description, category in rows:
+        model.update(tokenize(name, description), category)
+        model.min_id = record_id
+        count += 1
+    if limit is None or count < limit:
+        model.min_id = 0
+    return model
+
+
+def _labeled():
+    return Record.objects.exclude(category="")
+
+
+_lock = threading.Lock()
+_family_models = OrderedDict()
+_global_model = None
+# Models being trained: a family id, or GLOBAL
+_training = set()
+GLOBAL = "global"
+
+
+def _expired(model):
+    return time.monotonic() - model.loaded_at > settings.CATEGORY_MODEL_MAX_AGE
+
+
+def _store(key, model):
+    global _global_model
+    with _lock:
+        if key == GLOBAL:
+            _global_model = model
+            return
+        _family_models[key] = model
+        _family_models.move_to_end(key)
+        while len(_family_models) > settings.CATEGORY_MODEL_CACHE_SIZE:
+            _family_models.popitem(last=False)
+
+
+def retrain(key):
+    """Train the model for ``key`` (a family id or GLOBAL) and swap it in."""
+    if key == GLOBAL:
+        model = _train(_labeled(), limit=GLOBAL_TRAINING_LIMIT)
+    else:
+        model = _train(_labeled().filter(family_id=key))
+    _store(key, model)
+    return model
+
+
+def _retrain_in_background(key):
+    with _lock:
+        if key in _training:
+            return
+        _training.add(key)
+
+    def run():
+        try:
+            retrain(key)
+        except Exception:
+            logger.exception("Training category model %s failed", key)
+        finally:
+            with _lock:
+                _training.discard(key)
+            connections.close_all()
+
+    # The copied context keeps the request's active shard.
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(run,), daemon=True).start()
+
+
+def _get_model(key):
+    """The loaded model for ``key`` (an empty one if cold); never trains inline."""
+    with _lock:
+        if key == GLOBAL:
+            model = _global_model
+        else:
+            model = _family_models.get(key)
+            if model is not None:
+                _family_models.move_to_end(key)
+    if model is None or _expired(model):
+        _retrain_in_background(key)
+    return model if model is not None else NaiveBayes()
+
+
+def suggest(family_id, name="", description="", limit=3):
+    """Return up to ``limit`` ``(category, probability)`` pairs, best first."""
+    tokens = tokenize(name, description)
+    if not tokens:
+        return []
+    family_model = _get_model(family_id)
+    global_model = _get_model(GLOBAL)
+    weight = family_model.size / (family_model.size + FAMILY_WEIGHT_RECORDS)
+    family_probs = family_model.probabilities(tokens)
+    global_probs = global_model.probabilities(tokens)
+    if not family_probs:
+        weight = 0.0
+    if not global_probs:
+        weight = 1.0
+    mixed = {
+        category: weight * family_probs.get(category, 0)
+        + (1 - weight) * global_probs.get(category, 0)
+        for category in family_probs.keys() | global_probs.keys()
+    }
+    ranked = sorted(mixed.items(), key=lambda item: item[1], reverse=True)
+    return ranked[:limit]
+
+
+def learn(family_id, record_id, old=None, new=None):
+    """Apply a write to record ``record_id`` to the loaded models.
+
+    ``old`` and ``new`` are ``(name, description, category)`` before and after
+    the write (None for a create / delete). Models not in memory are left
+    alone; they train from the database when next needed. Records older
+    than a model's training window are left out of it.
+    """
+    with _lock:
+        models = [m for m in (_family_models.get(family_id), _global_model) if m is not None]
+        for model in models:
+            if record_id < model.min_id:
+                continue
+            for values, weight in ((old, -1), (new, 1)):
+                if values:
+                    name, description, category = values
+                    model.update(tokenize(name, description), category, weight)
@@ -0,0 +1,90 @@
+"""Exchange-rate lookups and DB-side currency conversion.
+
+Rates live in the ExchangeRate table, loaded from files with the
+``load_exchange_rates`` command; nothing is fetched from the network. Each
+process keeps the table in memory. At most every EXCHANGE_RATE_CHECK_SECONDS
+it reads the table's version, its row count and latest ``updated_at``
+(one aggregate over a few hundred rows), and reloads the rates when that
+changed, so writes from any process, e.g. the command, are seen without a
+shared cache. Writes made in this process are seen at once.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Case, Count, F, FloatField, Max, Value, When
+
+_lock = threading.Lock()
+_rates = None
+_version = None
+_checked_at = 0.0
+
+
+def bump_version():
+    """Make this process check the rate table on its next lookup."""
+    global _checked_at
+    _checked_at = 0.0
+
+
+def _table_version():
+    from .models import ExchangeRate
+
+    version = ExchangeRate.objects.aggregate(count=Count("id"), updated=Max("updated_at"))
+    return version["count"], version["updated"]
+
+
+def get_rates():
+    """Return ``{currency: units per one EXCHANGE_RATE_BASE}``."""
+    global _rates, _version, _checked_at
+    fresh = time.monotonic() - _checked_at < settings.EXCHANGE_RATE_CHECK_SECONDS
+    if _rates is not None and fresh:
+        return _rates
+    with _lock:
+        version = _table_version()
+        if _rates is None or version != _version:
+            from .models import ExchangeRate
+
+            rates = dict(ExchangeRate.objects.values_list("currency", "rate"))
+            rates.setdefault(settings.EXCHANGE_RATE_BASE, 1.0)
+            _rates, _version = rates, version
+        _checked_at = time.monotonic()
+    return _rates
+
+
+def normalize_currency(code):
+    return (code or "").strip().upper()
+
+
+def conversion_factor(source, target, rates=None):
+    """Multiplier turning an amount in ``source`` into ``target``.
+
+    Unknown currencies convert at 1 so that a missing rate never hides an
+    expense from totals.
+    """
+    rates = rates if rates is not None else get_rates()
+    source, target = normalize_currency(source), normalize_currency(target)
+    if not source or source == target or source not in rates or target not in rates:
+        return 1.0
+    return rates[target] / rates[source]
+
+
+def converted_amount(target, field="amount", currency_field="currency"):
+    """Expression converting ``field`` into ``target`` inside the database.
+
+    Compiles the cached rate table into a single CASE over the record
+    currency, so an aggregate like ``Sum(converted_amount("HKD"))`` converts
+    every row in the same SQL statement with no extra joins.
+    """
+    rates = get_rates()
+    whens = [
+        When(
+            **{currency_field: currency},
+            then=F(field) * Value(conversion_factor(currency, target, rates)),
+        )
+        for currency in rates
+        if conversion_factor(currency, target, rates) != 1.0
+    ]
+    if not whens:
+        return F(field)
+    return Case(*whens, default=F(field), output_field=FloatField())
@@ -0,0 +1,142 @@
+"""Duplicate record detection.
+
+Two records are duplicates when they have the same family, name (case and
+spacing aside), amount and currency, and were created at most
+DUPLICATE_WINDOW_SECONDS apart: a double-tapped "Add", or a statement
+imported twice.
+
+Every record stores a fingerprint: a hash of those fields and of the time
+window its created_at falls in. Before a new record is saved, the
+fingerprints of its own and the two neighbouring windows are looked up in
+one probe of the fingerprint index. A transaction-level advisory lock on
+the fingerprint's fields makes two identical requests arriving together
+wait for each other, so the second one sees the first.
+
+``find_clusters`` finds duplicates already stored: one pass over the
+family's records in created_at order, keeping only the records of the
+last window in memory. Records saved before fingerprints existed are
+found by it too; ``manage.py find_duplicates --backfill`` fingerprints
+them so that new records are also checked against them.
+"""
+
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, router
+
+from .models import Record
+
+BATCH_SIZE = 2000
+
+
+def normalize_name(name):
+    return " ".join((name or "").lower().split())
+
+
+def _key(family_id, name, amount, currency):
+    return f"{family_id}|{normalize_name(name)}|{float(amount or 0):.2f}|{(currency or '').upper()}"
+
+
+def _window():
+    return timedelta(seconds=settings.DUPLICATE_WINDOW_SECONDS)
+
+
+def _bucket(moment):
+    return int(moment.timestamp()) // max(settings.DUPLICATE_WINDOW_SECONDS, 1)
+
+
+def _hash(key, bucket):
+    return hashlib.blake2b(f"{key}|{bucket}".encode(), digest_size=16).hexdigest()
+
+
+def fingerprint(record):
+    """Fingerprint stored on ``record`` (see Record.save)."""
+    key = _key(record.family_id, record.name, record.amount, record.currency)
+    return _hash(key, _bucket(record.created_at))
+
+
+def find_duplicate(record):
+    """The newest stored record that ``record`` would duplicate, or None.
+
+    Call inside the transaction that saves ``record``: the lock taken here
+    is held until it commits.
+    """
+    key = _key(record.family_id, record.name, record.amount, record.currency)
+    bucket = _bucket(record.created_at)
+    using = router.db_for_write(Record, instance=record)
+    lock_id = int.from_bytes(
+        hashlib.blake2b(key.encode(), digest_size=8).digest(), "big", signed=True
+    )
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [lock_id])
+    window = _window()
+    return (
+        Record.objects.using(using)
+        .filter(
+            fingerprint__in=[_hash(key, b) for b in (bucket - 1, bucket, bucket + 1)],
+            created_at__range=(record.created_at - window, record.created_at + window),
+        )
+        .exclude(pk=record.pk)
+        .order_by("-created_at")
+        .first()
+    )
+
+
+def find_clusters(family_id):
+    """Groups of duplicate records of one family, oldest first.
+
+    Each group is a list of ``{"id", "name", "amount", "currency",
+    "created_at"}`` dicts in created_at order; within a group each record
+    is at most the window apart from the one before it.
+    """
+    window = _window()
+    clusters = []
+    # key -> records of the cluster still open for that key
+    open_clusters = {}
+    rows = (
+        Record.objects.filter(family_id=family_id)
+        .order_by("created_at", "id")
+        .values("id", "name", "amount", "currency", "created_at")
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    for count, row in enumerate(rows, start=1):
+        key = _key(family_id, row["name"], row["amount"], row["currency"])
+        cluster = open_clusters.get(key)
+        if cluster and row["created_at"] - cluster[-1]["created_at"] <= window:
+            cluster.append(row)
+            continue
+        if cluster and len(cluster) > 1:
+            clusters.append(cluster)
+        open_clusters[key] = [row]
+        if count % BATCH_SIZE == 0:
+            # Drop clusters no later record can join.
+            for stale_key, stale in list(open_clusters.items()):
+                if row["created_at"] - stale[-1]["created_at"] > window:
+                    if len(stale) > 1:
+                        clusters.append(stale)
+                    del open_clusters[stale_key]
+    clusters.extend(cluster for cluster in open_clusters.values() if len(cluster) > 1)
+    clusters.sort(key=lambda cluster: (cluster[0]["created_at"], cluster[0]["id"]))
+    return clusters
+
+
+def backfill(family_ids=None):
+    """Fingerprint records saved without one. Returns the number updated."""
+    updated = 0
+    # From the primary: a lagging replica would hand out the same rows again.
+    queryset = Record.objects.using(router.db_for_write(Record)).filter(fingerprint="")
+    if family_ids:
+        queryset = queryset.filter(family_id__in=family_ids)
+    while True:
+        batch = list(
+            queryset.only("id", "family_id", "name", "amount", "currency", "created_at")[
+                :BATCH_SIZE
+            ]
+        )
+        if not batch:
+            return updated
+        for record in batch:
+            record.fingerprint = fingerprint(record)
+        Record.objects.using(queryset.db).bulk_update(batch, ["fingerprint"])
+        updated += len(batch)
@@ -0,0 +1,192 @@
+"""Family change events pushed to browsers over server-sent events.
+
+Model signals publish small JSON events per family once the surrounding
+transaction commits. The broker fans them out to the asyncio queues of the
+SSE streams open in this process. ``PostgresBackend`` routes events
+through LISTEN/NOTIFY so that every web process sees them.
+"""
+
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, router, transaction
+from django.utils.module_loading import import_string
+
+from .models import Family
+
+logger = logging.getLogger(__name__)
+
+# Events queued for a slow client beyond this are dropped; the client
+# refetches on the next event anyway.
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def _put_nowait(queue, event):
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        pass
+
+
+class LocalBackend:
+    """In-process pub/sub. Only reaches streams served by this process."""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, family_id):
+        # Must be called from the event loop that will consume the queue.
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(family_id, set()).add((loop, queue))
+        return queue
+
+    def unsubscribe(self, family_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(family_id)
+            if not subscribers:
+                return
+            subscribers.difference_update(
+                {entry for entry in subscribers if entry[1] is queue}
+            )
+            if not subscribers:
+                del self._subscribers[family_id]
+
+    def publish(self, family_id, event):
+        self._deliver(family_id, event)
+
+    def _deliver(self, family_id, event):
+        with self._lock:
+            targets = list(self._subscribers.get(family_id, ()))
+        for loop, queue in targets:
+            try:
+                loop.call_soon_threadsafe(_put_nowait, queue, event)
+            except RuntimeError:
+                # The loop has been closed; the stream's cleanup will
+                # unsubscribe it.
+                pass
+
+
+class PostgresBackend(LocalBackend):
+    """Pub/sub over Postgres LISTEN/NOTIFY, shared by all processes.
+
+    Each process runs one listener thread on its own connection and hands
+    notifications to its local subscribers.
+    """
+
+    channel = "expense_family_events"
+
+    def __init__(self):
+        super().__init__()
+        self._listener = None
+
+    def subscribe(self, family_id):
+        self._ensure_listener()
+        return super().subscribe(family_id)
+
+    def publish(self, family_id, event):
+        payload = json.dumps({"family_id": family_id, "event": event})
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [self.channel, payload])
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(
+                    target=self._listen, name="family-events-listener", daemon=True
+                )
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                self._listen_once()
+            except Exception:
+                logger.exception("Family event listener failed, reconnecting.")
+                time.sleep(1)
+
+    def _listen_once(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        db = settings.DATABASES["default"]
+        conn = psycopg2.connect(
+            dbname=db["NAME"],
+            user=db["USER"],
+            password=db["PASSWORD"],
+            host=db["HOST"],
+            port=db["PORT"],
+        )
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.channel};")
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    message = json.loads(notify.payload)
+                    self._deliver(message["family_id"], message["event"])
+        finally:
+            conn.close()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.EVENTS_BACKEND)()
+    return _broker
+
+
+def publish_family_event(family_id, event):
+    """Publish ``event`` to ``family_id`` once the current transaction commits."""
+    if family_id is None:
+        return
+    transaction.on_commit(
+        lambda: get_broker().publish(family_id, event),
+        # The family's shard (see expense/sharding.py)
+        using=router.db_for_write(Family),
+    )
+
+
+def _format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+async def family_event_stream(family_id):
+    """Yield SSE frames for ``family_id`` until the client disconnects.
+
+    An idle stream is just a suspended coroutine and a small queue, so a
+    single ASGI worker can hold thousands of them.
+    """
+    broker = get_broker()
+    queue = broker.subscribe(family_id)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    queue.get(), timeout=settings.EVENTS_HEARTBEAT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                # Comment frame keeps proxies from closing idle streams.
+                yield ": keepalive\n\n"
+                continue
+            yield _format_event(event)
+    finally:
+        broker.unsubscribe(family_id, queue)
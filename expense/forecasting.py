@@ -0,0 +1,160 @@
+"""Month-end and year-end spending forecasts.
+
+Forecasts are built from the monthly BudgetTotal rows (``member_id`` 0:
+one row per family, month and category, plus ``category=""`` for the whole
+family), so no records are scanned. For every category at once:
+
+* past months are deseasonalized with per-calendar-month indexes once a
+  year of history exists, then exponentially smoothed into a level;
+* a future month is forecast as ``level * seasonal index``;
+* the current month blends that forecast with the run rate so far, leaning
+  on the run rate as the month goes on.
+
+Results are cached per family for FORECAST_CACHE_SECONDS and dropped once
+a record write commits (see ``apply_deltas``), so the endpoint is cheap
+between writes. That needs a cache shared between processes
+(CACHE_SHARED): with a per-process cache a write by another worker or the
+job runner couldn't drop the entry, so forecasts are computed every time.
+"""
+
+from calendar import monthrange
+from datetime import date
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import sharding
+from .models import BudgetTotal
+
+CACHE_KEY = "forecast:{family_id}"
+
+HISTORY_MONTHS = 36
+SMOOTHING = 0.4
+# Seasonal indexes need at least one full year of history.
+SEASONAL_MIN_MONTHS = 12
+
+
+def _month_index(period):
+    return period.year * 12 + period.month - 1
+
+
+def _period(month_index):
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def invalidate(family_ids):
+    if not settings.CACHE_SHARED:
+        return
+    cache.delete_many([CACHE_KEY.format(family_id=family_id) for family_id in family_ids])
+
+
+def _compute(family_id, now):
+    # NumPy is imported on the first cache miss, not at startup: this module
+    # is loaded by the record signals.
+    import numpy as np
+
+    today = now.date()
+    current = _month_index(today)
+    # Read from the primary of the family's shard, named directly: the result
+    # is cached, so a lagging replica would keep a stale forecast around, and
+    # routing it as a write would pin the request to the primary.
+    rows = BudgetTotal.objects.using(sharding.active()).filter(
+        family_id=family_id,
+        member_id=0,
+        period__gte=_period(current - HISTORY_MONTHS),
+        period__lte=_period(current),
+    ).values_list("category", "period", "total")
+
+    categories, periods, totals = [], [], []
+    for category, period, total in rows:
+        categories.append(category)
+        periods.append(_month_index(period))
+        totals.append(total)
+    if not categories:
+        return {"date": today.isoformat(), "categories": []}
+
+    keys, cat_index = np.unique(np.array(categories, dtype=object), return_inverse=True)
+    months = np.array(periods)
+    first = months.min()
+    # (category, month) matrix from the family's first recorded month up to
+    # the current one; months without a row had no spend.
+    matrix = np.zeros((len(keys), current - first + 1))
+    np.add.at(matrix, (cat_index, months - first), np.array(totals, dtype=float))
+    history, spent = matrix[:, :-1], matrix[:, -1]
+    calendar_months = (np.arange(first, current) % 12).astype(int)
+
+    seasonal = np.ones((len(keys), 12))
+    if history.shape[1] >= SEASONAL_MIN_MONTHS:
+        counts = np.bincount(calendar_months, minlength=12)
+        sums = np.zeros((len(keys), 12))
+        np.add.at(sums.T, calendar_months, history.T)
+        overall = history.mean(axis=1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            by_month = sums / counts
+            index = by_month / overall
+        # Calendar months not seen yet, or a category with no spend, stay flat.
+        seasonal = np.where(np.isfinite(index) & (counts > 0), index, 1.0)
+
+    level = np.zeros(len(keys))
+    if history.shape[1]:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            adjusted = np.where(
+                seasonal[:, calendar_months] > 0,
+                history / seasonal[:, calendar_months],
+                history,
+            )
+        level = adjusted[:, 0]
+        for column in range(1, adjusted.shape[1]):
+            level = SMOOTHING * adjusted[:, column] + (1 - SMOOTHING) * level
+
+    def forecast(month_index):
+        return level * seasonal[:, month_index % 12]
+
+    days = monthrange(today.year, today.month)[1]
+    month_start = timezone.localtime(now).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    elapsed = min((now - month_start).total_seconds() / (days * 86400), 1.0)
+    expected = forecast(current) if history.shape[1] else spent / max(elapsed, 1e-9)
+    run_rate = spent / elapsed if elapsed > 0 else expected
+    month_end = np.maximum(spent, (1 - elapsed) * expected + elapsed * run_rate)
+
+    year_start = today.year * 12
+    in_year = np.arange(first, current) >= year_start
+    year_to_date = history[:, in_year].sum(axis=1)
+    rest_of_year = sum(
+        (forecast(m) for m in range(current + 1, year_start + 12)), np.zeros(len(keys))
+    )
+    year_end = year_to_date + month_end + rest_of_year
+
+    return {
+        "date": today.isoformat(),
+        "categories": [
+            {
+                "category": str(keys[i]),
+                "spent_this_month": float(spent[i]),
+                "month_end": float(month_end[i]),
+                "year_end": float(year_end[i]),
+            }
+            for i in range(len(keys))
+        ],
+    }
+
+
+def family_forecast(family_id, now=None):
+    """Return the forecast of ``family_id``, cached if the cache is shared.
+
+    ``category`` is "" for the family as a whole.
+    """
+    now = now or timezone.now()
+    if not settings.CACHE_SHARED:
+        return _compute(family_id, timezone.localtime(now))
+    key = CACHE_KEY.format(family_id=family_id)
+    cached = cache.get(key)
+    # The run-rate blend depends on the day, so yesterday's forecast is stale.
+    if cached is not None and cached["date"] == timezone.localdate(now).isoformat():
+        return cached
+    result = _compute(family_id, timezone.localtime(now))
+    cache.set(key, result, settings.FORECAST_CACHE_SECONDS)
+    return result
@@ -0,0 +1,164 @@
+"""Idempotency keys for mutating API calls.
+
+A client that may retry a request (a phone on a flaky network) sends an
+``Idempotency-Key`` header with a value unique to that operation. Views
+opt in with ``@idempotent``. The first request with a given key runs the
+view and stores its response for IDEMPOTENCY_KEY_TTL seconds; requests
+repeating the key get that response back, with ``Idempotent-Replayed:
+true``, and the view doesn't run again. Keys are per user.
+
+The key's row is inserted in a transaction on the default database that
+stays open while the view runs, and the response is stored in that same
+transaction. A concurrent request with the same key therefore blocks on
+the unique index until the first one commits, then replays its response;
+after IDEMPOTENCY_WAIT_SECONDS it gives up with 409. Writes the view makes
+to the default database commit together with the key; if the view raises,
+both roll back and a retry runs the view again. 5xx and streaming
+responses are not stored.
+
+Reusing a key for a different request (method, path or body) answers
+422. ``manage.py cleanup_idempotency_keys`` deletes expired keys.
+"""
+
+import hashlib
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+MUTATING_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+# lock_not_available: the wait for the first request timed out
+LOCK_TIMEOUT_SQLSTATE = "55P03"
+
+
+class KeyInUse(Exception):
+    """Another request holding the same key didn't finish in time."""
+
+
+def request_hash(request):
+    digest = hashlib.sha256(f"{request.method} {request.path}\n".encode())
+    digest.update(request.body)
+    return digest.hexdigest()
+
+
+def _claim(user_id, key, digest):
+    """Insert the key's row; False if a live row for it already exists.
+
+    Waits (up to IDEMPOTENCY_WAIT_SECONDS) for a transaction inserting the
+    same key to finish first, then raises KeyInUse.
+    """
+    table = IdempotencyKey._meta.db_table
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+        cursor.execute(
+            "SELECT current_setting('lock_timeout'), set_config('lock_timeout', %s, true)",
+            [f"{int(settings.IDEMPOTENCY_WAIT_SECONDS * 1000)}ms"],
+        )
+        previous_timeout = cursor.fetchone()[0]
+        # An expired row is taken over as if it weren't there.
+        try:
+            cursor.execute(
+                f"INSERT INTO {table} "
+                "(user_id, key, request_hash, status_code, content_type, body, created_at, expires_at) "
+                "VALUES (%s, %s, %s, NULL, '', %s, %s, %s) "
+                "ON CONFLICT (user_id, key) DO UPDATE SET "
+                "request_hash = EXCLUDED.request_hash, status_code = NULL, content_type = '', "
+                "body = EXCLUDED.body, created_at = EXCLUDED.created_at, "
+                "expires_at = EXCLUDED.expires_at "
+                f"WHERE {table}.expires_at < EXCLUDED.created_at "
+                "RETURNING id",
+                [user_id, key, digest, b"", now, expires_at],
+            )
+        except OperationalError as e:
+            if _is_lock_timeout(e):
+                raise KeyInUse from e
+            raise
+        claimed = cursor.fetchone() is not None
+        cursor.execute("SELECT set_config('lock_timeout', %s, true)", [previous_timeout])
+    return claimed
+
+
+def _store(user_id, key, response):
+    keys = IdempotencyKey.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_id, key=key)
+    if response.streaming or response.status_code >= 500:
+        # Not replayable, or a failure the client should be able to retry.
+        keys.delete()
+        return
+    keys.update(
+        status_code=response.status_code,
+        content_type=response.get("Content-Type", ""),
+        body=response.content,
+    )
+
+
+def _replay(stored, digest):
+    if stored is None or stored.status_code is None:
+        # Deleted (cleanup) or released (5xx) since the conflict: retry.
+        return _error(409, "A request with this Idempotency-Key is being processed.")
+    if stored.request_hash != digest:
+        return _error(422, "Idempotency-Key was already used for a different request.")
+    response = HttpResponse(
+        bytes(stored.body), status=stored.status_code, content_type=stored.content_type
+    )
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _error(status, detail):
+    response = JsonResponse({"detail": detail}, status=status)
+    if status == 409:
+        response["Retry-After"] = "1"
+    return response
+
+
+def _is_lock_timeout(error):
+    cause = error.__cause__
+    return (getattr(cause, "pgcode", None) or getattr(cause, "sqlstate", None)) == (
+        LOCK_TIMEOUT_SQLSTATE
+    )
+
+
+def idempotent(view):
+    """Replay the stored response for repeated ``Idempotency-Key`` requests."""
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER, "").strip()
+        user = getattr(request, "user", None)
+        if (
+            not key
+            or request.method not in MUTATING_METHODS
+            or user is None
+            or not user.is_authenticated
+        ):
+            return view(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return _error(400, f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters.")
+
+        digest = request_hash(request)
+        try:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                if _claim(user.pk, key, digest):
+                    response = view(request, *args, **kwargs)
+                    _store(user.pk, key, response)
+                    return response
+        except KeyInUse:
+            return _error(409, "A request with this Idempotency-Key is being processed.")
+
+        stored = (
+            IdempotencyKey.objects.using(DEFAULT_DB_ALIAS)
+            .filter(user_id=user.pk, key=key)
+            .first()
+        )
+        return _replay(stored, digest)
+
+    return wrapper
@@ -0,0 +1,151 @@
+"""Database-backed background jobs.
+
+Jobs are rows in the Job table, so enqueueing inside a transaction only
+makes the job visible once that transaction commits, and nothing but
+Postgres is needed. Workers (``manage.py run_jobs``) claim due jobs with
+``SELECT ... FOR UPDATE SKIP LOCKED``, so any number of them can poll the
+same table without handing out a job twice, and run them in a thread or
+process pool.
+
+A failing job is retried with exponential backoff (JOB_RETRY_BACKOFF
+seconds, doubled per attempt, capped at JOB_RETRY_BACKOFF_MAX) until it has
+been attempted ``max_attempts`` times. A job left running by a worker that
+died is claimed again once its lock is older than JOB_LOCK_TIMEOUT, unless
+that was its last attempt: then it fails, so a job that kills its worker
+isn't retried forever.
+
+Handlers are registered by name::
+
+    @register("qrcode.delete_file")
+    def delete_file(path): ...
+
+    enqueue("qrcode.delete_file", path=qr.image.name)
+"""
+
+import logging
+import random
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+def register(name):
+    def decorator(func):
+        _handlers[name] = func
+        return func
+
+    return decorator
+
+
+def enqueue(name, run_at=None, max_attempts=None, **payload):
+    if name not in _handlers:
+        raise ValueError(f"No job handler registered for {name!r}.")
+    return Job.objects.create(
+        name=name,
+        payload=payload,
+        run_at=run_at or timezone.now(),
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+    )
+
+
+def _claimable(now):
+    stale = now - timedelta(seconds=settings.JOB_LOCK_TIMEOUT)
+    return Q(status=Job.STATUS_QUEUED, run_at__lte=now) | Q(
+        status=Job.STATUS_RUNNING, locked_at__lt=stale
+    )
+
+
+def claim(worker, limit):
+    """Lock up to ``limit`` due jobs for ``worker`` and mark them running."""
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(_claimable(now))
+            .order_by("run_at")[:limit]
+        )
+        claimed, abandoned = [], []
+        for job in jobs:
+            if job.status == Job.STATUS_RUNNING and job.attempts >= job.max_attempts:
+                # Its worker died during the last attempt.
+                job.status = Job.STATUS_FAILED
+                job.finished_at = now
+                job.locked_at = None
+                job.last_error = f"Worker {job.locked_by} stopped while running the job."
+                abandoned.append(job)
+                continue
+            job.status = Job.STATUS_RUNNING
+            job.attempts += 1
+            job.locked_at = now
+            job.locked_by = worker
+            claimed.append(job)
+        Job.objects.bulk_update(claimed, ["status", "attempts", "locked_at", "locked_by"])
+        Job.objects.bulk_update(
+            abandoned, ["status", "finished_at", "locked_at", "last_error"]
+        )
+    for job in abandoned:
+        logger.warning("Job %s (%s) failed: its worker stopped.", job.id, job.name)
+    return claimed
+
+
+def retry_delay(attempts):
+    delay = min(
+        settings.JOB_RETRY_BACKOFF * 2 ** max(attempts - 1, 0),
+        settings.JOB_RETRY_BACKOFF_MAX,
+    )
+    # Jitter keeps jobs that failed together from retrying together.
+    return delay * random.uniform(0.5, 1.0)
+
+
+def run(job_id):
+    """Run a claimed job and record the outcome. Safe to call in a subprocess."""
+    close_old_connections()
+    try:
+        job = Job.objects.get(id=job_id)
+        try:
+            handler = _handlers[job.name]
+            handler(**job.payload)
+        except Exception:
+            job.last_error = traceback.format_exc()
+            if job.attempts < job.max_attempts:
+                job.status = Job.STATUS_QUEUED
+                job.run_at = timezone.now() + timedelta(seconds=retry_delay(job.attempts))
+            else:
+                job.status = Job.STATUS_FAILED
+                job.finished_at = timezone.now()
+            logger.warning("Job %s (%s) failed, attempt %s.", job.id, job.name, job.attempts)
+        else:
+            job.status = Job.STATUS_DONE
+            job.finished_at = timezone.now()
+        job.locked_at = None
+        job.save(
+            update_fields=["status", "run_at", "last_error", "locked_at", "finished_at"]
+        )
+        return job.status
+    finally:
+        close_old_connections()
+
+
+def queue_stats():
+    """Return queue-depth metrics, read with one aggregate query."""
+    now = timezone.now()
+    stats = Job.objects.aggregate(
+        queued=Count("id", filter=Q(status=Job.STATUS_QUEUED)),
+        due=Count("id", filter=Q(status=Job.STATUS_QUEUED, run_at__lte=now)),
+        running=Count("id", filter=Q(status=Job.STATUS_RUNNING)),
+        failed=Count("id", filter=Q(status=Job.STATUS_FAILED)),
+        oldest_due=Min("run_at", filter=Q(status=Job.STATUS_QUEUED, run_at__lte=now)),
+    )
+    oldest_due = stats.pop("oldest_due")
+    stats["oldest_due_seconds"] = (now - oldest_due).total_seconds() if oldest_due else 0
+    return stats
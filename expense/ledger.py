@@ -0,0 +1,335 @@
+"""Columnar ledger files and the statistics computed from them.
+
+A ledger file (see expense/snapshots.py) stores one family's records as
+columns, sorted by ``(ts, id)``:
+
+==========  =======  ==================================================
+id          int64    record id
+ts          int64    created_at, Unix seconds
+month       int32    ``year * 12 + month - 1`` of created_at (TIME_ZONE)
+amount      float64  amount in the record's own currency
+currency    int16    index into the ``currency`` string table
+category    int16    CATEGORY_CODES code, -1 if uncategorized
+member      int32    who_id, 0 if nobody
+name        int32    index into the ``name`` string table
+==========  =======  ==================================================
+
+Layout: an 8-byte magic, the columns at 64-byte aligned offsets, then a
+JSON footer (row count, column offsets and dtypes, string tables, sync
+time), its length as 8 little-endian bytes and the magic again. The file
+is mapped read-only and every column is a view into the mapping, so
+opening a ledger reads only the footer. A new version is written to a
+temporary file and renamed over the old one; readers that still have the
+old file mapped keep their consistent view.
+
+Amounts stay in their own currency and are converted when aggregated, one
+multiply by a per-currency factor, so exchange-rate updates don't make
+snapshots stale.
+"""
+
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import numpy as np
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import sharding
+from .analysis import CATEGORY_KEYS, Epoch, category_code, month_index
+from .currency import conversion_factor
+from .models import Record
+from .snapshots import snapshot_path
+
+MAGIC = b"EXLEDGR1"
+ALIGN = 64
+
+COLUMNS = {
+    "id": np.dtype("<i8"),
+    "ts": np.dtype("<i8"),
+    "month": np.dtype("<i4"),
+    "amount": np.dtype("<f8"),
+    "currency": np.dtype("<i2"),
+    "category": np.dtype("<i2"),
+    "member": np.dtype("<i4"),
+    "name": np.dtype("<i4"),
+}
+ROW_DTYPE = np.dtype(list(COLUMNS.items()))
+STRING_TABLES = ("currency", "name")
+
+# Records streamed from the database per round trip
+BATCH_SIZE = 5000
+# Records updated this long before the last refresh started are read again:
+# covers transactions still open then, and clock skew between servers.
+SYNC_MARGIN_SECONDS = 60
+# Ledgers kept open (mapped) per process
+OPEN_LEDGERS = 32
+
+
+class Ledger:
+    """An opened ledger file: read-only columns backed by the mapping."""
+
+    def __init__(self, path):
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(data[:8]) != MAGIC or bytes(data[-8:]) != MAGIC:
+            raise ValueError(f"{path} is not a ledger file.")
+        footer_length = int.from_bytes(bytes(data[-16:-8]), "little")
+        footer = json.loads(bytes(data[-16 - footer_length : -16]))
+        self.family_id = footer["family_id"]
+        self.synced_at = datetime.fromisoformat(footer["synced_at"])
+        self.strings = footer["strings"]
+        rows = footer["rows"]
+        self.columns = {}
+        for name, (dtype, offset) in footer["columns"].items():
+            dtype = np.dtype(dtype)
+            self.columns[name] = data[offset : offset + rows * dtype.itemsize].view(dtype)
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def window(self, start=None, end=None):
+        """Row slice of records created in [start, end) (aware datetimes)."""
+        ts = self.columns["ts"]
+        lo = 0 if start is None else int(np.searchsorted(ts, start.timestamp(), side="left"))
+        hi = len(ts) if end is None else int(np.searchsorted(ts, end.timestamp(), side="left"))
+        return slice(lo, max(lo, hi))
+
+    def amounts(self, currency, rows=slice(None)):
+        """Amounts of ``rows`` converted to ``currency``."""
+        factors = np.array(
+            [conversion_factor(code, currency) for code in self.strings["currency"]] or [1.0]
+        )
+        return self.columns["amount"][rows] * factors[self.columns["currency"][rows]]
+
+
+def write(path, family_id, columns, strings, synced_at):
+    """Write a ledger file atomically (see the module docstring)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(MAGIC)
+            layout = {}
+            for name, dtype in COLUMNS.items():
+                file.write(b"\0" * (-file.tell() % ALIGN))
+                layout[name] = (dtype.str, file.tell())
+                file.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+            footer = json.dumps(
+                {
+                    "family_id": family_id,
+                    "rows": len(columns["id"]),
+                    "synced_at": synced_at.isoformat(),
+                    "columns": layout,
+                    "strings": strings,
+                }
+            ).encode()
+            file.write(footer)
+            file.write(len(footer).to_bytes(8, "little"))
+            file.write(MAGIC)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+@lru_cache(maxsize=OPEN_LEDGERS)
+def _open(path, inode, mtime_ns):
+    # Keyed by inode and mtime, so a replaced file is opened afresh.
+    return Ledger(path)
+
+
+def open_ledger(family_id):
+    """The family's snapshot, or None if it has none."""
+    path = snapshot_path(family_id)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return _open(str(path), stat.st_ino, stat.st_mtime_ns)
+
+
+def _read_rows(queryset, strings):
+    """Columns of ``queryset``'s records; new strings are added to ``strings``."""
+    codes = {table: {s: i for i, s in enumerate(strings[table])} for table in STRING_TABLES}
+
+    def code(table, value):
+        value = value or ""
+        index = codes[table].get(value)
+        if index is None:
+            index = codes[table][value] = len(strings[table])
+            strings[table].append(value)
+        return index
+
+    rows = (
+        queryset.annotate(
+            ts=Epoch("created_at"),
+            month=month_index(),
+            category_code=category_code(),
+            member=Coalesce("who_id", 0),
+        )
+        .values_list("id", "ts", "month", "amount", "currency", "category_code", "member", "name")
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    data = np.fromiter(
+        (
+            (
+                id_,
+                int(ts),
+                month,
+                amount or 0,
+                code("currency", currency),
+                category,
+                member,
+                code("name", name),
+            )
+            for id_, ts, month, amount, currency, category, member, name in rows
+        ),
+        dtype=ROW_DTYPE,
+    )
+    return {name: data[name] for name in COLUMNS}
+
+
+def _compact(columns, strings):
+    """Drop string table entries no row refers to, e.g. old names of records."""
+    for table in STRING_TABLES:
+        used, codes = np.unique(columns[table], return_inverse=True)
+        strings[table] = [strings[table][i] for i in used.tolist()]
+        columns[table] = codes.astype(COLUMNS[table])
+
+
+def _sorted(columns):
+    order = np.lexsort((columns["id"], columns["ts"]))
+    return {name: column[order] for name, column in columns.items()}
+
+
+def _records(family_id):
+    # From the primary of the active shard, named directly so the read doesn't
+    # pin the request: a lagging replica would leave the snapshot behind
+    # until the record is written again.
+    return Record.objects.using(sharding.active()).filter(family_id=family_id)
+
+
+def build(family_id):
+    """Write the family's snapshot from scratch; returns it opened."""
+    synced_at = timezone.now()
+    strings = {table: [] for table in STRING_TABLES}
+    columns = _sorted(_read_rows(_records(family_id), strings))
+    write(snapshot_path(family_id), family_id, columns, strings, synced_at)
+    return open_ledger(family_id)
+
+
+def refresh(family_id):
+    """Merge records changed since the last sync into the family's snapshot.
+
+    Builds it if it's missing. Returns the number of records read.
+    """
+    ledger = open_ledger(family_id)
+    if ledger is None:
+        return len(build(family_id))
+
+    synced_at = timezone.now()
+    since = ledger.synced_at - timedelta(seconds=SYNC_MARGIN_SECONDS)
+    strings = {table: list(ledger.strings[table]) for table in STRING_TABLES}
+    changed = _read_rows(_records(family_id).filter(updated_at__gte=since), strings)
+    keep = ~np.isin(ledger["id"], changed["id"])
+    columns = {
+        name: np.concatenate((ledger[name][keep], changed[name])) for name in COLUMNS
+    }
+    if len(columns["id"]) != _records(family_id).count():
+        # Records were deleted (or archived): keep only those still there.
+        ids = np.fromiter(
+            _records(family_id).values_list("id", flat=True).iterator(chunk_size=BATCH_SIZE),
+            dtype=np.int64,
+        )
+        present = np.isin(columns["id"], ids)
+        columns = {name: column[present] for name, column in columns.items()}
+    # The file is rewritten anyway, so it might as well not carry the
+    # strings of renamed and deleted records along.
+    _compact(columns, strings)
+    write(snapshot_path(family_id), family_id, _sorted(columns), strings, synced_at)
+    return len(changed["id"])
+
+
+def load(family_id):
+    """The family's snapshot, built first if it has none."""
+    return open_ledger(family_id) or build(family_id)
+
+
+def summarize(ledger, currency, start=None, end=None, bins=20, top=10):
+    """Aggregates of the records created in [start, end), in ``currency``."""
+    rows = ledger.window(start, end)
+    amounts = ledger.amounts(currency, rows)
+    count = len(amounts)
+    if not count:
+        return {
+            "count": 0,
+            "total": 0.0,
+            "mean": None,
+            "percentiles": {},
+            "histogram": {"edges": [], "counts": []},
+            "months": [],
+            "categories": [],
+            "members": [],
+            "largest": [],
+        }
+
+    percentiles = np.percentile(amounts, [10, 25, 50, 75, 90, 99])
+    counts, edges = np.histogram(amounts, bins=bins)
+
+    # Rows are sorted by time, so months are already in order.
+    months, month_rows = np.unique(ledger["month"][rows], return_inverse=True)
+    month_totals = np.bincount(month_rows, weights=amounts)
+
+    categories = ledger["category"][rows].astype(np.int64) + 1
+    category_totals = np.bincount(categories, weights=amounts, minlength=len(CATEGORY_KEYS) + 1)
+    category_counts = np.bincount(categories, minlength=len(CATEGORY_KEYS) + 1)
+
+    members, member_rows = np.unique(ledger["member"][rows], return_inverse=True)
+    member_totals = np.bincount(member_rows, weights=amounts)
+
+    top = min(top, count)
+    candidates = np.argpartition(-amounts, top - 1)[:top]
+    largest = candidates[np.argsort(-amounts[candidates], kind="stable")]
+    names = ledger.strings["name"]
+
+    return {
+        "count": count,
+        "total": float(amounts.sum()),
+        "mean": float(amounts.mean()),
+        "percentiles": {
+            f"p{p}": float(value) for p, value in zip((10, 25, 50, 75, 90, 99), percentiles)
+        },
+        "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+        "months": [
+            {"month": f"{m // 12:04d}-{m % 12 + 1:02d}", "total": float(total)}
+            for m, total in zip(months.tolist(), month_totals)
+        ],
+        "categories": [
+            {
+                "category": CATEGORY_KEYS[code - 1] if code else "",
+                "total": float(category_totals[code]),
+                "count": int(category_counts[code]),
+            }
+            for code in np.nonzero(category_counts)[0].tolist()
+        ],
+        "members": [
+            {"member_id": member or None, "total": float(total)}
+            for member, total in zip(members.tolist(), member_totals)
+        ],
+        "largest": [
+            {
+                "record_id": int(ledger["id"][rows][i]),
+                "name": names[ledger["name"][rows][i]],
+                "amount": float(amounts[i]),
+                "created_at": datetime.fromtimestamp(
+                    int(ledger["ts"][rows][i]), tz=timezone.get_current_timezone()
+                ).isoformat(),
+            }
+            for i in largest.tolist()
+        ],
+    }
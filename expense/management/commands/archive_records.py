@@ -0,0 +1,66 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from expense import partitioning
+
+
+class Command(BaseCommand):
+    help = (
+        "Move record partitions that end before a date to compressed archive "
+        "files, or restore an archived partition."
+    )
+
+    def add_arguments(self, parser):
+        group = parser.add_mutually_exclusive_group(required=True)
+        group.add_argument(
+            "--before",
+            help="Archive every partition that ends on or before this date (YYYY-MM-DD).",
+        )
+        group.add_argument(
+            "--restore",
+            metavar="PARTITION",
+            help="Restore an archived partition, e.g. expense_record_y2022.",
+        )
+        parser.add_argument(
+            "--database",
+            default=DEFAULT_DB_ALIAS,
+            help="Database (shard) to work on (default: default).",
+        )
+
+    def handle(self, *args, **options):
+        using = options["database"]
+        connection = connections[using]
+        if connection.vendor != "postgresql":
+            raise CommandError("Record archival requires PostgreSQL.")
+
+        try:
+            if options["restore"]:
+                path = partitioning.restore_partition(options["restore"], using)
+                self.stdout.write(
+                    self.style.SUCCESS(f"Restored {options['restore']} from {path}.")
+                )
+                return
+
+            try:
+                cutoff = datetime.strptime(options["before"], "%Y-%m-%d")
+            except ValueError:
+                raise CommandError("--before must be a date in YYYY-MM-DD format.")
+            cutoff = cutoff.replace(tzinfo=partitioning.local_timezone())
+
+            with connection.cursor() as cursor:
+                names = [name for name, _ in partitioning.list_partitions(cursor)]
+            archived = 0
+            for name in names:
+                if name == partitioning.DEFAULT_PARTITION:
+                    continue
+                _, end = partitioning.bounds_from_name(name)
+                if end <= cutoff:
+                    path = partitioning.archive_partition(name, using)
+                    self.stdout.write(f"Archived {name} to {path}")
+                    archived += 1
+        except partitioning.PartitioningError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(f"{archived} partitions archived."))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+from expense.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = "Delete expired idempotency keys in small batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of keys deleted per statement (default: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        keys = IdempotencyKey.objects.using(DEFAULT_DB_ALIAS)
+        now = timezone.now()
+        total = 0
+        # Batches keep each delete short; requests insert into this table.
+        while True:
+            ids = list(keys.filter(expires_at__lt=now).values_list("id", flat=True)[:batch_size])
+            if not ids:
+                break
+            deleted, _ = keys.filter(id__in=ids).delete()
+            total += deleted
+
+        self.stdout.write(self.style.SUCCESS(f"Deleted {total} expired idempotency keys."))
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = "Delete expired rows from django_session in small batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of sessions deleted per statement (default: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        if settings.SESSION_MODE == "signed_cookies":
+            self.stdout.write("Signed cookie sessions are not stored server-side.")
+            return
+
+        batch_size = options["batch_size"]
+        now = timezone.now()
+        total = 0
+        # Delete by primary key in batches so a large backlog never holds
+        # a long lock on the table used by every authenticated request.
+        while True:
+            keys = list(
+                Session.objects.filter(expire_date__lt=now).values_list(
+                    "session_key", flat=True
+                )[:batch_size]
+            )
+            if not keys:
+                break
+            deleted, _ = Session.objects.filter(session_key__in=keys).delete()
+            total += deleted
+
+        self.stdout.write(self.style.SUCCESS(f"Deleted {total} expired sessions."))
@@ -0,0 +1,51 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from expense import sharding
+from expense.analysis import family_anomalies
+from expense.models import Family
+
+
+class Command(BaseCommand):
+    help = (
+        "Scan every family's records for unusual expenses and monthly "
+        "category spikes, printing one JSON line per finding."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--family",
+            type=int,
+            action="append",
+            help="Only scan this family id (may be repeated).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=200,
+            help="Families loaded into memory at once (default: 200).",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = max(options["batch_size"], 1)
+        scanned = outliers = spikes = 0
+        for alias in sharding.shards():
+            with sharding.use_shard(alias):
+                family_ids = Family.objects.order_by("id").values_list("id", flat=True)
+                if options["family"]:
+                    family_ids = family_ids.filter(id__in=options["family"])
+                family_ids = list(family_ids)
+                for start in range(0, len(family_ids), batch_size):
+                    found = family_anomalies(family_ids[start : start + batch_size])
+                    for outlier in found["outliers"]:
+                        self.stdout.write(json.dumps({"type": "outlier", **outlier}))
+                    for spike in found["spikes"]:
+                        self.stdout.write(json.dumps({"type": "spike", **spike}))
+                    outliers += len(found["outliers"])
+                    spikes += len(found["spikes"])
+            scanned += len(family_ids)
+
+        self.stderr.write(
+            f"Scanned {scanned} families: {outliers} outliers, {spikes} spikes."
+        )
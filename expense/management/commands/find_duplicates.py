@@ -0,0 +1,59 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from expense import sharding
+from expense.duplicates import backfill, find_clusters
+from expense.models import Family
+
+
+class Command(BaseCommand):
+    help = (
+        "Find groups of duplicate records (same name, amount and currency "
+        "within DUPLICATE_WINDOW_SECONDS), printing one JSON line per group."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--family",
+            type=int,
+            action="append",
+            help="Only scan this family id (may be repeated).",
+        )
+        parser.add_argument(
+            "--backfill",
+            action="store_true",
+            help="First fingerprint records saved before duplicate checks existed.",
+        )
+
+    def handle(self, *args, **options):
+        scanned = found = updated = 0
+        for alias in sharding.shards():
+            with sharding.use_shard(alias):
+                if options["backfill"]:
+                    updated += backfill(options["family"])
+                family_ids = Family.objects.order_by("id").values_list("id", flat=True)
+                if options["family"]:
+                    family_ids = family_ids.filter(id__in=options["family"])
+                for family_id in family_ids:
+                    for cluster in find_clusters(family_id):
+                        self.stdout.write(
+                            json.dumps(
+                                {
+                                    "family_id": family_id,
+                                    "name": cluster[0]["name"],
+                                    "amount": cluster[0]["amount"],
+                                    "currency": cluster[0]["currency"],
+                                    "record_ids": [row["id"] for row in cluster],
+                                    "created_at": [
+                                        row["created_at"].isoformat() for row in cluster
+                                    ],
+                                }
+                            )
+                        )
+                        found += 1
+                    scanned += 1
+
+        if options["backfill"]:
+            self.stderr.write(f"Fingerprinted {updated} records.")
+        self.stderr.write(f"Scanned {scanned} families: {found} duplicate groups.")
@@ -0,0 +1,123 @@
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Exists, OuterRef, Q
+
+from expense import sharding
+from expense.models import BudgetTotal, Family
+from expense.statements import default_period, generate, month_bounds, month_is_over, parse_period
+
+# Family ids fetched per round trip while streaming them
+BATCH_SIZE = 2000
+
+
+class Command(BaseCommand):
+    help = (
+        "Render the monthly statement of every family (see expense/statements.py). "
+        "Run it from cron early each month, e.g. '0 3 1 * *'."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--month",
+            help="Month to render, as YYYY-MM (default: the last complete month).",
+        )
+        parser.add_argument(
+            "--family",
+            type=int,
+            action="append",
+            help="Only render this family id (may be repeated).",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Render statements again even if they exist.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.JOB_WORKERS,
+            help="Statements rendered concurrently (default: JOB_WORKERS).",
+        )
+        parser.add_argument(
+            "--pool",
+            choices=["thread", "process"],
+            default=settings.JOB_POOL,
+            help="Render in threads or processes (default: JOB_POOL).",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            period = parse_period(options["month"]) if options["month"] else default_period()
+        except ValueError:
+            raise CommandError("--month must look like 2025-01.")
+        if not month_is_over(period):
+            raise CommandError(f"{period:%Y-%m} isn't over yet.")
+        workers = options["workers"]
+        if workers < 1:
+            raise CommandError("--workers must be at least 1.")
+
+        if options["pool"] == "process":
+            # Spawned rather than forked, so no child inherits the parent's
+            # database connection. The initializer must not live in this
+            # module: unpickling it would import models before setup.
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup,
+            )
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+
+        # future -> family id; at most two per worker, so the ids streamed
+        # from the database never pile up in the pool's queue.
+        running = {}
+        counts = {"rendered": 0, "skipped": 0, "failed": 0}
+        try:
+            for alias in sharding.shards():
+                with sharding.use_shard(alias):
+                    # Families that existed that month, or have spending in it
+                    # (records can be dated before the family was created).
+                    family_ids = Family.objects.filter(
+                        Q(created_at__lt=month_bounds(period)[1])
+                        | Exists(
+                            BudgetTotal.objects.filter(family=OuterRef("pk"), period=period)
+                        )
+                    ).order_by("id")
+                    if options["family"]:
+                        family_ids = family_ids.filter(id__in=options["family"])
+                    if not options["force"]:
+                        family_ids = family_ids.exclude(statements__period=period)
+                    for family_id in family_ids.values_list("id", flat=True).iterator(
+                        chunk_size=BATCH_SIZE
+                    ):
+                        if len(running) >= workers * 2:
+                            self._collect(running, counts)
+                        future = pool.submit(generate, family_id, period, alias, options["force"])
+                        running[future] = family_id
+            while running:
+                self._collect(running, counts)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        self.stdout.write(
+            f"{period:%Y-%m}: rendered {counts['rendered']} statements, "
+            f"skipped {counts['skipped']}, {counts['failed']} failed."
+        )
+        if counts["failed"]:
+            raise CommandError("Some statements failed; run again to retry them.")
+
+    def _collect(self, running, counts):
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+            family_id = running.pop(future)
+            try:
+                rendered = future.result()
+            except Exception as e:
+                counts["failed"] += 1
+                self.stderr.write(f"Family {family_id} failed: {e!r}")
+            else:
+                counts["rendered" if rendered else "skipped"] += 1
@@ -0,0 +1,56 @@
+import csv
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from expense.currency import bump_version, normalize_currency
+from expense.models import ExchangeRate
+
+
+class Command(BaseCommand):
+    help = (
+        "Load exchange rates from a CSV file with 'currency,rate' columns, "
+        "where rate is units of the currency per one EXCHANGE_RATE_BASE."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV file to load.")
+        parser.add_argument(
+            "--replace",
+            action="store_true",
+            help="Delete rates for currencies that are not in the file.",
+        )
+
+    def handle(self, *args, **options):
+        rates = {}
+        try:
+            with open(options["path"], newline="") as fh:
+                for row in csv.DictReader(fh):
+                    currency = normalize_currency(row.get("currency"))
+                    if not currency:
+                        continue
+                    rate = float(row["rate"])
+                    if rate <= 0:
+                        raise ValueError(f"rate for {currency} must be positive")
+                    rates[currency] = rate
+        except (OSError, KeyError, ValueError) as e:
+            raise CommandError(f"Could not read {options['path']}: {e}")
+
+        base = normalize_currency(settings.EXCHANGE_RATE_BASE)
+        if rates.setdefault(base, 1.0) != 1.0:
+            raise CommandError(f"The base currency {base} must have rate 1.")
+
+        with transaction.atomic():
+            ExchangeRate.objects.bulk_create(
+                [ExchangeRate(currency=c, rate=r) for c, r in rates.items()],
+                update_conflicts=True,
+                unique_fields=["currency"],
+                update_fields=["rate", "updated_at"],
+            )
+            if options["replace"]:
+                ExchangeRate.objects.exclude(currency__in=rates).delete()
+        # bulk_create skips post_save, so invalidate the rate caches here.
+        bump_version()
+
+        self.stdout.write(self.style.SUCCESS(f"Loaded {len(rates)} exchange rates."))
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from expense import sharding
+from expense.models import FamilyShard
+
+
+class Command(BaseCommand):
+    help = (
+        "Maintain family shards: sync the shard directory, show how records "
+        "are spread, or move families between shards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action",
+            choices=["status", "sync", "move", "auto"],
+            nargs="?",
+            default="status",
+        )
+        parser.add_argument("--family", help="Pid of the family to move (with move).")
+        parser.add_argument("--to", dest="target", help="Shard alias to move it to (with move).")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.1,
+            help="With auto, stop once every shard is within this fraction of the mean (default: 0.1).",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="With auto, only print the planned moves."
+        )
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError("Sharding is off: set DATABASE_SHARDS.")
+        action = options["action"]
+
+        if action == "sync":
+            added = sharding.sync_directory()
+            self.stdout.write(self.style.SUCCESS(f"{added} families added to the directory."))
+            return
+
+        if action == "status":
+            for alias, families in sharding.shard_sizes().items():
+                self.stdout.write(
+                    f"{alias}\t{len(families)} families\t{sum(families.values())} records"
+                )
+            return
+
+        if action == "move":
+            if not options["family"] or not options["target"]:
+                raise CommandError("move needs --family and --to.")
+            if options["target"] not in sharding.shards():
+                raise CommandError(f"Unknown shard {options['target']!r}.")
+            entry = FamilyShard.objects.filter(pid=options["family"]).first()
+            if entry is None:
+                raise CommandError("Family not in the directory; run sync first.")
+            moves = [(entry.id, entry.shard, options["target"])]
+        else:
+            moves = sharding.plan_rebalance(sharding.shard_sizes(), options["tolerance"])
+
+        for family_id, source, target in moves:
+            if options["dry_run"]:
+                self.stdout.write(f"Would move family {family_id}: {source} -> {target}")
+                continue
+            records = sharding.move_family(family_id, target)
+            self.stdout.write(f"Moved family {family_id} ({records} records): {source} -> {target}")
+        if not options["dry_run"]:
+            self.stdout.write(self.style.SUCCESS(f"{len(moves)} families moved."))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from expense import sharding
+from expense.budgets import rebuild_totals
+from expense.forecasting import invalidate as invalidate_forecasts
+from expense.models import Family
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the running budget totals from records, e.g. after bulk "
+        "imports, currency changes or direct database edits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--family",
+            type=int,
+            action="append",
+            help="Only rebuild this family id (may be repeated).",
+        )
+
+    def handle(self, *args, **options):
+        rows = 0
+        for alias in sharding.shards():
+            rows += rebuild_totals(alias, options["family"])
+            families = Family.objects.using(alias)
+            if options["family"]:
+                families = families.filter(id__in=options["family"])
+            invalidate_forecasts(families.values_list("id", flat=True))
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} budget totals."))
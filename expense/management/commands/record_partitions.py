@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from expense import partitioning
+
+
+class Command(BaseCommand):
+    help = (
+        "Maintain record table partitions: convert the table, create "
+        "upcoming partitions, or list the current ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action",
+            choices=["ensure", "convert", "unpartition", "list"],
+            nargs="?",
+            default="ensure",
+        )
+        parser.add_argument(
+            "--interval",
+            choices=["yearly", "monthly"],
+            default=None,
+            help="Partition interval (default: RECORD_PARTITIONING).",
+        )
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            default=2,
+            help="Number of future periods to create partitions for (default: 2).",
+        )
+        parser.add_argument(
+            "--database",
+            default=DEFAULT_DB_ALIAS,
+            help="Database (shard) to work on (default: default).",
+        )
+
+    def handle(self, *args, **options):
+        using = options["database"]
+        connection = connections[using]
+        if connection.vendor != "postgresql":
+            raise CommandError("Record partitioning requires PostgreSQL.")
+
+        action = options["action"]
+        interval = options["interval"] or settings.RECORD_PARTITIONING
+
+        if action == "list":
+            with connection.cursor() as cursor:
+                for name, bound in partitioning.list_partitions(cursor):
+                    self.stdout.write(f"{name}\t{bound}")
+            return
+
+        if action == "unpartition":
+            if partitioning.unpartition_table(using):
+                self.stdout.write(self.style.SUCCESS("Record table is no longer partitioned."))
+            else:
+                self.stdout.write("Record table is not partitioned.")
+            return
+
+        if not interval:
+            raise CommandError("Set RECORD_PARTITIONING or pass --interval.")
+
+        try:
+            if action == "convert":
+                if partitioning.partition_table(interval, using):
+                    self.stdout.write(
+                        self.style.SUCCESS(f"Record table partitioned {interval}.")
+                    )
+                else:
+                    self.stdout.write("Record table is already partitioned.")
+            created = partitioning.ensure_partitions(interval, options["ahead"], using)
+        except partitioning.PartitioningError as e:
+            raise CommandError(str(e))
+
+        for name in created:
+            self.stdout.write(f"Created {name}")
+        self.stdout.write(self.style.SUCCESS(f"{len(created)} partitions created."))
@@ -0,0 +1,142 @@
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from expense.jobs import claim, queue_stats, run
+from expense.models import Job
+
+# How often finished jobs older than JOB_KEEP_DAYS are purged.
+PURGE_INTERVAL = 3600
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs with a thread or process pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.JOB_WORKERS,
+            help="Jobs run concurrently (default: JOB_WORKERS).",
+        )
+        parser.add_argument(
+            "--pool",
+            choices=["thread", "process"],
+            default=settings.JOB_POOL,
+            help="Run jobs in threads or processes (default: JOB_POOL).",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=1.0,
+            help="Seconds to wait between polls when the queue is empty.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once no due jobs are left instead of polling forever.",
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="Print queue-depth metrics and exit.",
+        )
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            for key, value in queue_stats().items():
+                self.stdout.write(f"{key}: {value}")
+            return
+
+        workers = options["workers"]
+        if workers < 1:
+            raise CommandError("--workers must be at least 1.")
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        pool = self._make_pool(options["pool"], workers)
+
+        running = {}  # future -> job
+        done = 0
+        last_purge = 0.0
+        try:
+            while True:
+                if time.monotonic() - last_purge > PURGE_INTERVAL:
+                    self._purge()
+                    last_purge = time.monotonic()
+
+                # Only claim what the pool can start right away, so claimed
+                # jobs never sit locked in a local backlog.
+                free = workers - len(running)
+                jobs = claim(worker_id, free) if free else []
+                for job in jobs:
+                    running[pool.submit(run, job.id)] = job
+
+                if not running:
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll"])
+                    continue
+
+                if len(running) >= workers:
+                    timeout = None  # pool is full, wait for a slot
+                elif jobs:
+                    timeout = 0  # there may be more due jobs, claim again
+                else:
+                    timeout = options["poll"]
+                finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in finished:
+                    job = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # run() records handler errors itself; this is the
+                        # worker failing around it (a crashed process, a lost
+                        # connection). The job is reclaimed after
+                        # JOB_LOCK_TIMEOUT.
+                        logger.exception("Job %s (%s) was interrupted.", job.id, job.name)
+                        self.stderr.write(f"Job {job.id} ({job.name}) was interrupted: {e!r}")
+                        broken = broken or isinstance(e, BrokenProcessPool)
+                    else:
+                        done += 1
+                if broken:
+                    # A dead child breaks the whole process pool; start a new one.
+                    for future in running:
+                        future.cancel()
+                    running.clear()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = self._make_pool(options["pool"], workers)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.shutdown(wait=True)
+        self.stdout.write(f"Ran {done} jobs.")
+
+    def _make_pool(self, kind, workers):
+        if kind == "process":
+            # Spawned rather than forked, so no child inherits the parent's
+            # database connection. The initializer must not live in this
+            # module: unpickling it would import models before setup.
+            return ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup,
+            )
+        return ThreadPoolExecutor(max_workers=workers)
+
+    def _purge(self):
+        cutoff = timezone.now() - timedelta(days=settings.JOB_KEEP_DAYS)
+        Job.objects.filter(
+            status__in=[Job.STATUS_DONE, Job.STATUS_FAILED], finished_at__lt=cutoff
+        ).delete()
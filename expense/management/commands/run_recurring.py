@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from expense.recurring import materialize_due
+
+
+class Command(BaseCommand):
+    help = "Create the records of every due recurring schedule."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Schedules locked and processed per transaction (default: 500).",
+        )
+        parser.add_argument(
+            "--loop",
+            type=int,
+            metavar="SECONDS",
+            default=0,
+            help="Keep running, checking for due schedules every SECONDS.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            schedules, records = materialize_due(batch_size=options["batch_size"])
+            self.stdout.write(
+                f"Processed {schedules} schedules, {records} occurrences."
+            )
+            if not options["loop"]:
+                return
+            time.sleep(options["loop"])
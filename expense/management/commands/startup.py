@@ -0,0 +1,89 @@
+import hashlib
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.staticfiles.finders import get_finders
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.executor import MigrationExecutor
+
+# Arbitrary key for pg_advisory_lock, so containers starting together
+# migrate one at a time instead of queueing on table locks.
+MIGRATION_LOCK_ID = 7211001
+
+STATIC_HASH_FILE = ".static-hash"
+
+
+def pending_migrations(using=DEFAULT_DB_ALIAS):
+    executor = MigrationExecutor(connections[using])
+    targets = executor.loader.graph.leaf_nodes()
+    return executor.migration_plan(targets)
+
+
+def static_sources_hash():
+    """Hash of every file collectstatic would collect, plus the storage setup."""
+    digest = hashlib.sha256(repr(settings.STORAGES.get("staticfiles")).encode())
+    files = []
+    for finder in get_finders():
+        for path, storage in finder.list(["CVS", ".*", "*~"]):
+            files.append((path, storage.path(path)))
+    for path, full_path in sorted(files):
+        digest.update(path.encode())
+        digest.update(Path(full_path).read_bytes())
+    return digest.hexdigest()
+
+
+class Command(BaseCommand):
+    help = (
+        "Prepare a container to serve: apply migrations and collect static "
+        "files, skipping each step when it is already up to date."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force", action="store_true", help="Run both steps unconditionally."
+        )
+        parser.add_argument(
+            "--skip-migrations",
+            action="store_true",
+            help="Only collect static files (e.g. at image build time, without a database).",
+        )
+
+    def handle(self, *args, **options):
+        if not options["skip_migrations"]:
+            self.migrate(options["force"])
+        self.collectstatic(options["force"])
+
+    def migrate(self, force):
+        # Shards have the full schema too (see expense/sharding.py); the
+        # lock taken on the default database covers them.
+        databases = settings.SHARDS
+        if not force and not any(pending_migrations(alias) for alias in databases):
+            self.stdout.write("Migrations: up to date.")
+            return
+        connection = connections[DEFAULT_DB_ALIAS]
+        locked = connection.vendor == "postgresql"
+        if locked:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_lock(%s)", [MIGRATION_LOCK_ID])
+        try:
+            # Another container may have applied them while we waited.
+            pending = [alias for alias in databases if force or pending_migrations(alias)]
+            for alias in pending:
+                call_command("migrate", database=alias, interactive=False, verbosity=1)
+            if not pending:
+                self.stdout.write("Migrations: applied by another process.")
+        finally:
+            if locked:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", [MIGRATION_LOCK_ID])
+
+    def collectstatic(self, force):
+        stamp = Path(settings.STATIC_ROOT) / STATIC_HASH_FILE
+        current = static_sources_hash()
+        if not force and stamp.exists() and stamp.read_text() == current:
+            self.stdout.write("Static files: up to date.")
+            return
+        call_command("collectstatic", interactive=False, verbosity=1)
+        stamp.write_text(current)
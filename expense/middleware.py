@@ -0,0 +1,281 @@
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+from . import sharding
+from .routers import pinned_until, replicas, restore_pin, set_pin
+
+STICKY_COOKIE = "db_primary_until"
+
+
+class ReplicaStickinessMiddleware:
+    """Keep a user reading from the primary for a while after they write.
+
+    The deadline set by the router on a write is stored in a cookie and
+    restored at the start of the user's next requests. Does nothing when no
+    replicas are configured.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = bool(replicas())
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def _start(self, request):
+        try:
+            until = float(request.COOKIES.get(STICKY_COOKIE, 0))
+        except ValueError:
+            until = 0.0
+        return set_pin(until), until
+
+    def _finish(self, response, token, until_before):
+        until = pinned_until()
+        # Threads serve many requests; don't let this pin leak to the next one.
+        restore_pin(token)
+        if until > until_before:
+            response.set_cookie(
+                STICKY_COOKIE,
+                f"{until:.3f}",
+                max_age=settings.DATABASE_STICKY_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        token, until = self._start(request)
+        response = self.get_response(request)
+        return self._finish(response, token, until)
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        token, until = self._start(request)
+        response = await self.get_response(request)
+        return self._finish(response, token, until)
+
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+
+class GzipEncoder:
+    name = "gzip"
+
+    def __init__(self):
+        # wbits=31: zlib stream with a gzip header and trailer.
+        self.compressor = zlib.compressobj(settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def process(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        # Ends the output on a byte boundary without ending the stream.
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    name = "br"
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+
+    def process(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def accepted_encodings(header):
+    """Parse Accept-Encoding into ``{coding: q}``."""
+    accepted = {}
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def negotiate_encoder(header):
+    """Pick the encoder the client prefers, brotli on a tie; None for identity."""
+    encoders = [BrotliEncoder, GzipEncoder] if brotli is not None else [GzipEncoder]
+    accepted = accepted_encodings(header)
+    best, best_q = None, 0.0
+    for encoder in encoders:
+        q = accepted.get(encoder.name, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoder, q
+    return best
+
+
+class CompressionMiddleware:
+    """Compress responses with brotli or gzip, as the client's Accept-Encoding allows.
+
+    Like Django's GZipMiddleware, but negotiates brotli (when the ``brotli``
+    package is installed), only compresses text-like content types and skips
+    bodies under COMPRESSION_MIN_SIZE bytes. Streaming responses, sync or
+    async, are compressed chunk by chunk with one compressor, flushed after
+    each chunk, so the output still arrives incrementally without buffering
+    the whole body. Event streams are left alone: their messages must not
+    wait in a compressor.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def _compressible(self, response):
+        if response.has_header("Content-Encoding") or response.status_code in (204, 304):
+            return False
+        if "no-transform" in response.get("Cache-Control", ""):
+            return False
+        content_type = response.get("Content-Type", "").lower()
+        if content_type.startswith("text/event-stream"):
+            return False
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+        return response.streaming or len(response.content) >= settings.COMPRESSION_MIN_SIZE
+
+    def _compress(self, request, response):
+        if not settings.COMPRESSION_ENABLED or not self._compressible(response):
+            return response
+        patch_vary_headers(response, ("Accept-Encoding",))
+        encoder_class = negotiate_encoder(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        if encoder_class is None:
+            return response
+
+        encoder = encoder_class()
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = self._acompress_stream(
+                    encoder, response.streaming_content
+                )
+            else:
+                response.streaming_content = self._compress_stream(
+                    encoder, response.streaming_content
+                )
+            # The compressed size isn't known until the stream ends.
+            del response.headers["Content-Length"]
+        else:
+            compressed = encoder.process(response.content) + encoder.finish()
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers["Content-Length"] = str(len(compressed))
+
+        # A strong ETag promises identical bytes; see RFC 9110 8.8.1.
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = encoder.name
+        return response
+
+    @staticmethod
+    def _compress_stream(encoder, chunks):
+        # Flush each chunk, so the client can decode it when it arrives.
+        for chunk in chunks:
+            yield encoder.process(chunk) + encoder.flush()
+        yield encoder.finish()
+
+    @staticmethod
+    async def _acompress_stream(encoder, chunks):
+        async for chunk in chunks:
+            yield encoder.process(chunk) + encoder.flush()
+        yield encoder.finish()
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self._compress(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self._compress(request, await self.get_response(request))
+
+
+class ShardMiddleware:
+    """Activate the shard a request's family data lives on.
+
+    That is the shard of the ``family_id`` URL argument if the view has one,
+    else the shard of the user's families (the first, for a user whose
+    families are spread over several). Does nothing unless sharding is on.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = sharding.enabled()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not self.enabled:
+            return None
+        family_id = view_kwargs.get("family_id")
+        if family_id is not None:
+            sharding.activate(sharding.family_shard(family_id))
+        elif request.user.is_authenticated:
+            # A user without families gets new ones placed by hash.
+            aliases = sharding.user_shards(request.user.pk)
+            if aliases:
+                sharding.activate(aliases[0])
+        return None
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # Threads serve many requests; process_view's shard ends with this one.
+        token = sharding.activate(None)
+        try:
+            return self.get_response(request)
+        finally:
+            sharding.deactivate(token)
+
+    async def __acall__(self, request):
+        token = sharding.activate(None)
+        try:
+            return await self.get_response(request)
+        finally:
+            sharding.deactivate(token)
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def partition_records(apps, schema_editor):
+    # Opt-in: only rebuild the table when RECORD_PARTITIONING is configured.
+    interval = getattr(settings, "RECORD_PARTITIONING", "")
+    if schema_editor.connection.vendor != "postgresql" or not interval:
+        return
+    from expense.partitioning import partition_table
+
+    partition_table(interval, using=schema_editor.connection.alias)
+
+
+def unpartition_records(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    from expense.partitioning import unpartition_table
+
+    unpartition_table(using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expense', '0009_qrcode_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['family', 'created_at'], name='expense_rec_family__5f6066_idx'),
+        ),
+        migrations.RunPython(partition_records, unpartition_records),
+    ]
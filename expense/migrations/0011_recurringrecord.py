@@ -0,0 +1,55 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:53
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expense', '0010_record_partitioning'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='record',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.CreateModel(
+            name='RecurringRecord',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('pid', models.CharField(max_length=50, unique=True)),
+                ('name', models.CharField(max_length=100)),
+                ('amount', models.FloatField(default=0)),
+                ('category', models.CharField(blank=True, choices=[('food', 'Food'), ('transport', 'Transport'), ('entertainment', 'Entertainment'), ('shopping', 'Shopping'), ('other', 'Other'), ('rent', 'Rent'), ('utilities', 'Utilities'), ('insurance', 'Insurance'), ('education', 'Education'), ('health', 'Health')], max_length=100)),
+                ('description', models.TextField(blank=True)),
+                ('schedule', models.CharField(max_length=100)),
+                ('starts_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('ends_at', models.DateTimeField(blank=True, null=True)),
+                ('next_run_at', models.DateTimeField(blank=True, null=True)),
+                ('last_run_at', models.DateTimeField(blank=True, null=True)),
+                ('active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('family', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recurring_records', to='expense.family')),
+                ('who', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='recurring_records', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='record',
+            name='recurring',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='records', to='expense.recurringrecord'),
+        ),
+        migrations.AddConstraint(
+            model_name='record',
+            constraint=models.UniqueConstraint(fields=('recurring', 'created_at'), name='expense_record_unique_occurrence'),
+        ),
+        migrations.AddIndex(
+            model_name='recurringrecord',
+            index=models.Index(fields=['active', 'next_run_at'], name='expense_rec_active_0fa1dd_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expense', '0011_recurringrecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('currency', models.CharField(max_length=10, unique=True)),
+                ('rate', models.FloatField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='record',
+            name='currency',
+            field=models.CharField(blank=True, default='', max_length=10),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.7 on 2026-10-19 03:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_totals(apps, schema_editor):
+    # Existing records count towards budgets from the start.
+    from expense.budgets import rebuild_totals
+
+    rebuild_totals(schema_editor.connection.alias, apps=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expense', '0012_record_currency_exchangerate'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Budget',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('category', models.CharField(blank=True, choices=[('food', 'Food'), ('transport', 'Transport'), ('entertainment', 'Entertainment'), ('shopping', 'Shopping'), ('other', 'Other'), ('rent', 'Rent'), ('utilities', 'Utilities'), ('insurance', 'Insurance'), ('education', 'Education'), ('health', 'Health')], max_length=100)),
+                ('amount', models.FloatField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('family', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='budgets', to='expense.family')),
+                ('member', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='budgets', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BudgetAlert',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('period', models.DateField()),
+                ('threshold', models.FloatField()),
+                ('total', models.FloatField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('budget', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alerts', to='expense.budget')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('budget', 'period', 'threshold'), name='expense_budgetalert_unique_threshold')],
+            },
+        ),
+        migrations.CreateModel(
+            name='BudgetTotal',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('period', models.DateField()),
+                ('category', models.CharField(blank=True, max_length=100)),
+                ('member_id', models.IntegerField(default=0)),
+                ('total', models.FloatField(default=0)),
+                ('family', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='budget_totals', to='expense.family')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('family', 'period', 'category', 'member_id'), name='expense_budgettotal_unique_key')],
+            },
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 04:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expense', '0014_job'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='family',
+            index=models.Index(fields=['name'], name='expense_family_name_prefix', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['name'], name='expense_record_name_prefix', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.7 on 2026-10-19 04:33
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expense', '0015_name_prefix_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FamilyShard',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('pid', models.CharField(max_length=50, unique=True)),
+                ('shard', models.CharField(max_length=100)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ShardMembership',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('family', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='expense.familyshard')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shard_memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'family'), name='expense_shard_membership_unique')],
+            },
+        ),
+    ]
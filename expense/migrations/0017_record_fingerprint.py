@@ -0,0 +1,24 @@
+# Generated by Django 5.2.7 on 2026-10-19 04:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expense', '0016_shard_directory'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', editable=False, max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['fingerprint'], name='expense_record_fingerprint'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.7 on 2026-10-19 04:54
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expense', '0018_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Statement',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('period', models.DateField()),
+                ('file', models.FileField(upload_to='statements/')),
+                ('currency', models.CharField(max_length=10)),
+                ('total', models.FloatField(default=0)),
+                ('record_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('family', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statements', to='expense.family')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('family', 'period'), name='expense_statement_unique_period')],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-19 05:00
+
+from django.db import migrations, models
+
+
+def count_members(apps, schema_editor):
+    Family = apps.get_model("expense", "Family")
+    through = Family.members.through
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {Family._meta.db_table} f SET member_count = "
+            f"(SELECT count(*) FROM {through._meta.db_table} m WHERE m.family_id = f.id)"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expense', '0019_statement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='family',
+            name='member_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_members, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='family',
+            constraint=models.CheckConstraint(condition=models.Q(('member_count__gte', 0)), name='expense_family_member_count_non_negative'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-19 05:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expense', '0020_family_member_count'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['family', 'updated_at'], name='expense_record_family_updated'),
+        ),
+    ]
@@ -1,7 +1,9 @@
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
 from email.policy import default
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models.signals import m2m_changed
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 CATEGORIES = {
     "food": "Food",
@@ -47,6 +49,25 @@ class Family(models.Model):
     max_budget = models.FloatField(default=0)
     currency = models.CharField(max_length=10, default='HKD')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Rows in members; kept by add_members / remove_members, which change
+    # both in one statement.
+    member_count = models.IntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            # Serves the admin's name__startswith search
+            models.Index(
+                fields=["name"],
+                name="expense_family_name_prefix",
+                opclasses=["varchar_pattern_ops"],
+            ),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(member_count__gte=0),
+                name="expense_family_member_count_non_negative",
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -58,30 +79,159 @@ class Family(models.Model):
     def save(self, *args, **kwargs):
         if not self.pid:
             self.generate_pid()
+        if self._state.adding and self.id is None:
+            from .sharding import register_family
+
+            # Takes a globally unique id from the shard directory
+            register_family(self)
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # member_count only changes together with the members, so a
+            # stale copy must not overwrite it.
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "member_count"
+            ]
         super().save(*args, **kwargs)
         
     def max_members(self):
         return 2 if self.level == 1 else 4
 
     def can_add_member(self):
-        return self.members.count() < self.max_members()
+        return self.member_count < self.max_members()
+
+    def _change_members(self, sql, action, users, capacity=False):
+        users = {user.pk: user for user in users}
+        if not users:
+            return []
+        through = Family.members.through
+        using = router.db_for_write(Family, instance=self)
+        signal = dict(
+            sender=through, instance=self, reverse=False, model=User, using=using, counted=True
+        )
+        with transaction.atomic(using=using):
+            params = [self.pk, list(users), self.pk]
+            if capacity:
+                # Locks the family row, so its level (and max_members()) holds
+                # until the statement below has run.
+                self.level = (
+                    Family.objects.using(using)
+                    .select_for_update()
+                    .values_list("level", flat=True)
+                    .get(pk=self.pk)
+                )
+                params.append(self.max_members())
+            m2m_changed.send(action=f"pre_{action}", pk_set=set(users), **signal)
+            with connections[using].cursor() as cursor:
+                cursor.execute(
+                    sql.format(through=through._meta.db_table, family=Family._meta.db_table),
+                    params,
+                )
+                row = cursor.fetchone()
+            if row is None:
+                # Over capacity: undo the inserted rows.
+                transaction.set_rollback(True, using=using)
+                return None
+            self.member_count, changed = row[0], row[1]
+            if changed:
+                m2m_changed.send(action=f"post_{action}", pk_set=set(changed), **signal)
+        return [users[user_id] for user_id in changed]
+
+    def add_members(self, users):
+        """Add those of ``users`` that aren't members yet, all or none.
+
+        Returns the users added, or None if they don't all fit. The rows are
+        inserted and member_count raised in one statement, which checks
+        max_members() against the locked family row, so concurrent invites
+        can't take a family over it.
+        """
+        return self._change_members(
+            "WITH added AS ("
+            " INSERT INTO {through} (family_id, user_id)"
+            " SELECT %s, user_id FROM unnest(%s::integer[]) AS user_id"
+            " ON CONFLICT (family_id, user_id) DO NOTHING RETURNING user_id"
+            ") "
+            "UPDATE {family} SET member_count = member_count + (SELECT count(*) FROM added) "
+            "WHERE id = %s AND member_count + (SELECT count(*) FROM added) "
+            "<= %s "
+            "RETURNING member_count, ARRAY(SELECT user_id FROM added)",
+            "add",
+            users,
+            capacity=True,
+        )
+
+    def remove_members(self, users):
+        """Remove those of ``users`` that are members; returns the users removed."""
+        return self._change_members(
+            "WITH removed AS ("
+            " DELETE FROM {through} WHERE family_id = %s AND user_id = ANY(%s::integer[])"
+            " RETURNING user_id"
+            ") "
+            "UPDATE {family} SET member_count = member_count - (SELECT count(*) FROM removed) "
+            "WHERE id = %s "
+            "RETURNING member_count, ARRAY(SELECT user_id FROM removed)",
+            "remove",
+            users,
+        ) or []
 
     def add_member(self, user: User):
         # Returns (ok: bool, error: str|None)
-        if self.members.filter(id=user.id).exists():
-            return False, "User is already a member."
-        if not self.can_add_member():
+        added = self.add_members([user])
+        if added is None:
             return False, f"Cannot add more members. Level {self.level} allows only {self.max_members()} members."
-        self.members.add(user)
+        if not added:
+            return False, "User is already a member."
         return True, None
 
     def remove_member(self, user: User):
         # Returns (ok: bool, error: str|None)
-        if not self.members.filter(id=user.id).exists():
+        if not self.remove_members([user]):
             return False, "User is not a member."
-        self.members.remove(user)
         return True, None
 
+
+class RecurringRecord(models.Model):
+    id = models.AutoField(primary_key=True)
+    pid = models.CharField(max_length=50, unique=True)
+    family = models.ForeignKey(Family, on_delete=models.CASCADE, related_name="recurring_records")
+    who = models.ForeignKey(User, on_delete=models.SET_NULL, related_name="recurring_records", null=True, blank=True)
+    name = models.CharField(max_length=100)
+    amount = models.FloatField(default=0)
+    category = models.CharField(max_length=100, choices=CATEGORIES.items(), blank=True)
+    description = models.TextField(blank=True)
+    # Cron expression, e.g. "0 9 1 * *" for 09:00 on the 1st of every month
+    schedule = models.CharField(max_length=100)
+    starts_at = models.DateTimeField(default=timezone.now)
+    ends_at = models.DateTimeField(null=True, blank=True)
+    next_run_at = models.DateTimeField(null=True, blank=True)
+    last_run_at = models.DateTimeField(null=True, blank=True)
+    active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["active", "next_run_at"]),
+        ]
+
+    def __str__(self):
+        return self.name
+
+    def generate_pid(self):
+        import uuid
+        self.pid = str(uuid.uuid4())
+
+    def get_schedule(self):
+        from .schedules import CronSchedule
+        return CronSchedule(self.schedule)
+
+    def save(self, *args, **kwargs):
+        if not self.pid:
+            self.generate_pid()
+        if self.next_run_at is None:
+            self.next_run_at = self.get_schedule().first_at_or_after(self.starts_at)
+        super().save(*args, **kwargs)
+
+
 class Record(models.Model):
     id = models.AutoField(primary_key=True)
     pid = models.CharField(max_length=50, unique=True)
@@ -89,14 +239,48 @@ class Record(models.Model):
     who = models.ForeignKey(User, on_delete=models.CASCADE, related_name='records', null=True, blank=True)
     name = models.CharField(max_length=100, blank=True)
     amount = models.FloatField(default=0)
+    # Currency the amount was spent in; blank means the family currency
+    currency = models.CharField(max_length=10, blank=True, default="")
     category = models.CharField(max_length=100, choices=CATEGORIES.items(), blank=True)
     description = models.TextField(blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, so a client-supplied or scheduled time is kept.
+    created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
+    recurring = models.ForeignKey(RecurringRecord, on_delete=models.SET_NULL, related_name="records", null=True, blank=True)
+    # Hash of family, name, amount, currency and time window, for duplicate
+    # checks (see expense/duplicates.py); set on save.
+    fingerprint = models.CharField(max_length=32, blank=True, default="", editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["family", "created_at"]),
+            models.Index(fields=["family", "updated_at"], name="expense_record_family_updated"),
+            models.Index(fields=["fingerprint"], name="expense_record_fingerprint"),
+            # Serves the admin's name__startswith search
+            models.Index(
+                fields=["name"],
+                name="expense_record_name_prefix",
+                opclasses=["varchar_pattern_ops"],
+            ),
+        ]
+        constraints = [
+            # One record per recurring occurrence; includes created_at so it
+            # is also valid on a partitioned record table.
+            models.UniqueConstraint(
+                fields=["recurring", "created_at"], name="expense_record_unique_occurrence"
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Values as loaded, so budget totals can apply the difference on save
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     def generate_pid(self):
         import uuid
         self.pid = str(uuid.uuid4())
@@ -104,9 +288,159 @@ class Record(models.Model):
     def save(self, *args, **kwargs):
         if not self.pid:
             self.generate_pid()
+        from .duplicates import fingerprint
+
+        self.fingerprint = fingerprint(self)
         super().save(*args, **kwargs)
 
 
+class Budget(models.Model):
+    id = models.AutoField(primary_key=True)
+    family = models.ForeignKey(Family, on_delete=models.CASCADE, related_name="budgets")
+    # Blank category / null member means the budget covers all of them
+    category = models.CharField(max_length=100, choices=CATEGORIES.items(), blank=True)
+    member = models.ForeignKey(User, on_delete=models.CASCADE, related_name="budgets", null=True, blank=True)
+    # Monthly limit in the family currency
+    amount = models.FloatField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.family.name} {self.category or 'all'} {self.amount}"
+
+    @property
+    def member_key(self):
+        return self.member_id or 0
+
+
+class BudgetTotal(models.Model):
+    # Running monthly spend, in the family currency, per (category, member).
+    # "" / 0 hold the totals across all categories / members.
+    id = models.BigAutoField(primary_key=True)
+    family = models.ForeignKey(Family, on_delete=models.CASCADE, related_name="budget_totals")
+    period = models.DateField()
+    category = models.CharField(max_length=100, blank=True)
+    member_id = models.IntegerField(default=0)
+    total = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["family", "period", "category", "member_id"],
+                name="expense_budgettotal_unique_key",
+            ),
+        ]
+
+
+class BudgetAlert(models.Model):
+    id = models.AutoField(primary_key=True)
+    budget = models.ForeignKey(Budget, on_delete=models.CASCADE, related_name="alerts")
+    period = models.DateField()
+    threshold = models.FloatField()
+    total = models.FloatField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["budget", "period", "threshold"],
+                name="expense_budgetalert_unique_threshold",
+            ),
+        ]
+
+
+class Statement(models.Model):
+    # Monthly statement rendered by ``manage.py generate_statements`` (see
+    # expense/statements.py); the HTML is kept in storage.
+    id = models.AutoField(primary_key=True)
+    family = models.ForeignKey(Family, on_delete=models.CASCADE, related_name="statements")
+    period = models.DateField()
+    file = models.FileField(upload_to="statements/")
+    # Headline figures, so listing statements never opens the files
+    currency = models.CharField(max_length=10)
+    total = models.FloatField(default=0)
+    record_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["family", "period"], name="expense_statement_unique_period"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.family.name} {self.period:%Y-%m}"
+
+
+class ExchangeRate(models.Model):
+    # Units of `currency` per one unit of settings.EXCHANGE_RATE_BASE
+    id = models.AutoField(primary_key=True)
+    currency = models.CharField(max_length=10, unique=True)
+    rate = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.currency} {self.rate}"
+
+
+class Job(models.Model):
+    # Background work run by the `run_jobs` worker (see expense/jobs.py)
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUSES = {
+        STATUS_QUEUED: "Queued",
+        STATUS_RUNNING: "Running",
+        STATUS_DONE: "Done",
+        STATUS_FAILED: "Failed",
+    }
+
+    id = models.BigAutoField(primary_key=True)
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES.items(), default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "run_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status})"
+
+
+class IdempotencyKey(models.Model):
+    # Stored response of a request sent with an Idempotency-Key header
+    # (see expense/idempotency.py); kept in the default database.
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    # Null until the first request's response is stored
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    body = models.BinaryField(blank=True, default=b"")
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "key"], name="expense_idempotency_key_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["expires_at"]),
+        ]
+
+
 class QRCode(models.Model):
     id = models.AutoField(primary_key=True)
     family = models.ForeignKey(Family, on_delete=models.CASCADE, related_name="qrcodes")
@@ -116,3 +450,28 @@ class QRCode(models.Model):
 
     def __str__(self):
         return self.name or f"QR for {self.family.name} ({self.id})"
+
+
+class FamilyShard(models.Model):
+    # Shard directory, kept in the default database only (see
+    # expense/sharding.py). Its id is the family's id on its shard, so
+    # family ids stay unique across shards.
+    id = models.AutoField(primary_key=True)
+    pid = models.CharField(max_length=50, unique=True)
+    shard = models.CharField(max_length=100)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.pid} @ {self.shard}"
+
+
+class ShardMembership(models.Model):
+    # Which families (and so which shards) a user belongs to
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="shard_memberships")
+    family = models.ForeignKey(FamilyShard, on_delete=models.CASCADE, related_name="memberships")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "family"], name="expense_shard_membership_unique"),
+        ]
@@ -0,0 +1,293 @@
+"""Optional range partitioning of ``expense_record`` by ``created_at``.
+
+Postgres only. With ``RECORD_PARTITIONING`` set to "yearly" or "monthly"
+the record table is rebuilt as a partitioned table with one partition per
+period plus a default partition, so queries on the current month or year
+only touch (and only keep hot the indexes of) a single partition.
+
+Partitioned tables require unique constraints to include the partition
+key, so the primary key becomes ``(id, created_at)`` and ``pid`` is only
+unique together with ``created_at`` in the database. Both are still
+generated uniquely by the application.
+
+Every function works on one database, ``using`` (``default`` unless
+given): migrations pass their own, so each shard is converted when it is
+migrated.
+"""
+
+import gzip
+import re
+from datetime import datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+TABLE = "expense_record"
+DEFAULT_PARTITION = f"{TABLE}_default"
+ID_SEQUENCE = f"{TABLE}_pk_seq"
+
+_PARTITION_NAME = re.compile(rf"^{TABLE}_(?:y(?P<year>\d{{4}})|m(?P<ym>\d{{6}}))$")
+
+
+class PartitioningError(Exception):
+    pass
+
+
+def _q(cursor, name):
+    return cursor.db.ops.quote_name(name)
+
+
+def local_timezone():
+    return ZoneInfo(settings.TIME_ZONE)
+
+
+def period_bounds(moment: datetime, interval: str):
+    """Return ``(start, end)`` of the yearly/monthly period containing ``moment``."""
+    moment = moment.astimezone(local_timezone())
+    if interval == "yearly":
+        start = datetime(moment.year, 1, 1, tzinfo=local_timezone())
+        end = datetime(moment.year + 1, 1, 1, tzinfo=local_timezone())
+    elif interval == "monthly":
+        start = datetime(moment.year, moment.month, 1, tzinfo=local_timezone())
+        year, month = divmod(moment.month, 12)
+        end = datetime(moment.year + year, month + 1, 1, tzinfo=local_timezone())
+    else:
+        raise PartitioningError(f"Unknown partition interval {interval!r}.")
+    return start, end
+
+
+def partition_name(start: datetime, interval: str):
+    if interval == "yearly":
+        return f"{TABLE}_y{start:%Y}"
+    return f"{TABLE}_m{start:%Y%m}"
+
+
+def bounds_from_name(name: str):
+    match = _PARTITION_NAME.match(name)
+    if not match:
+        raise PartitioningError(f"{name!r} is not a record partition name.")
+    if match["year"]:
+        start = datetime(int(match["year"]), 1, 1, tzinfo=local_timezone())
+        return period_bounds(start, "yearly")
+    start = datetime(int(match["ym"][:4]), int(match["ym"][4:]), 1, tzinfo=local_timezone())
+    return period_bounds(start, "monthly")
+
+
+def is_partitioned(cursor):
+    # to_regclass resolves the name through search_path, like the queries do.
+    cursor.execute(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+        [_q(cursor, TABLE)],
+    )
+    return cursor.fetchone() is not None
+
+
+def list_partitions(cursor):
+    """Return ``[(name, bound_expression)]`` for the attached partitions."""
+    cursor.execute(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname",
+        [_q(cursor, TABLE)],
+    )
+    return cursor.fetchall()
+
+
+def _move_indexes_and_constraints(cursor, source, target):
+    """Recreate ``source``'s indexes, unique constraints and foreign keys on ``target``.
+
+    The primary key and the pid constraint are handled by the caller.
+
+    Names are kept so that later Django migrations can still find them.
+    """
+    cursor.execute(
+        "SELECT i.relname, pg_get_indexdef(ix.indexrelid) "
+        "FROM pg_index ix JOIN pg_class i ON i.oid = ix.indexrelid "
+        "WHERE ix.indrelid = to_regclass(%s) AND NOT ix.indisunique",
+        [_q(cursor, source)],
+    )
+    indexes = cursor.fetchall()
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(%s) AND contype IN ('u', 'f') AND conname <> %s",
+        [_q(cursor, source), f"{source}_pid_key"],
+    )
+    constraints = cursor.fetchall()
+
+    # The definition names the table schema-qualified (in whatever schema it
+    # lives), quoted if needed, and as "ON ONLY <table>" for a partitioned one.
+    table = re.compile(
+        rf' ON (?:ONLY )?(?:(?:"[^"]+"|\w+)\.)?(?:{re.escape(_q(cursor, source))}|{source}) '
+    )
+    for name, definition in indexes:
+        cursor.execute(f"DROP INDEX {_q(cursor, name)}")
+        cursor.execute(table.sub(f" ON {_q(cursor, target)} ", definition, count=1))
+    for name, definition in constraints:
+        cursor.execute(f"ALTER TABLE {_q(cursor, source)} DROP CONSTRAINT {_q(cursor, name)}")
+        cursor.execute(
+            f"ALTER TABLE {_q(cursor, target)} ADD CONSTRAINT {_q(cursor, name)} {definition}"
+        )
+
+
+def _rebuild_table(cursor, partition_by):
+    old = f"{TABLE}_old"
+    table, old_table, sequence = _q(cursor, TABLE), _q(cursor, old), _q(cursor, ID_SEQUENCE)
+    pkey, pid_key = _q(cursor, f"{TABLE}_pkey"), _q(cursor, f"{TABLE}_pid_key")
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {old_table}")
+    cursor.execute(
+        f"ALTER TABLE {old_table} RENAME CONSTRAINT {pkey} TO {_q(cursor, f'{old}_pkey')}"
+    )
+    cursor.execute(
+        f"ALTER TABLE {old_table} RENAME CONSTRAINT {pid_key} TO {_q(cursor, f'{old}_pid_key')}"
+    )
+    cursor.execute(
+        f"CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS)"
+        + (" PARTITION BY RANGE (created_at)" if partition_by else "")
+    )
+    # Identity columns are not supported on partitioned tables before
+    # Postgres 17; a plain sequence works everywhere.
+    cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {sequence}")
+    cursor.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval(%s)", [sequence])
+    cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+    if partition_by:
+        primary_key, pid_columns = "id, created_at", "pid, created_at"
+    else:
+        primary_key, pid_columns = "id", "pid"
+    cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {pkey} PRIMARY KEY ({primary_key})")
+    cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {pid_key} UNIQUE ({pid_columns})")
+    _move_indexes_and_constraints(cursor, old, TABLE)
+    return old
+
+
+def partition_table(interval: str, using=DEFAULT_DB_ALIAS):
+    """Convert ``expense_record`` into a table partitioned by ``interval``."""
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        if is_partitioned(cursor):
+            return False
+        table = _q(cursor, TABLE)
+        cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+        old = _q(cursor, _rebuild_table(cursor, partition_by=True))
+        cursor.execute(
+            f"CREATE TABLE {_q(cursor, DEFAULT_PARTITION)} PARTITION OF {table} DEFAULT"
+        )
+
+        cursor.execute(f"SELECT min(created_at), max(created_at) FROM {old}")
+        first, last = cursor.fetchone()
+        now = datetime.now(local_timezone())
+        start, _ = period_bounds(min(first or now, now), interval)
+        _, stop = period_bounds(max(last or now, now), interval)
+        while start < stop:
+            _, end = period_bounds(start, interval)
+            create_partition(cursor, partition_name(start, interval), start, end)
+            start = end
+
+        cursor.execute(f"INSERT INTO {table} SELECT * FROM {old}")
+        cursor.execute(f"DROP TABLE {old}")
+        cursor.execute(
+            f"SELECT setval(%s, COALESCE((SELECT max(id) FROM {table}), 0) + 1, false)",
+            [_q(cursor, ID_SEQUENCE)],
+        )
+    return True
+
+
+def unpartition_table(using=DEFAULT_DB_ALIAS):
+    """Rebuild ``expense_record`` as a plain table (reverse of ``partition_table``)."""
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        if not is_partitioned(cursor):
+            return False
+        table = _q(cursor, TABLE)
+        cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+        # The sequence is owned by the old table's column; detach it first
+        # so it survives the drop.
+        cursor.execute(f"ALTER SEQUENCE {_q(cursor, ID_SEQUENCE)} OWNED BY NONE")
+        old = _q(cursor, _rebuild_table(cursor, partition_by=False))
+        cursor.execute(f"INSERT INTO {table} SELECT * FROM {old}")
+        cursor.execute(f"DROP TABLE {old} CASCADE")
+    return True
+
+
+def create_partition(cursor, name, start, end):
+    """Create and attach partition ``name`` for ``[start, end)``.
+
+    Rows for the range that already landed in the default partition are
+    moved into the new partition before it is attached.
+    """
+    table, partition = _q(cursor, TABLE), _q(cursor, name)
+    default = _q(cursor, DEFAULT_PARTITION)
+    cursor.execute(f"CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS)")
+    cursor.execute(
+        f"INSERT INTO {partition} SELECT * FROM {default} "
+        "WHERE created_at >= %s AND created_at < %s",
+        [start, end],
+    )
+    cursor.execute(
+        f"DELETE FROM {default} WHERE created_at >= %s AND created_at < %s",
+        [start, end],
+    )
+    cursor.execute(
+        f"ALTER TABLE {table} ATTACH PARTITION {partition} FOR VALUES FROM (%s) TO (%s)",
+        [start, end],
+    )
+
+
+def ensure_partitions(interval: str, ahead: int = 2, using=DEFAULT_DB_ALIAS):
+    """Create missing partitions from the current period up to ``ahead`` periods ahead."""
+    created = []
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        if not is_partitioned(cursor):
+            raise PartitioningError(f"{TABLE} is not partitioned.")
+        existing = {name for name, _ in list_partitions(cursor)}
+        start, end = period_bounds(datetime.now(local_timezone()), interval)
+        for _ in range(ahead + 1):
+            name = partition_name(start, interval)
+            if name not in existing:
+                create_partition(cursor, name, start, end)
+                created.append(name)
+            start, end = period_bounds(end, interval)
+    return created
+
+
+def _archive_path(name, using=DEFAULT_DB_ALIAS):
+    # Shards have partitions of the same names; keep their archives apart.
+    directory = Path(settings.RECORD_ARCHIVE_DIR)
+    if using != DEFAULT_DB_ALIAS:
+        directory /= using
+    return directory / f"{name}.csv.gz"
+
+
+def archive_partition(name, using=DEFAULT_DB_ALIAS):
+    """Copy partition ``name`` to a gzip'd CSV file, then detach and drop it."""
+    bounds_from_name(name)
+    path = _archive_path(name, using)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        partition = _q(cursor, name)
+        cursor.execute(f"LOCK TABLE {partition} IN ACCESS EXCLUSIVE MODE")
+        tmp = path.with_suffix(".tmp")
+        with gzip.open(tmp, "wb") as fh:
+            cursor.copy_expert(f"COPY {partition} TO STDOUT WITH (FORMAT csv, HEADER)", fh)
+        tmp.replace(path)
+        cursor.execute(f"ALTER TABLE {_q(cursor, TABLE)} DETACH PARTITION {partition}")
+        cursor.execute(f"DROP TABLE {partition}")
+    return path
+
+
+def restore_partition(name, using=DEFAULT_DB_ALIAS):
+    """Recreate partition ``name`` from its archive file."""
+    start, end = bounds_from_name(name)
+    path = _archive_path(name, using)
+    if not path.exists():
+        raise PartitioningError(f"No archive found at {path}.")
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        create_partition(cursor, name, start, end)
+        with gzip.open(path, "rt", newline="") as fh:
+            # Name the columns from the header so archives taken before a
+            # column was added still load.
+            columns = ", ".join(_q(cursor, c) for c in fh.readline().strip().split(","))
+            cursor.copy_expert(
+                f"COPY {_q(cursor, name)} ({columns}) FROM STDIN WITH (FORMAT csv)", fh
+            )
+    return path
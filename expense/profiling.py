@@ -0,0 +1,160 @@
+"""On-demand request profiling for staff.
+
+A staff user adds ``?_profile=1`` or the ``X-Profile: 1`` header to any
+request. ProfilingMiddleware then runs the rest of the request under
+cProfile and times every SQL query on every database connection. The
+report is stored under PROFILE_DIR with a random ID, and the response
+carries that ID in ``X-Profile-Id``. Reports are read back from
+``profiles/<id>/``: a JSON summary, or the raw pstats file with
+``?format=pstats``, which snakeviz or ``python -m pstats`` can open.
+
+Requests without the trigger only pay for a header lookup and a substring
+check of the query string. Under ASGI a profiled request is handed to a
+worker thread that the sync view then runs in too, so the view is what
+gets profiled; async views (the event stream) and streamed response
+bodies are not included.
+"""
+
+import cProfile
+import io
+import json
+import pstats
+import time
+import uuid
+from contextlib import ExitStack
+from pathlib import Path
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+QUERY_PARAM = "_profile"
+HEADER = "HTTP_X_PROFILE"
+TOP_FUNCTIONS = 40
+
+_ID_LENGTH = 32
+
+
+def _report_dir():
+    path = Path(settings.PROFILE_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def report_paths(report_id):
+    """Return ``(summary, pstats)`` paths, or None for an invalid ID."""
+    if len(report_id) != _ID_LENGTH or not all(c in "0123456789abcdef" for c in report_id):
+        return None
+    directory = Path(settings.PROFILE_DIR)
+    return directory / f"{report_id}.json", directory / f"{report_id}.pstats"
+
+
+class QueryTimer:
+    """``execute_wrapper`` recording the SQL and duration of each query."""
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(
+                {
+                    "database": self.alias,
+                    "sql": sql,
+                    "many": many,
+                    "ms": (time.perf_counter() - start) * 1000,
+                }
+            )
+
+
+def _prune():
+    reports = sorted(Path(settings.PROFILE_DIR).glob("*.json"), key=lambda p: p.stat().st_mtime)
+    for summary in reports[: max(len(reports) - settings.PROFILE_MAX_REPORTS, 0)]:
+        summary.unlink(missing_ok=True)
+        summary.with_suffix(".pstats").unlink(missing_ok=True)
+
+
+def _save(request, response, profiler, timers, elapsed):
+    report_id = uuid.uuid4().hex
+    directory = _report_dir()
+    profiler.dump_stats(directory / f"{report_id}.pstats")
+
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    queries = [query for timer in timers for query in timer.queries]
+    summary = {
+        "id": report_id,
+        "method": request.method,
+        "path": request.get_full_path(),
+        "status": response.status_code,
+        "user_id": request.user.pk,
+        "created_at": time.time(),
+        "total_ms": elapsed * 1000,
+        "sql_ms": sum(query["ms"] for query in queries),
+        "query_count": len(queries),
+        "queries": queries,
+        "functions": [
+            {
+                "function": f"{filename}:{line}({name})",
+                "calls": calls,
+                "total_ms": total * 1000,
+                "cumulative_ms": cumulative * 1000,
+            }
+            for (filename, line, name), (_, calls, total, cumulative, _) in functions[
+                :TOP_FUNCTIONS
+            ]
+        ],
+    }
+    (directory / f"{report_id}.json").write_text(json.dumps(summary))
+    _prune()
+    return report_id
+
+
+class ProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def _triggered(request):
+        return HEADER in request.META or (
+            QUERY_PARAM in request.META.get("QUERY_STRING", "")
+            and QUERY_PARAM in request.GET
+        )
+
+    def _profile(self, request, get_response):
+        timers = [QueryTimer(alias) for alias in connections]
+        profiler = cProfile.Profile()
+        with ExitStack() as stack:
+            for timer in timers:
+                stack.enter_context(connections[timer.alias].execute_wrapper(timer))
+            start = time.perf_counter()
+            response = profiler.runcall(get_response, request)
+            elapsed = time.perf_counter() - start
+
+        response["X-Profile-Id"] = _save(request, response, profiler, timers, elapsed)
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if self._triggered(request) and request.user.is_staff:
+            return self._profile(request, self.get_response)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if self._triggered(request) and (await request.auser()).is_staff:
+            # Thread-sensitive sync code called from inside this thread (the
+            # view) runs in this same thread, under the profiler.
+            return await sync_to_async(self._profile, thread_sensitive=True)(
+                request, async_to_sync(self.get_response)
+            )
+        return await self.get_response(request)
@@ -0,0 +1,213 @@
+"""Token-bucket rate limiting and concurrency-based load shedding.
+
+Views opt in with ``@rate_limit("<group>")``; groups are configured in
+settings.RATE_LIMITS::
+
+    "auth": {
+        "rate": "10/m",              # bucket size / refill period
+        "keys": ["ip", "username"],  # one bucket per key kind
+        "methods": ["POST"],         # only these methods are limited
+        "concurrency": 4,            # in-flight requests per process
+    }
+
+Each key kind gets its own bucket (per IP, per signed-in user, per
+submitted username), and a request needs a token from all of them. Empty
+buckets answer 429 with ``Retry-After`` set to when the next token is due.
+More than ``concurrency`` requests of the group in flight in this process
+answer 503 with ``Retry-After: 1``. Both checks happen before the view
+runs, so a rejected login never reaches the password hasher.
+
+Buckets live in process memory (RATE_LIMIT_STORE="memory") or in the
+Django cache ("cache"), which shares them between processes when the cache
+backend is shared. The cache store reads and writes without a lock, so
+concurrent requests can race for the same token; a bucket can then let
+through a few extra requests, never fewer.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# Memory store entries beyond which full (idle) buckets are dropped.
+MEMORY_STORE_MAX_KEYS = 100000
+
+
+def parse_rate(rate):
+    """``"10/m"`` -> ``(capacity, tokens per second)``."""
+    count, _, period = rate.partition("/")
+    count = int(count)
+    seconds = PERIODS.get(period) or int(period)
+    return count, count / seconds
+
+
+def _refill(state, capacity, per_second, now):
+    if state is None:
+        return float(capacity)
+    tokens, updated = state
+    return min(capacity, tokens + (now - updated) * per_second)
+
+
+class MemoryStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Least recently updated first, so pruning only looks at the front.
+        self.buckets = OrderedDict()
+
+    def take(self, key, capacity, per_second, now):
+        """Take a token; return 0 if allowed, else seconds until one is due."""
+        with self.lock:
+            tokens = _refill(self.buckets.pop(key, None), capacity, per_second, now)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self.buckets) > MEMORY_STORE_MAX_KEYS:
+                self._prune(now)
+            return 0 if allowed else (1 - tokens) / per_second
+
+    def _prune(self, now):
+        # Drop buckets idle long enough to be full again; they'd start full.
+        while self.buckets:
+            key, (tokens, updated) = next(iter(self.buckets.items()))
+            if now - updated <= 3600:
+                break
+            del self.buckets[key]
+
+
+class CacheStore:
+    def take(self, key, capacity, per_second, now):
+        cache_key = f"ratelimit:{key}"
+        tokens = _refill(cache.get(cache_key), capacity, per_second, now)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # Expire once the bucket would be full again anyway.
+        timeout = math.ceil((capacity - tokens) / per_second) + 1
+        cache.set(cache_key, (tokens, now), timeout)
+        return 0 if allowed else (1 - tokens) / per_second
+
+
+_store = None
+_store_lock = threading.Lock()
+_semaphores = {}
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = CacheStore() if settings.RATE_LIMIT_STORE == "cache" else MemoryStore()
+    return _store
+
+
+def _semaphore(group, limit):
+    with _store_lock:
+        if group not in _semaphores:
+            _semaphores[group] = threading.BoundedSemaphore(limit)
+        return _semaphores[group]
+
+
+def client_ip(request):
+    if settings.RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.META.get("HTTP_X_FORWARDED_FOR", "")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def _key_value(kind, request, user):
+    if kind == "ip":
+        return client_ip(request)
+    if kind == "user":
+        return str(user.pk) if user is not None and user.is_authenticated else None
+    if kind == "username":
+        return (request.POST.get("username") or "").strip().lower() or None
+    raise ValueError(f"Unknown rate limit key {kind!r}.")
+
+
+def _rejected(request, status, retry_after, detail):
+    retry_after = max(1, math.ceil(retry_after))
+    # Pages (the login form) get text, API calls from fetch() get JSON.
+    if "text/html" in request.headers.get("Accept", ""):
+        response = HttpResponse(detail, status=status, content_type="text/plain")
+    else:
+        response = JsonResponse({"detail": detail}, status=status)
+    response["Retry-After"] = str(retry_after)
+    return response
+
+
+def check_rate(group, request, user=None):
+    """Return a 429 response if ``request`` is over the group's rate, else None."""
+    config = settings.RATE_LIMITS[group]
+    capacity, per_second = parse_rate(config["rate"])
+    store, now = get_store(), time.time()
+    retry_after = 0
+    for kind in config.get("keys", ["ip"]):
+        value = _key_value(kind, request, user)
+        if value is not None:
+            retry_after = max(
+                retry_after, store.take(f"{group}:{kind}:{value}", capacity, per_second, now)
+            )
+    if retry_after:
+        return _rejected(request, 429, retry_after, "Too many requests, slow down.")
+    return None
+
+
+def rate_limit(group):
+    """Apply the ``group`` limits of settings.RATE_LIMITS to a view."""
+
+    def decorator(view):
+        def limited(request, user):
+            config = settings.RATE_LIMITS.get(group)
+            if not settings.RATE_LIMIT_ENABLED or config is None:
+                return None, None
+            methods = config.get("methods")
+            if methods and request.method not in methods:
+                return None, None
+            rejected = check_rate(group, request, user)
+            if rejected is not None:
+                return rejected, None
+            if config.get("concurrency"):
+                semaphore = _semaphore(group, config["concurrency"])
+                if not semaphore.acquire(blocking=False):
+                    return _rejected(request, 503, 1, "Server busy, try again shortly."), None
+                return None, semaphore
+            return None, None
+
+        if iscoroutinefunction(view):
+
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                rejected, semaphore = limited(request, await request.auser())
+                if rejected is not None:
+                    return rejected
+                try:
+                    return await view(request, *args, **kwargs)
+                finally:
+                    if semaphore is not None:
+                        semaphore.release()
+
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            rejected, semaphore = limited(request, getattr(request, "user", None))
+            if rejected is not None:
+                return rejected
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,163 @@
+"""Server-rendered pages of the records list (see records_view).
+
+Records are listed newest first and paged with a keyset cursor on
+``(created_at, id)``. Each family's page is read from the
+``(family, created_at)`` index and the pages are merged in one UNION ALL,
+so rendering a page costs the same however long the history is. With
+sharding on, that is one query per shard holding a listed family, merged
+here; record ids are unique across shards, so the cursor stays valid.
+
+Rendered pages are cached when the cache is shared between processes
+(CACHE_SHARED); with a per-process cache a write by another worker, the
+job runner or a command couldn't reach it, so pages are rendered every
+time. The key covers the filters, the cursor and the record version of
+every family listed. A record write bumps its family's version once the
+transaction commits, so pages showing that family are not served again
+and expire from the cache. Changes made outside the ORM signals, such as
+archiving a partition or renaming a user, show up once
+RECORDS_PAGE_CACHE_SECONDS have passed.
+"""
+
+import hashlib
+import heapq
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models import Q
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from . import sharding
+from .models import Record
+
+VERSION_KEY = "records:version:{family_id}"
+PAGE_KEY = "records:page:{digest}"
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def invalidate(family_ids):
+    """Stop serving cached pages of these families once the write commits."""
+    family_ids = set(family_ids)
+    if not family_ids or not settings.CACHE_SHARED:
+        return
+
+    def bump():
+        version = time.time_ns()
+        cache.set_many(
+            {VERSION_KEY.format(family_id=family_id): version for family_id in family_ids},
+            None,
+        )
+
+    transaction.on_commit(bump, using=router.db_for_write(Record))
+
+
+def _versions(family_ids):
+    keys = {VERSION_KEY.format(family_id=family_id): family_id for family_id in family_ids}
+    versions = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in versions}
+    if missing:
+        # A version evicted from the cache must not come back as an old one.
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return sorted((keys[key], version) for key, version in versions.items())
+
+
+def encode_cursor(record):
+    microseconds = (record.created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{microseconds}-{record.id}"
+
+
+def decode_cursor(value):
+    """``"<microseconds>-<id>"`` -> ``(created_at, id)``; ValueError if malformed."""
+    microseconds, _, record_id = value.partition("-")
+    try:
+        return _EPOCH + timedelta(microseconds=int(microseconds)), int(record_id)
+    except OverflowError as e:
+        raise ValueError(str(e)) from e
+
+
+def fetch_page(families, cursor=None, query="", size=None):
+    """Return ``(records, next_cursor)``, newest first."""
+    size = size or settings.RECORDS_PAGE_SIZE
+    if not families:
+        return [], None
+    conditions = Q()
+    if cursor is not None:
+        created_at, record_id = cursor
+        conditions &= Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=record_id)
+    if query:
+        conditions &= (
+            Q(name__icontains=query)
+            | Q(category__icontains=query)
+            | Q(description__icontains=query)
+        )
+
+    by_shard = defaultdict(list)
+    for family in families:
+        by_shard[sharding.family_shard(family.id)].append(family.id)
+    pages = []
+    for alias, family_ids in by_shard.items():
+        with sharding.use_shard(alias):
+            pages.append(_shard_page(family_ids, conditions, size))
+    # Each shard's page is already newest first.
+    merged = list(heapq.merge(*pages, key=lambda r: (r.created_at, r.id), reverse=True))
+    records = merged[:size]
+    next_cursor = encode_cursor(records[-1]) if len(merged) > size else None
+    return records, next_cursor
+
+
+def _shard_page(family_ids, conditions, size):
+    """Up to ``size + 1`` records of these families on the active shard."""
+    pages = [
+        Record.objects.filter(conditions, family_id=family_id)
+        .order_by("-created_at", "-id")
+        .values_list("id", "created_at")[: size + 1]
+        for family_id in family_ids
+    ]
+    merged = pages[0]
+    if len(pages) > 1:
+        merged = (
+            pages[0].union(*pages[1:], all=True).order_by("-created_at", "-id")[: size + 1]
+        )
+    ids = [record_id for record_id, _ in merged]
+
+    by_id = Record.objects.select_related("family", "who").in_bulk(ids)
+    return [by_id[record_id] for record_id in ids if record_id in by_id]
+
+
+def _render(families, cursor, query, family_pid):
+    records, next_cursor = fetch_page(families, decode_cursor(cursor) if cursor else None, query)
+    next_url = None
+    if next_cursor:
+        params = {"cursor": next_cursor}
+        if family_pid:
+            params["family"] = family_pid
+        if query:
+            params["q"] = query
+        next_url = f"{reverse('records_page')}?{urlencode(params)}"
+    return render_to_string(
+        "expense/record_rows.html",
+        {"records": records, "next_url": next_url, "first": cursor is None},
+    )
+
+
+def render_page(families, cursor=None, query="", family_pid=""):
+    """Rendered rows of one page plus the sentinel that loads the next one."""
+    if not settings.CACHE_SHARED:
+        return _render(families, cursor, query, family_pid)
+    family_ids = [family.id for family in families]
+    digest = hashlib.sha1(
+        repr((_versions(family_ids), cursor, query, family_pid)).encode()
+    ).hexdigest()
+    key = PAGE_KEY.format(digest=digest)
+    html = cache.get(key)
+    if html is None:
+        html = _render(families, cursor, query, family_pid)
+        cache.set(key, html, settings.RECORDS_PAGE_CACHE_SECONDS)
+    return html
@@ -0,0 +1,124 @@
+"""Materialize due recurring records into ``Record`` rows.
+
+Each batch costs a fixed number of queries regardless of how many
+occurrences it produces: one locking SELECT of due schedules, one bulk
+INSERT of records, one upsert of budget totals and one bulk UPDATE of the
+schedules, plus lookups of already existing occurrences and of the rows
+actually inserted. Inserts rely on the (recurring, created_at) unique
+constraint and ``ignore_conflicts``, so re-running a batch, or two
+schedulers racing, never duplicates a record or counts it twice.
+"""
+
+import uuid
+
+from django.utils import timezone
+
+from . import sharding
+from .budgets import apply_records
+from .duplicates import fingerprint
+from .events import publish_family_event
+from .models import Record, RecurringRecord
+from .record_pages import invalidate as invalidate_record_pages
+from .snapshots import schedule_refresh as refresh_snapshots
+
+# Occurrences created per schedule per batch. A schedule that is further
+# behind stays due and is picked up again by the next batch.
+MAX_OCCURRENCES_PER_BATCH = 500
+
+
+def _due_occurrences(recurring, now):
+    schedule = recurring.get_schedule()
+    occurrences = []
+    moment = recurring.next_run_at
+    while moment <= now and len(occurrences) < MAX_OCCURRENCES_PER_BATCH:
+        if recurring.ends_at and moment > recurring.ends_at:
+            break
+        occurrences.append(moment)
+        moment = schedule.next_after(moment)
+    return occurrences, moment
+
+
+def materialize_batch(now=None, batch_size=500):
+    """Create the records of up to ``batch_size`` due schedules.
+
+    Returns ``(schedules_processed, occurrences)``. Occurrences that already
+    had a record are counted but not inserted again.
+    """
+    now = now or timezone.now()
+    # On the active shard; materialize_due goes through every shard.
+    with sharding.atomic():
+        due = list(
+            RecurringRecord.objects.select_for_update(skip_locked=True)
+            .filter(active=True, next_run_at__lte=now)
+            .order_by("next_run_at")[:batch_size]
+        )
+        if not due:
+            return 0, 0
+
+        records = []
+        for recurring in due:
+            occurrences, next_run_at = _due_occurrences(recurring, now)
+            for moment in occurrences:
+                records.append(
+                    Record(
+                        pid=str(uuid.uuid4()),
+                        family_id=recurring.family_id,
+                        who_id=recurring.who_id,
+                        name=recurring.name,
+                        amount=recurring.amount,
+                        category=recurring.category,
+                        description=recurring.description,
+                        created_at=moment,
+                        recurring=recurring,
+                    )
+                )
+            if occurrences:
+                recurring.last_run_at = occurrences[-1]
+            recurring.next_run_at = next_run_at
+            if recurring.ends_at and next_run_at > recurring.ends_at:
+                recurring.active = False
+
+        # Skip occurrences that already have a record (e.g. next_run_at was
+        # moved back by hand) so they are not added to budget totals twice.
+        existing = set(
+            Record.objects.filter(
+                recurring__in=due, created_at__in={r.created_at for r in records}
+            ).values_list("recurring_id", "created_at")
+        )
+        records = [r for r in records if (r.recurring_id, r.created_at) not in existing]
+        for record in records:
+            # bulk_create skips Record.save
+            record.fingerprint = fingerprint(record)
+        Record.objects.bulk_create(records, batch_size=1000, ignore_conflicts=True)
+        # Rows skipped as conflicts (another scheduler got there first) are
+        # already in the totals; the pids were just generated, so the ones
+        # found are exactly the rows inserted here.
+        inserted = set(
+            Record.objects.filter(pid__in=[r.pid for r in records]).values_list("pid", flat=True)
+        )
+        records = [r for r in records if r.pid in inserted]
+        apply_records(records)
+        RecurringRecord.objects.bulk_update(
+            due, ["next_run_at", "last_run_at", "active"], batch_size=1000
+        )
+        invalidate_record_pages({record.family_id for record in records})
+        refresh_snapshots({record.family_id for record in records})
+        for family_id in {recurring.family_id for recurring in due}:
+            publish_family_event(family_id, {"type": "record.created", "record_id": None})
+
+    return len(due), len(records)
+
+
+def materialize_due(now=None, batch_size=500):
+    """Run batches until no schedule is due. Returns totals like ``materialize_batch``."""
+    now = now or timezone.now()
+    schedules = records = 0
+    for alias in sharding.shards():
+        with sharding.use_shard(alias):
+            while True:
+                processed, occurrences = materialize_batch(now, batch_size)
+                if not processed:
+                    break
+                schedules += processed
+                records += occurrences
+    return schedules, records
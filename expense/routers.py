@@ -0,0 +1,115 @@
+"""Read-replica routing with read-your-writes stickiness.
+
+Reads go to a random replica from DATABASE_REPLICAS, writes to
+``default``. Reads go to ``default`` instead when:
+
+* a transaction is open on ``default`` (e.g. ``select_for_update``), so a
+  transaction never mixes snapshots from two servers;
+* this request, task or thread wrote within the last
+  DATABASE_STICKY_SECONDS, so a replica that lags behind can't hide the
+  write from the writer.
+
+``ReplicaStickinessMiddleware`` carries the sticky window from one request
+to the next in a cookie, so a user who just saved a record also reads it
+back from the primary on the redirect that follows.
+"""
+
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .sharding import DIRECTORY_MODELS, SHARDED_MODELS, active, shards
+
+PRIMARY = "default"
+
+# A wall-clock deadline rather than a monotonic one: it also goes in a cookie.
+_pinned_until = contextvars.ContextVar("db_pinned_until", default=0.0)
+
+
+def replicas():
+    return [alias for alias in settings.DATABASES if alias.startswith("replica")]
+
+
+def pin_to_primary(seconds=None):
+    seconds = settings.DATABASE_STICKY_SECONDS if seconds is None else seconds
+    _pinned_until.set(max(_pinned_until.get(), time.time() + seconds))
+
+
+def pinned_until():
+    return _pinned_until.get()
+
+
+def set_pin(until):
+    """Replace the deadline; returns a token for ``restore_pin``."""
+    return _pinned_until.set(until)
+
+
+def restore_pin(token):
+    _pinned_until.reset(token)
+
+
+def is_pinned():
+    return _pinned_until.get() > time.time()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        aliases = replicas()
+        if not aliases or is_pinned() or connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        pin_to_primary()
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
+
+
+class ShardRouter:
+    """Routes family models to the instance's or else the active shard."""
+
+    def db_for_write(self, model, **hints):
+        label = model._meta.label_lower
+        if label in DIRECTORY_MODELS:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get("instance")
+        # Instances read from a replica were routed by ReplicaRouter, so the
+        # replica alias says nothing about the shard: fall through.
+        if instance is not None and instance._state.db in shards():
+            if instance._meta.label_lower in SHARDED_MODELS:
+                # Also users related to a family (family.members, record.who),
+                # read from the mirror on the family's shard.
+                return instance._state.db
+        if label not in SHARDED_MODELS:
+            return None
+        return active()
+
+    def db_for_read(self, model, **hints):
+        alias = self.db_for_write(model, **hints)
+        # Reads of the default database may go to a replica (ReplicaRouter).
+        return None if alias == DEFAULT_DB_ALIAS else alias
+
+    def allow_relation(self, obj1, obj2, **hints):
+        labels = {obj1._meta.label_lower, obj2._meta.label_lower}
+        if labels <= SHARDED_MODELS:
+            return obj1._state.db == obj2._state.db
+        # Users are mirrored to every shard that references them.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db not in shards():
+            # Not a shard, e.g. a replica: up to ReplicaRouter.
+            return None
+        if model_name is not None and f"{app_label}.{model_name}" in DIRECTORY_MODELS:
+            return db == DEFAULT_DB_ALIAS
+        # Every shard gets the full schema, so foreign keys to auth_user hold.
+        return True
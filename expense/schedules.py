@@ -0,0 +1,98 @@
+"""Minimal cron expressions for recurring records.
+
+Supports the standard five fields (minute, hour, day of month, month, day
+of week) with ``*``, lists, ranges and steps, plus the ``@yearly``,
+``@monthly``, ``@weekly`` and ``@daily`` shortcuts. Times are evaluated in
+``settings.TIME_ZONE``.
+"""
+
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+
+ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+}
+
+# (low, high) for minute, hour, day of month, month, day of week.
+FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+# How far ahead to look for the next matching day, e.g. "0 0 29 2 *".
+MAX_LOOKAHEAD_DAYS = 366 * 8
+
+
+def _parse_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        value_range, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if value_range == "*":
+            start, end = low, high
+        elif "-" in value_range:
+            start, end = (int(v) for v in value_range.split("-", 1))
+        else:
+            start = int(value_range)
+            end = high if step > 1 else start
+        if step < 1 or not low <= start <= end <= high:
+            raise ValueError(f"Invalid cron field {field!r}.")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    def __init__(self, expression: str):
+        expression = ALIASES.get(expression.strip(), expression)
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression {expression!r} must have 5 fields.")
+        try:
+            parsed = [
+                _parse_field(field, low, high)
+                for field, (low, high) in zip(fields, FIELD_RANGES)
+            ]
+        except ValueError as e:
+            raise ValueError(str(e) or f"Invalid cron expression {expression!r}.")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            sorted(values) for values in parsed
+        )
+        # Both 0 and 7 mean Sunday.
+        self.weekdays = {0 if d == 7 else d for d in weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _day_matches(self, day):
+        if day.month not in self.months:
+            return False
+        in_days = day.day in self.days
+        in_weekdays = day.isoweekday() % 7 in self.weekdays
+        # Cron semantics: when both day fields are restricted, either matches.
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, moment: datetime) -> datetime:
+        """Return the first occurrence strictly after ``moment``."""
+        tz = ZoneInfo(settings.TIME_ZONE)
+        local = moment.astimezone(tz).replace(second=0, microsecond=0)
+        local += timedelta(minutes=1)
+        day = local.date()
+        for _ in range(MAX_LOOKAHEAD_DAYS):
+            if self._day_matches(day):
+                for hour in self.hours:
+                    if day == local.date() and hour < local.hour:
+                        continue
+                    for minute in self.minutes:
+                        if day == local.date() and hour == local.hour and minute < local.minute:
+                            continue
+                        return datetime.combine(day, time(hour, minute), tzinfo=tz)
+            day += timedelta(days=1)
+        raise ValueError(f"Cron expression {self.expression!r} never matches.")
+
+    def first_at_or_after(self, moment: datetime) -> datetime:
+        return self.next_after(moment - timedelta(minutes=1))
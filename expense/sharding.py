@@ -0,0 +1,521 @@
+"""Family-based horizontal sharding.
+
+Every family lives on one database from settings.SHARDS: ``default`` plus
+one ``shardN`` alias per entry of DATABASE_SHARDS. Its records, QR codes,
+recurring records, budgets and membership rows live on the same database.
+Users, accounts, sessions, jobs and exchange rates stay on ``default``.
+
+The directory on ``default`` says where each family lives. FamilyShard
+maps a family to its shard, and its id is the family's id, so family ids
+are unique across shards. ShardMembership maps users to their families.
+Directory lookups are cached for SHARD_DIRECTORY_CACHE_SECONDS.
+
+Each shard has the full schema. The auth_user rows of a family's members,
+and of the authors of its records and budgets, are mirrored to the shard,
+so its foreign keys hold. Mirrors have no usable password.
+
+ShardRouter sends the family models to the shard active in this context.
+ShardMiddleware activates the shard of the ``family_id`` URL argument, or
+else the shard of the signed-in user's families. Code that may touch
+several shards uses ``use_shard()``, ``user_shards()`` and ``locate()``.
+
+New families go on their creator's shard, so one user's families stay
+together. A creator without families gets a shard by hash of the family
+pid. ``manage.py rebalance_shards`` syncs the directory and moves families
+between shards. The sync also interleaves the id sequences of the other
+sharded tables (shard i of N hands out ids congruent to i mod N), so record,
+QR code, budget and recurring ids are unique across shards too. They change
+when a family moves; pids do not.
+
+With DATABASE_SHARDS unset everything stays on ``default``, and the
+directory isn't used.
+"""
+
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count
+
+from .models import (
+    Budget,
+    BudgetAlert,
+    BudgetTotal,
+    Family,
+    FamilyShard,
+    QRCode,
+    Record,
+    RecurringRecord,
+    ShardMembership,
+    Statement,
+)
+
+# Models stored on a family's shard, by label_lower
+SHARDED_MODELS = {
+    "expense.family",
+    "expense.family_members",
+    "expense.record",
+    "expense.recurringrecord",
+    "expense.qrcode",
+    "expense.budget",
+    "expense.budgettotal",
+    "expense.budgetalert",
+    "expense.statement",
+}
+# Sharded tables whose ids come from a per-shard sequence
+SEQUENCED_MODELS = [Record, RecurringRecord, QRCode, Budget, BudgetAlert, Statement]
+
+# Models stored on the default database only
+DIRECTORY_MODELS = {"expense.familyshard", "expense.shardmembership"}
+
+FAMILY_KEY = "shard:family:{family_id}"
+USER_KEY = "shard:user:{user_id}"
+
+# User columns copied to shards; the password is never copied.
+MIRRORED_USER_FIELDS = ["username", "first_name", "last_name", "email", "is_active", "date_joined"]
+
+MOVE_BATCH_SIZE = 5000
+
+_active = ContextVar("active_shard", default=None)
+
+
+def shards():
+    return settings.SHARDS
+
+
+def enabled():
+    return len(settings.SHARDS) > 1
+
+
+def active():
+    """The shard family models are routed to here; ``default`` if none is active."""
+    return _active.get() or DEFAULT_DB_ALIAS
+
+
+def activate(alias):
+    """Make ``alias`` active in this context; returns a token for ``deactivate``."""
+    return _active.set(alias)
+
+
+def deactivate(token):
+    _active.reset(token)
+
+
+@contextmanager
+def use_shard(alias):
+    token = _active.set(alias)
+    try:
+        yield alias
+    finally:
+        _active.reset(token)
+
+
+def atomic(using=None):
+    """``transaction.atomic`` on the active shard."""
+    return transaction.atomic(using=using or active())
+
+
+def family_shard(family_id):
+    """Shard holding ``family_id`` (``default`` if unknown, so lookups 404 there)."""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    key = FAMILY_KEY.format(family_id=family_id)
+    alias = cache.get(key)
+    if alias is None:
+        alias = (
+            FamilyShard.objects.using(DEFAULT_DB_ALIAS)
+            .filter(id=family_id)
+            .values_list("shard", flat=True)
+            .first()
+        ) or DEFAULT_DB_ALIAS
+        cache.set(key, alias, settings.SHARD_DIRECTORY_CACHE_SECONDS)
+    return alias
+
+
+def user_shards(user_id):
+    """Shards holding the user's families (just the active one if sharding is off)."""
+    if not enabled():
+        return [active()]
+    key = USER_KEY.format(user_id=user_id)
+    aliases = cache.get(key)
+    if aliases is None:
+        aliases = sorted(
+            set(
+                ShardMembership.objects.using(DEFAULT_DB_ALIAS)
+                .filter(user_id=user_id)
+                .values_list("family__shard", flat=True)
+            )
+        )
+        cache.set(key, aliases, settings.SHARD_DIRECTORY_CACHE_SECONDS)
+    return aliases
+
+
+def locate(user, queryset):
+    """First match of ``queryset`` on any of the user's shards, or None.
+
+    For objects addressed by a per-shard id (records, QR codes, recurring
+    records); the queryset should also check the user's membership.
+    """
+    for alias in user_shards(user.pk):
+        with use_shard(alias):
+            obj = queryset.first()
+        if obj is not None:
+            return obj
+    return None
+
+
+def collect(user, queryset):
+    """Every match of ``queryset`` on the user's shards, shard by shard."""
+    results = []
+    for alias in user_shards(user.pk):
+        with use_shard(alias):
+            results.extend(queryset.all())
+    return results
+
+
+def place(pid):
+    """Shard for a new family: the active one, else by hash of its pid."""
+    alias = _active.get()
+    if alias is None:
+        alias = shards()[zlib.crc32(pid.encode()) % len(shards())]
+    return alias
+
+
+def _forget_users(user_ids):
+    cache.delete_many([USER_KEY.format(user_id=user_id) for user_id in user_ids])
+
+
+def register_family(family):
+    """Give a new family a directory entry on the shard it's being saved to."""
+    if not enabled():
+        return
+    alias = place(family.pid)
+    entry = FamilyShard.objects.using(DEFAULT_DB_ALIAS).create(pid=family.pid, shard=alias)
+    family.id = entry.id
+    family._state.db = alias
+    cache.set(
+        FAMILY_KEY.format(family_id=entry.id), alias, settings.SHARD_DIRECTORY_CACHE_SECONDS
+    )
+
+
+def mirror_users(alias, user_ids):
+    """Copy (or refresh) auth_user rows onto a shard, without passwords."""
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if alias == DEFAULT_DB_ALIAS or not user_ids:
+        return
+    users = [
+        User(id=user["id"], password="!", **{name: user[name] for name in MIRRORED_USER_FIELDS})
+        for user in User.objects.using(DEFAULT_DB_ALIAS)
+        .filter(id__in=user_ids)
+        .values("id", *MIRRORED_USER_FIELDS)
+    ]
+    User.objects.using(alias).bulk_create(
+        users,
+        update_conflicts=True,
+        unique_fields=["id"],
+        update_fields=MIRRORED_USER_FIELDS,
+    )
+
+
+def add_memberships(family_id, user_ids):
+    if not enabled():
+        return
+    ShardMembership.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+        [ShardMembership(user_id=user_id, family_id=family_id) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+    _forget_users(user_ids)
+
+
+def remove_memberships(family_id, user_ids):
+    if not enabled():
+        return
+    ShardMembership.objects.using(DEFAULT_DB_ALIAS).filter(
+        family_id=family_id, user_id__in=user_ids
+    ).delete()
+    _forget_users(user_ids)
+
+
+def forget_family(family_id):
+    """Drop a deleted family from the directory."""
+    if not enabled():
+        return
+    user_ids = list(
+        ShardMembership.objects.using(DEFAULT_DB_ALIAS)
+        .filter(family_id=family_id)
+        .values_list("user_id", flat=True)
+    )
+    FamilyShard.objects.using(DEFAULT_DB_ALIAS).filter(id=family_id).delete()
+    cache.delete(FAMILY_KEY.format(family_id=family_id))
+    _forget_users(user_ids)
+
+
+def refresh_mirrors(user):
+    """Push a changed user to the shards that hold a mirror of it."""
+    if not enabled():
+        return
+    for alias in user_shards(user.pk):
+        if alias != DEFAULT_DB_ALIAS:
+            User.objects.using(alias).filter(id=user.pk).update(
+                **{name: getattr(user, name) for name in MIRRORED_USER_FIELDS}
+            )
+
+
+def sync_directory():
+    """Add every family found on a shard to the directory.
+
+    Run when sharding is switched on and whenever a shard is added. Also
+    moves the directory's id sequence past every existing family id and
+    interleaves the other id sequences. Returns the number of families
+    added.
+    """
+    known = set(FamilyShard.objects.using(DEFAULT_DB_ALIAS).values_list("id", flat=True))
+    added = 0
+    for alias in shards():
+        families = list(Family.objects.using(alias).exclude(id__in=known).values("id", "pid"))
+        FamilyShard.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+            [FamilyShard(id=f["id"], pid=f["pid"], shard=alias) for f in families],
+            ignore_conflicts=True,
+        )
+        members = Family.members.through.objects.using(alias).values_list("family_id", "user_id")
+        ShardMembership.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+            [ShardMembership(family_id=f, user_id=u) for f, u in members],
+            ignore_conflicts=True,
+        )
+        known.update(f["id"] for f in families)
+        added += len(families)
+    with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+        table = FamilyShard._meta.db_table
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+            f"GREATEST((SELECT COALESCE(MAX(id), 0) FROM {table}), %s) + 1, false)",
+            [table, max((_max_family_id(alias) for alias in shards()), default=0)],
+        )
+    _interleave_sequences()
+    cache.delete_many(
+        [FAMILY_KEY.format(family_id=family_id) for family_id in known]
+        + [USER_KEY.format(user_id=user_id) for user_id in User.objects.values_list("id", flat=True)]
+    )
+    return added
+
+
+def _max_family_id(alias):
+    return Family.objects.using(alias).order_by("-id").values_list("id", flat=True).first() or 0
+
+
+def _interleave_sequences():
+    count = len(shards())
+    for model in SEQUENCED_MODELS:
+        table = model._meta.db_table
+        highest = max(
+            model.objects.using(alias).order_by("-pk").values_list("pk", flat=True).first() or 0
+            for alias in shards()
+        )
+        for index, alias in enumerate(shards()):
+            # First id above every shard's ids that is ``index`` mod ``count``
+            start = highest + 1 + (index - highest - 1) % count
+            with connections[alias].cursor() as cursor:
+                cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+                (sequence,) = cursor.fetchone()
+                cursor.execute(
+                    f"ALTER SEQUENCE {sequence} INCREMENT BY {count} "
+                    f"MINVALUE 1 RESTART WITH {start}"
+                )
+
+
+def _referenced_users(alias, family_id):
+    user_ids = set(
+        Family.members.through.objects.using(alias)
+        .filter(family_id=family_id)
+        .values_list("user_id", flat=True)
+    )
+    for model, field in ((Record, "who_id"), (RecurringRecord, "who_id"), (Budget, "member_id")):
+        user_ids.update(
+            model.objects.using(alias)
+            .filter(family_id=family_id)
+            .exclude(**{field: None})
+            .values_list(field, flat=True)
+            .distinct()
+        )
+    return user_ids
+
+
+def _copy(model, rows, using, id_map=None, remap=None):
+    """Insert copies of ``rows`` (model instances) with fresh ids.
+
+    ``remap`` maps a foreign-key attribute to an {old id: new id} dict.
+    Returns {old id: new id}.
+    """
+    old_ids, copies = [], []
+    for row in rows:
+        old_ids.append(row.pk)
+        row.pk = None
+        row._state.adding, row._state.db = True, None
+        for attname, mapping in (remap or {}).items():
+            value = getattr(row, attname)
+            if value is not None:
+                setattr(row, attname, mapping.get(value))
+        copies.append(row)
+    model.objects.using(using).bulk_create(copies, batch_size=MOVE_BATCH_SIZE)
+    if id_map is not None:
+        id_map.update(zip(old_ids, (row.pk for row in copies)))
+    return id_map
+
+
+def _delete_family_rows(alias, family_id):
+    """Delete a family and everything on its shard, without per-row signals."""
+    with connections[alias].cursor() as cursor:
+        alert, budget = BudgetAlert._meta.db_table, Budget._meta.db_table
+        cursor.execute(
+            f"DELETE FROM {alert} WHERE budget_id IN (SELECT id FROM {budget} WHERE family_id = %s)",
+            [family_id],
+        )
+        for model in (
+            Record,
+            RecurringRecord,
+            QRCode,
+            Budget,
+            BudgetTotal,
+            Statement,
+            Family.members.through,
+        ):
+            cursor.execute(f"DELETE FROM {model._meta.db_table} WHERE family_id = %s", [family_id])
+        cursor.execute(f"DELETE FROM {Family._meta.db_table} WHERE id = %s", [family_id])
+
+
+def move_family(family_id, target):
+    """Move a family and its rows to the ``target`` shard.
+
+    Writes to the family wait on a lock on its row until the move is done;
+    a write that was waiting then fails (its family is gone from the old
+    shard) and succeeds when retried. QR code and statement files stay where
+    they are in storage. Returns the number of records moved.
+    """
+    source = family_shard(family_id)
+    if source == target:
+        return 0
+    with transaction.atomic(using=source):
+        family = Family.objects.using(source).select_for_update().get(id=family_id)
+        with transaction.atomic(using=target):
+            # Left behind by an interrupted move
+            _delete_family_rows(target, family_id)
+            mirror_users(target, _referenced_users(source, family_id))
+
+            family._state.adding, family._state.db = True, None
+            Family.objects.using(target).bulk_create([family])
+            through = Family.members.through
+            through.objects.using(target).bulk_create(
+                [
+                    through(family_id=family_id, user_id=user_id)
+                    for user_id in through.objects.using(source)
+                    .filter(family_id=family_id)
+                    .values_list("user_id", flat=True)
+                ]
+            )
+
+            recurring = _copy(
+                RecurringRecord,
+                RecurringRecord.objects.using(source).filter(family_id=family_id),
+                target,
+                id_map={},
+            )
+            moved = 0
+            batch = []
+            for record in (
+                Record.objects.using(source)
+                .filter(family_id=family_id)
+                .order_by("id")
+                .iterator(chunk_size=MOVE_BATCH_SIZE)
+            ):
+                batch.append(record)
+                if len(batch) == MOVE_BATCH_SIZE:
+                    _copy(Record, batch, target, remap={"recurring_id": recurring})
+                    moved += len(batch)
+                    batch = []
+            _copy(Record, batch, target, remap={"recurring_id": recurring})
+            moved += len(batch)
+
+            _copy(QRCode, QRCode.objects.using(source).filter(family_id=family_id), target)
+            budgets = _copy(
+                Budget, Budget.objects.using(source).filter(family_id=family_id), target, id_map={}
+            )
+            _copy(
+                BudgetAlert,
+                BudgetAlert.objects.using(source).filter(budget__family_id=family_id),
+                target,
+                remap={"budget_id": budgets},
+            )
+            _copy(BudgetTotal, BudgetTotal.objects.using(source).filter(family_id=family_id), target)
+            _copy(Statement, Statement.objects.using(source).filter(family_id=family_id), target)
+
+        FamilyShard.objects.using(DEFAULT_DB_ALIAS).filter(id=family_id).update(shard=target)
+        cache.set(
+            FAMILY_KEY.format(family_id=family_id), target, settings.SHARD_DIRECTORY_CACHE_SECONDS
+        )
+        _forget_users(
+            ShardMembership.objects.using(DEFAULT_DB_ALIAS)
+            .filter(family_id=family_id)
+            .values_list("user_id", flat=True)
+        )
+        _delete_family_rows(source, family_id)
+
+    from .record_pages import invalidate as invalidate_record_pages
+    from .snapshots import discard as discard_snapshot
+
+    invalidate_record_pages([family_id])
+    # Records get new ids on the target; the next stats request rebuilds it.
+    discard_snapshot(family_id)
+    return moved
+
+
+def shard_sizes():
+    """``{alias: {family_id: record count}}`` for every shard."""
+    sizes = {}
+    for alias in shards():
+        counts = dict.fromkeys(Family.objects.using(alias).values_list("id", flat=True), 0)
+        counts.update(
+            Record.objects.using(alias)
+            .order_by()
+            .values_list("family_id")
+            .annotate(n=Count("id"))
+            .values_list("family_id", "n")
+        )
+        sizes[alias] = counts
+    return sizes
+
+
+def plan_rebalance(sizes, tolerance=0.1):
+    """Moves ``[(family_id, source, target)]`` evening out record counts.
+
+    Greedy: repeatedly moves the largest family that fits from the fullest
+    shard to the emptiest, until every shard is within ``tolerance`` of the
+    mean or no move helps.
+    """
+    sizes = {alias: dict(families) for alias, families in sizes.items()}
+    totals = {alias: sum(families.values()) for alias, families in sizes.items()}
+    mean = sum(totals.values()) / max(len(totals), 1)
+    moves = []
+    while True:
+        fullest = max(totals, key=totals.get)
+        emptiest = min(totals, key=totals.get)
+        gap = totals[fullest] - totals[emptiest]
+        if totals[fullest] <= mean * (1 + tolerance) or not gap:
+            break
+        # A move helps if it narrows the gap between the two shards.
+        candidates = [
+            (count, family_id)
+            for family_id, count in sizes[fullest].items()
+            if 0 < count < gap
+        ]
+        if not candidates:
+            break
+        count, family_id = max(candidates, key=lambda c: min(c[0], gap - c[0]))
+        moves.append((family_id, fullest, emptiest))
+        sizes[emptiest][family_id] = sizes[fullest].pop(family_id)
+        totals[fullest] -= count
+        totals[emptiest] += count
+    return moves
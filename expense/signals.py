@@ -0,0 +1,223 @@
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import sharding
+from .backends import invalidate_cached_user
+from .budgets import apply_deltas, record_deltas, record_values
+from .categorizer import learn
+from .currency import bump_version
+from .events import publish_family_event
+from .jobs import enqueue
+from .models import ExchangeRate, Family, Record, Statement
+from .record_pages import invalidate as invalidate_record_pages
+from .snapshots import discard as discard_snapshot, schedule_refresh as refresh_snapshots
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    invalidate_cached_user(instance.pk)
+
+
+@receiver(user_logged_out)
+def user_logged_out_handler(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_cached_user(user.pk)
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, using, **kwargs):
+    # The cascade deletes the user's membership rows without m2m_changed.
+    Family.objects.using(using).filter(members=instance).update(
+        member_count=F("member_count") - 1
+    )
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, using, **kwargs):
+    # Mirrors on shards are written with .update(), which sends no signal.
+    if using == "default" and not created:
+        sharding.refresh_mirrors(instance)
+
+
+@receiver(post_save, sender=ExchangeRate)
+@receiver(post_delete, sender=ExchangeRate)
+def exchange_rate_changed(sender, instance, **kwargs):
+    bump_version()
+
+
+def _loaded_record_values(record):
+    loaded = getattr(record, "_loaded_values", None) or {}
+    keys = ("amount", "currency", "category", "who_id", "created_at")
+    if not all(key in loaded for key in keys):
+        # Never loaded, or loaded with deferred fields.
+        return None
+    return {key: loaded[key] for key in keys}
+
+
+def _family_currency(record):
+    if Record.family.is_cached(record):
+        return record.family.currency
+    return (
+        Family.objects.filter(id=record.family_id)
+        .values_list("currency", flat=True)
+        .first()
+    )
+
+
+def _record_text(record):
+    return (record.name, record.description, record.category)
+
+
+def _loaded_record_text(record):
+    loaded = getattr(record, "_loaded_values", None) or {}
+    keys = ("name", "description", "category")
+    if not all(key in loaded for key in keys):
+        return None
+    return tuple(loaded[key] for key in keys)
+
+
+@receiver(post_save, sender=Record)
+def record_saved(sender, instance, created, using, **kwargs):
+    with sharding.use_shard(using):
+        _record_saved(instance, created)
+
+
+def _record_saved(instance, created):
+    old = None if created else _loaded_record_values(instance)
+    new = record_values(instance)
+    apply_deltas(
+        record_deltas(instance.family_id, _family_currency(instance), old=old, new=new)
+    )
+
+    old_text = None if created else _loaded_record_text(instance)
+    # An update whose previous text is unknown waits for the next retrain.
+    if created or old_text is not None:
+        learn(instance.family_id, instance.pk, old=old_text, new=_record_text(instance))
+    invalidate_record_pages([instance.family_id])
+    refresh_snapshots([instance.family_id])
+    instance._loaded_values = {
+        **new,
+        "name": instance.name,
+        "description": instance.description,
+        "category": instance.category,
+    }
+
+    publish_family_event(
+        instance.family_id,
+        {
+            "type": "record.created" if created else "record.updated",
+            "record_id": instance.id,
+        },
+    )
+
+
+@receiver(post_delete, sender=Record)
+def record_deleted(sender, instance, using, origin=None, **kwargs):
+    with sharding.use_shard(using):
+        _record_deleted(instance, origin)
+
+
+def _record_deleted(instance, origin):
+    # When the whole family is being deleted its totals go with it.
+    origin_model = getattr(origin, "model", type(origin))
+    if origin_model is not Family:
+        apply_deltas(
+            record_deltas(
+                instance.family_id,
+                _family_currency(instance),
+                old=record_values(instance),
+            )
+        )
+    learn(instance.family_id, instance.pk, old=_record_text(instance))
+    invalidate_record_pages([instance.family_id])
+    if origin_model is not Family:
+        refresh_snapshots([instance.family_id])
+
+    publish_family_event(
+        instance.family_id,
+        {"type": "record.deleted", "record_id": instance.id},
+    )
+
+
+@receiver(post_save, sender=Family)
+def family_saved(sender, instance, created, **kwargs):
+    # Rows show the family's name and currency.
+    if not created:
+        invalidate_record_pages([instance.pk])
+
+
+@receiver(post_delete, sender=Family)
+def family_deleted(sender, instance, using, **kwargs):
+    sharding.forget_family(instance.pk)
+    family_id = instance.pk
+    transaction.on_commit(lambda: discard_snapshot(family_id), using=using)
+
+
+@receiver(post_delete, sender=Statement)
+def statement_deleted(sender, instance, using, **kwargs):
+    # Also sent for each statement of a deleted family
+    path = instance.file.name
+    if path:
+        transaction.on_commit(lambda: enqueue("storage.delete", path=path), using=using)
+
+
+def _recount_members(family_ids, using):
+    through = Family.members.through
+    Family.objects.using(using).filter(id__in=family_ids).update(
+        member_count=Coalesce(
+            Subquery(
+                through.objects.using(using)
+                .filter(family_id=OuterRef("pk"))
+                .values("family_id")
+                .annotate(count=Count("id"))
+                .values("count")
+            ),
+            0,
+        )
+    )
+
+
+@receiver(m2m_changed, sender=Family.members.through)
+def family_members_changed(
+    sender, instance, action, reverse, pk_set, using, counted=False, **kwargs
+):
+    if action in ("post_add", "post_remove", "post_clear") and not counted:
+        # Changed through the related manager (e.g. the admin) rather than
+        # Family.add_members / remove_members: recount.
+        family_ids = pk_set if reverse else [instance.pk]
+        if family_ids:
+            _recount_members(family_ids, using)
+    if not pk_set:
+        return
+    if action == "pre_add":
+        # Members must exist on the family's shard before the rows point at them.
+        if not reverse:
+            sharding.mirror_users(using, pk_set)
+        return
+    if action not in ("post_add", "post_remove"):
+        return
+    for family_id, user_ids in (
+        [(family_id, [instance.pk]) for family_id in pk_set] if reverse else [(instance.pk, pk_set)]
+    ):
+        if action == "post_add":
+            sharding.add_memberships(family_id, user_ids)
+        else:
+            sharding.remove_memberships(family_id, user_ids)
+
+    event_type = "member.added" if action == "post_add" else "member.removed"
+    if reverse:
+        # user.families.add(...): instance is the user, pk_set the families.
+        for family_id in pk_set:
+            publish_family_event(
+                family_id, {"type": event_type, "member_ids": [instance.pk]}
+            )
+    else:
+        publish_family_event(
+            instance.pk, {"type": event_type, "member_ids": sorted(pk_set)}
+        )
@@ -0,0 +1,64 @@
+"""Ledger snapshots: columnar copies of each family's records.
+
+A snapshot holds one family's whole record history as NumPy columns in a
+single file under SNAPSHOT_DIR (the format is in expense/ledger.py). It is
+opened with mmap, so reading years of records costs no query and no copy,
+and the stats endpoint aggregates the columns directly.
+
+A family's snapshot is built the first time its stats are asked for. From
+then on, record writes schedule a ``snapshot.refresh`` job
+SNAPSHOT_REFRESH_DELAY seconds after they commit. Each family has at most
+one pending refresh per process, and that job covers every write made
+before it runs. The refresh reads only the records updated since the last
+one (through the ``(family, updated_at)`` index) and merges them into the
+columns. Deleted records are dropped when the family's record count
+disagrees with the snapshot's. Stats may therefore lag writes by about
+SNAPSHOT_REFRESH_DELAY; the response says how old they are.
+
+This module is imported by the record signals, so it doesn't load NumPy.
+"""
+
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
+from django.utils import timezone
+
+from .jobs import enqueue
+from .models import Record
+
+PENDING_KEY = "snapshot:pending:{family_id}"
+
+
+def snapshot_path(family_id):
+    return Path(settings.SNAPSHOT_DIR) / f"{family_id}.ledger"
+
+
+def schedule_refresh(family_ids):
+    """Refresh the families' snapshots, if they have one, after this write commits."""
+    family_ids = {
+        family_id for family_id in family_ids if snapshot_path(family_id).exists()
+    }
+    if not family_ids:
+        return
+    using = router.db_for_write(Record)
+
+    def enqueue_refreshes():
+        delay = settings.SNAPSHOT_REFRESH_DELAY
+        for family_id in family_ids:
+            # A refresh already pending reads this write too.
+            if cache.add(PENDING_KEY.format(family_id=family_id), True, delay):
+                enqueue(
+                    "snapshot.refresh",
+                    run_at=timezone.now() + timedelta(seconds=delay),
+                    family_id=family_id,
+                    shard=using,
+                )
+
+    transaction.on_commit(enqueue_refreshes, using=using)
+
+
+def discard(family_id):
+    snapshot_path(family_id).unlink(missing_ok=True)
@@ -0,0 +1,206 @@
+"""Monthly family statements.
+
+A statement sums up one family's month: spend per category and per member,
+the largest expenses and how each budget came out. ``manage.py
+generate_statements`` renders it once the month is over, as a standalone
+HTML file in storage, and records it in a Statement row; viewing it later
+only reads that file.
+
+The totals come from the month's BudgetTotal rows (see expense/budgets.py),
+so the cost of a statement doesn't grow with the number of records: only
+the record count and the largest expenses read records, both through the
+``(family, created_at)`` index.
+"""
+
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import DEFAULT_DB_ALIAS, close_old_connections
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from . import sharding
+from .budgets import budget_status
+from .currency import converted_amount
+from .models import CATEGORIES, BudgetTotal, Family, Record, Statement
+
+
+def parse_period(value):
+    """First day of the month given as ``YYYY-MM``; ValueError if malformed."""
+    return datetime.strptime(value, "%Y-%m").date()
+
+
+def previous_period(period):
+    return (period - timedelta(days=1)).replace(day=1)
+
+
+def month_bounds(period):
+    """Aware [start, end) datetimes of the month, in the current time zone."""
+    next_period = (period.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return (
+        timezone.make_aware(datetime.combine(period, time.min)),
+        timezone.make_aware(datetime.combine(next_period, time.min)),
+    )
+
+
+def statement_path(family, period):
+    return f"statements/{family.pid}/{period:%Y-%m}.html"
+
+
+def _user_name(user):
+    if user is None:
+        return "Unknown"
+    return user.first_name.strip() or user.username or user.email
+
+
+def _breakdown(amounts, total):
+    """``[(label, amount, share)]``, largest first."""
+    return [
+        (label, amount, amount / total if total else 0)
+        for label, amount in sorted(amounts, key=lambda item: -item[1])
+    ]
+
+
+def build_context(family, period):
+    """Everything the statement template shows for ``family``'s month."""
+    start, end = month_bounds(period)
+    totals = {
+        (row.category, row.member_id): row.total
+        for row in BudgetTotal.objects.filter(family=family, period=period)
+    }
+    total = totals.get(("", 0), 0)
+    previous_total = (
+        BudgetTotal.objects.filter(
+            family=family, period=previous_period(period), category="", member_id=0
+        )
+        .values_list("total", flat=True)
+        .first()
+        or 0
+    )
+
+    categories = [
+        (CATEGORIES.get(category, category), amount)
+        for (category, member_id), amount in totals.items()
+        if category and not member_id
+    ]
+    uncategorized = total - sum(amount for _, amount in categories)
+    if abs(uncategorized) >= 0.005:
+        categories.append(("Uncategorized", uncategorized))
+
+    member_totals = {
+        member_id: amount
+        for (category, member_id), amount in totals.items()
+        if not category and member_id
+    }
+    users = User.objects.in_bulk(member_totals)
+    members = [
+        (_user_name(users.get(member_id)), amount) for member_id, amount in member_totals.items()
+    ]
+    unassigned = total - sum(member_totals.values())
+    if abs(unassigned) >= 0.005:
+        members.append(("Unassigned", unassigned))
+
+    records = Record.objects.filter(family=family, created_at__gte=start, created_at__lt=end)
+    largest = list(
+        records.annotate(converted=converted_amount(family.currency))
+        .select_related("who")
+        .order_by("-converted", "id")[: settings.STATEMENT_LARGEST_EXPENSES]
+    )
+
+    budgets = []
+    for budget, spent, ratio in budget_status(family, period):
+        label = CATEGORIES.get(budget.category, "All categories")
+        if budget.member_id:
+            label = f"{label} ({_user_name(budget.member)})"
+        budgets.append(
+            {
+                "label": label,
+                "amount": budget.amount,
+                "spent": spent,
+                "variance": budget.amount - spent,
+                "ratio": ratio,
+            }
+        )
+
+    return {
+        "family": family,
+        "period": period,
+        "currency": family.currency,
+        "total": total,
+        "previous_total": previous_total,
+        "change": total - previous_total,
+        "record_count": records.count(),
+        "categories": _breakdown(categories, total),
+        "members": _breakdown(members, total),
+        "largest": [
+            {
+                "record": record,
+                "who": _user_name(record.who) if record.who_id else "Unassigned",
+                "converted": record.converted,
+            }
+            for record in largest
+        ],
+        "budgets": budgets,
+        "generated_at": timezone.now(),
+    }
+
+
+def _generate(family_id, period, force):
+    family = Family.objects.filter(id=family_id).first()
+    if family is None:
+        return False
+    existing = Statement.objects.filter(family=family, period=period).first()
+    if existing is not None and not force:
+        return False
+
+    context = build_context(family, period)
+    html = render_to_string("expense/statement.html", context)
+    # Saved next to the previous version (storage picks a free name), which
+    # keeps being served until the row points at the new one.
+    name = default_storage.save(statement_path(family, period), ContentFile(html.encode()))
+    try:
+        with sharding.atomic():
+            Statement.objects.update_or_create(
+                family=family,
+                period=period,
+                defaults={
+                    "file": name,
+                    "currency": family.currency,
+                    "total": context["total"],
+                    "record_count": context["record_count"],
+                    "created_at": timezone.now(),
+                },
+            )
+    except Exception:
+        default_storage.delete(name)
+        raise
+    if existing is not None and existing.file.name != name:
+        default_storage.delete(existing.file.name)
+    return True
+
+
+def generate(family_id, period, shard=DEFAULT_DB_ALIAS, force=False):
+    """Render and store one family's statement. Safe to call in a subprocess.
+
+    Returns False when there was nothing to do: the statement exists (and
+    ``force`` is off) or the family is gone.
+    """
+    close_old_connections()
+    try:
+        with sharding.use_shard(shard):
+            return _generate(family_id, period, force)
+    finally:
+        close_old_connections()
+
+
+def month_is_over(period):
+    return month_bounds(period)[1] <= timezone.now()
+
+
+def default_period():
+    """The last complete month."""
+    return previous_period(timezone.localdate().replace(day=1))
+
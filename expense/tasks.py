@@ -0,0 +1,47 @@
+"""Background job handlers (see expense/jobs.py)."""
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import DEFAULT_DB_ALIAS
+
+from . import sharding
+from .jobs import enqueue, register
+from .models import Family, QRCode
+from .snapshots import PENDING_KEY
+
+
+@register("storage.delete")
+def delete_file(path):
+    if path and default_storage.exists(path):
+        default_storage.delete(path)
+
+
+@register("qrcode.verify")
+def verify_qrcode(qrcode_id, shard=DEFAULT_DB_ALIAS):
+    # The upload's content type comes from the client; make sure the stored
+    # file really is an image and drop it otherwise.
+    # Pillow is only imported by the worker that needs it.
+    from PIL import Image, UnidentifiedImageError
+
+    qr = QRCode.objects.using(shard).filter(id=qrcode_id).first()
+    if qr is None or not qr.image:
+        return
+    try:
+        with qr.image.open("rb") as file, Image.open(file) as image:
+            image.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        path = qr.image.name
+        qr.delete()
+        enqueue("storage.delete", path=path)
+
+
+@register("snapshot.refresh")
+def refresh_snapshot(family_id, shard=DEFAULT_DB_ALIAS):
+    # NumPy is only imported by the worker that needs it.
+    from .ledger import refresh
+
+    cache.delete(PENDING_KEY.format(family_id=family_id))
+    if not Family.objects.using(shard).filter(id=family_id).exists():
+        return
+    with sharding.use_shard(shard):
+        refresh(family_id)
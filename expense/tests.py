@@ -1,3 +1,1426 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipIf
 
-# Create your tests here.
+import numpy as np
+from django.contrib import admin as django_admin
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, router
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.utils import timezone
+
+from . import (
+    admin,
+    budgets,
+    categorizer,
+    currency,
+    duplicates,
+    events,
+    forecasting,
+    idempotency,
+    jobs,
+    ledger,
+    middleware,
+    partitioning,
+    profiling,
+    ratelimit,
+    record_pages,
+    recurring,
+    routers,
+    sharding,
+    snapshots,
+    views,
+)
+from .analysis import CATEGORY_CODES, HISTORY_DTYPE, detect_outliers, detect_spikes
+from .backends import CachedModelBackend
+from .models import (
+    Budget,
+    BudgetAlert,
+    BudgetTotal,
+    ExchangeRate,
+    Family,
+    FamilyShard,
+    Job,
+    Record,
+    RecurringRecord,
+    ShardMembership,
+    Statement,
+)
+
+
+class CachedUserTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("cached", "cached@example.com", "old-password")
+        self.backend = CachedModelBackend()
+
+    def test_password_change_drops_the_cached_user(self):
+        self.backend.get_user(self.user.pk)
+        self.user.set_password("new-password")
+        self.user.save()
+        self.assertTrue(self.backend.get_user(self.user.pk).check_password("new-password"))
+
+    def test_deactivated_user_is_not_served(self):
+        self.backend.get_user(self.user.pk)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_logout_drops_the_cached_user(self):
+        self.client.force_login(self.user)
+        self.backend.get_user(self.user.pk)
+        # Changed behind the ORM's back, e.g. by another deployment
+        User.objects.filter(pk=self.user.pk).update(first_name="Renamed")
+        self.client.logout()
+        self.assertEqual(self.backend.get_user(self.user.pk).first_name, "Renamed")
+
+
+class EventTests(SimpleTestCase):
+    def test_event_frame(self):
+        frame = events._format_event({"type": "record.created", "id": 7})
+        self.assertEqual(frame, 'event: record.created\ndata: {"type": "record.created", "id": 7}\n\n')
+
+    async def test_local_backend_delivers_to_the_family_until_unsubscribed(self):
+        backend = events.LocalBackend()
+        queue = backend.subscribe(1)
+        other = backend.subscribe(2)
+        backend.publish(1, {"type": "record.created"})
+        self.assertEqual(await asyncio.wait_for(queue.get(), 1), {"type": "record.created"})
+        self.assertTrue(other.empty())
+
+        backend.unsubscribe(1, queue)
+        backend.publish(1, {"type": "record.deleted"})
+        await asyncio.sleep(0)
+        self.assertTrue(queue.empty())
+        self.assertNotIn(1, backend._subscribers)
+        self.assertIn(2, backend._subscribers)
+
+    async def test_stream_frames_events_and_unsubscribes_when_closed(self):
+        backend = events.LocalBackend()
+        with mock.patch.object(events, "_broker", backend):
+            stream = events.family_event_stream(3)
+            self.assertEqual(await anext(stream), "retry: 5000\n\n")
+            backend.publish(3, {"type": "member.added"})
+            self.assertEqual(await anext(stream), events._format_event({"type": "member.added"}))
+            await stream.aclose()
+        self.assertEqual(backend._subscribers, {})
+
+    @override_settings(EVENTS_HEARTBEAT_SECONDS=0.01)
+    async def test_idle_stream_sends_keepalives(self):
+        with mock.patch.object(events, "_broker", events.LocalBackend()):
+            stream = events.family_event_stream(4)
+            await anext(stream)
+            self.assertEqual(await anext(stream), ": keepalive\n\n")
+            await stream.aclose()
+
+
+class EventViewTests(TestCase):
+    def test_wsgi_request_is_told_not_to_reconnect(self):
+        user = User.objects.create_user("listener", "listener@example.com", "x")
+        family = Family.objects.create(name="Streamed")
+        family.add_member(user)
+        self.client.force_login(user)
+        response = self.client.get(f"/families/{family.pk}/events/")
+        self.assertEqual(response.status_code, 204)
+
+    async def test_asgi_request_gets_the_stream(self):
+        user = await User.objects.acreate_user("streamer", "streamer@example.com", "x")
+        family = await Family.objects.acreate(name="Streaming")
+        await family.members.aadd(user)
+        await self.async_client.aforce_login(user)
+        response = await self.async_client.get(f"/families/{family.pk}/events/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b"retry: 5000\n\n")
+        await stream.aclose()
+
+
+class PartitioningTests(TransactionTestCase):
+    def test_partition_round_trip_keeps_indexes(self):
+        def indexes():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT indexname FROM pg_indexes WHERE tablename = %s", [partitioning.TABLE]
+                )
+                return {name for name, in cursor.fetchall()}
+
+        before = indexes()
+        self.assertTrue(partitioning.partition_table("yearly", using="default"))
+        try:
+            self.assertEqual(len(partitioning.ensure_partitions("yearly", 1, using="default")), 1)
+            self.assertLessEqual(before, indexes())
+            family = Family.objects.create(name="Partitioned")
+            Record.objects.create(family=family, name="rent", amount=1)
+        finally:
+            self.assertTrue(partitioning.unpartition_table(using="default"))
+        self.assertEqual(indexes(), before)
+        self.assertEqual(Record.objects.get().name, "rent")
+
+
+class RecurringTests(TestCase):
+    def test_rerun_does_not_duplicate_occurrences(self):
+        family = Family.objects.create(name="Rent")
+        schedule = RecurringRecord.objects.create(
+            family=family,
+            name="rent",
+            amount=100,
+            schedule="0 0 * * *",
+            starts_at=timezone.now() - timedelta(days=3),
+        )
+        first_run = schedule.next_run_at
+        self.assertEqual(recurring.materialize_due(), (1, 3))
+        # As seen by a scheduler that read the schedule before the first run
+        RecurringRecord.objects.filter(pk=schedule.pk).update(next_run_at=first_run)
+        recurring.materialize_due()
+        self.assertEqual(Record.objects.filter(recurring=schedule).count(), 3)
+
+
+class ExchangeRateTests(TestCase):
+    def setUp(self):
+        ExchangeRate.objects.create(currency="HKD", rate=7.8)
+        currency.bump_version()
+
+    @override_settings(EXCHANGE_RATE_CHECK_SECONDS=0)
+    def test_changes_from_other_processes_are_seen(self):
+        self.assertEqual(currency.get_rates()["HKD"], 7.8)
+        # Written like load_exchange_rates does, without signals
+        ExchangeRate.objects.filter(currency="HKD").update(rate=7.5, updated_at=timezone.now())
+        self.assertEqual(currency.get_rates()["HKD"], 7.5)
+        ExchangeRate.objects.filter(currency="HKD").delete()
+        self.assertNotIn("HKD", currency.get_rates())
+
+    @override_settings(EXCHANGE_RATE_CHECK_SECONDS=3600)
+    def test_writes_in_this_process_are_seen_at_once(self):
+        currency.get_rates()
+        rate = ExchangeRate.objects.get(currency="HKD")
+        rate.rate = 8.0
+        rate.save()
+        self.assertEqual(currency.get_rates()["HKD"], 8.0)
+
+
+class BudgetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("spender", "spender@example.com", "x")
+        self.family = Family.objects.create(name="Budgeted", currency="HKD")
+        self.family.add_member(self.user)
+
+    def record(self, amount, category="food", **fields):
+        return Record.objects.create(
+            family=self.family, who=self.user, name="x", amount=amount, category=category, **fields
+        )
+
+    def totals(self):
+        return {
+            (t.category, t.member_id): t.total
+            for t in BudgetTotal.objects.filter(family=self.family)
+        }
+
+    def test_totals_follow_record_writes(self):
+        food = Budget.objects.create(family=self.family, category="food", amount=100)
+        overall = Budget.objects.create(family=self.family, member=self.user, amount=500)
+        lunch = self.record(30)
+        self.record(20, category="transport")
+        lunch.amount, lunch.category = 45, "health"
+        lunch.save()
+        self.record(10)
+
+        status = {budget.pk: (spent, ratio) for budget, spent, ratio in budgets.budget_status(self.family)}
+        self.assertEqual(status[food.pk], (10, 0.1))
+        self.assertEqual(status[overall.pk], (75, 0.15))
+
+        lunch.delete()
+        self.assertEqual(
+            self.totals(),
+            {
+                ("food", self.user.pk): 10, ("food", 0): 10,
+                ("transport", self.user.pk): 20, ("transport", 0): 20,
+                ("health", self.user.pk): 0, ("health", 0): 0,
+                ("", self.user.pk): 30, ("", 0): 30,
+            },
+        )
+
+    def test_rebuild_matches_the_running_totals(self):
+        self.record(12)
+        self.record(8, category="rent", created_at=timezone.now() - timedelta(days=40))
+        running = self.totals()
+        BudgetTotal.objects.all().delete()
+        budgets.rebuild_totals("default")
+        self.assertEqual(self.totals(), running)
+
+    def test_alerts_fire_once_per_threshold(self):
+        budget = Budget.objects.create(family=self.family, category="food", amount=100)
+        with mock.patch.object(events, "get_broker") as get_broker:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.record(50)
+                self.record(35)
+                self.record(5)
+                self.record(20, category="transport")
+                self.record(15)
+        alerts = list(BudgetAlert.objects.filter(budget=budget).values_list("threshold", "total"))
+        self.assertEqual(sorted(alerts), [(0.8, 85), (1.0, 105)])
+        published = [
+            call.args[1]
+            for call in get_broker.return_value.publish.call_args_list
+            if call.args[1]["type"] == "budget.alert"
+        ]
+        self.assertEqual([event["threshold"] for event in published], [0.8, 1.0])
+
+    def test_refunds_do_not_fire_alerts(self):
+        budget = Budget.objects.create(family=self.family, category="food", amount=100)
+        lunch = self.record(90)
+        BudgetAlert.objects.all().delete()
+        lunch.amount = 70
+        lunch.save()
+        self.assertFalse(BudgetAlert.objects.filter(budget=budget).exists())
+
+    def test_currency_change_rebuilds_totals(self):
+        ExchangeRate.objects.create(currency="HKD", rate=8.0)
+        currency.bump_version()
+        self.record(80, currency="HKD")
+        self.record(5, currency="USD")
+        self.assertEqual(self.totals()[("", 0)], 120)
+
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(
+                f"/families/{self.family.pk}/", {"currency": "USD"}, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.totals()[("", 0)], 15)
+        self.assertEqual(self.totals()[("food", self.user.pk)], 15)
+
+    def test_recurring_occurrences_inserted_elsewhere_are_not_counted_twice(self):
+        schedule = RecurringRecord.objects.create(
+            family=self.family,
+            name="rent",
+            amount=100,
+            schedule="0 0 * * *",
+            starts_at=timezone.now() - timedelta(days=1),
+        )
+        occurrence = schedule.next_run_at
+        real_bulk_create = Record.objects.bulk_create
+
+        def racing_bulk_create(records, **kwargs):
+            # Another scheduler inserts the occurrence first.
+            self.record(100, category="", recurring=schedule, created_at=occurrence)
+            return real_bulk_create(records, **kwargs)
+
+        with mock.patch.object(Record.objects, "bulk_create", racing_bulk_create):
+            recurring.materialize_batch()
+
+        self.assertEqual(Record.objects.filter(recurring=schedule).count(), 1)
+        self.assertEqual(self.totals()[("", 0)], 100)
+
+
+def _history(rows):
+    """HISTORY_DTYPE array from ``(family, category, month, amount)`` rows."""
+    return np.array(
+        [
+            (family, i, amount, category, 0, month, float(i))
+            for i, (family, category, month, amount) in enumerate(rows)
+        ],
+        dtype=HISTORY_DTYPE,
+    )
+
+
+class AnomalyTests(SimpleTestCase):
+    def test_uncategorized_spike_keeps_its_family(self):
+        history = _history(
+            [(7, -1, month, 10.0) for month in range(24300, 24306)] + [(7, -1, 24306, 100.0)]
+        )
+        [spike] = detect_spikes(history)
+        self.assertEqual(spike["family_id"], 7)
+        self.assertEqual(spike["category"], "")
+        self.assertEqual(spike["total"], 100.0)
+
+    def test_categorized_spike(self):
+        code = CATEGORY_CODES["food"]
+        history = _history(
+            [(3, code, month, 10.0) for month in range(24300, 24306)] + [(3, code, 24306, 50.0)]
+        )
+        [spike] = detect_spikes(history)
+        self.assertEqual((spike["family_id"], spike["category"]), (3, "food"))
+
+    def test_outliers_are_grouped_per_family(self):
+        # Family 6's last category and family 7's uncategorized records
+        # must not be scored together.
+        last = len(CATEGORY_CODES) - 1
+        history = _history(
+            [(6, last, 24300, 1000.0) for _ in range(10)]
+            + [(7, -1, 24300, 10.0) for _ in range(10)]
+        )
+        self.assertEqual(detect_outliers(history), [])
+
+
+class ForecastTests(TestCase):
+    def setUp(self):
+        forecasting.cache.clear()
+
+    @override_settings(CACHE_SHARED=True, FORECAST_CACHE_SECONDS=60)
+    def test_forecasts_expire(self):
+        family = Family.objects.create(name="Forecasts")
+        with mock.patch.object(forecasting.cache, "set") as cache_set:
+            forecasting.family_forecast(family.pk)
+        self.assertEqual(cache_set.call_args.args[2], 60)
+
+    @override_settings(CACHE_SHARED=True)
+    def test_record_writes_drop_the_cached_forecast(self):
+        family = Family.objects.create(name="Forecasts")
+        self.assertEqual(forecasting.family_forecast(family.pk)["categories"], [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Record.objects.create(family=family, name="x", amount=30, category="food")
+        spent = {
+            c["category"]: c["spent_this_month"]
+            for c in forecasting.family_forecast(family.pk)["categories"]
+        }
+        self.assertEqual(spent, {"": 30, "food": 30})
+
+    @override_settings(CACHE_SHARED=False)
+    def test_forecasts_are_not_cached_in_a_per_process_cache(self):
+        family = Family.objects.create(name="Forecasts")
+        forecasting.family_forecast(family.pk)
+        # Written by another process, e.g. the job runner
+        BudgetTotal.objects.create(
+            family=family, period=budgets.period_of(timezone.now()), category="", total=40
+        )
+        categories = forecasting.family_forecast(family.pk)["categories"]
+        self.assertEqual([c["spent_this_month"] for c in categories], [40])
+
+
+class NaiveBayesTests(SimpleTestCase):
+    def test_removing_an_unseen_record_keeps_counts_non_negative(self):
+        model = categorizer.NaiveBayes()
+        model.update(["bus"], "transport")
+        model.update(["train"], "transport")
+        model.update(["taxi"], "transport", -1)
+        model.update(["pizza"], "food", -1)
+        self.assertEqual(model.documents["transport"], 1)
+        self.assertEqual(model.documents["food"], 0)
+        self.assertNotIn("taxi", model.token_counts)
+        self.assertEqual(set(model.probabilities(["taxi", "home"])), {"transport"})
+
+    def test_learn_and_unlearn(self):
+        model = categorizer.NaiveBayes()
+        model.update(["bus"], "transport")
+        model.update(["lunch"], "food")
+        model.update(["lunch"], "food", -1)
+        self.assertEqual(model.token_counts["lunch"]["food"], 0)
+        self.assertEqual(set(model.probabilities(["lunch"])), {"transport"})
+
+
+class CategorizerTests(TestCase):
+    def setUp(self):
+        categorizer._family_models.clear()
+        categorizer._global_model = None
+        self.user = User.objects.create_user("cat", "cat@example.com", "x")
+        self.family = Family.objects.create(name="Cats")
+        self.family.add_member(self.user)
+
+    def tearDown(self):
+        categorizer._family_models.clear()
+        categorizer._global_model = None
+
+    def _record(self, name, category):
+        return Record.objects.create(family=self.family, name=name, category=category, amount=1)
+
+    def test_record_writes_update_the_loaded_model(self):
+        model = categorizer.retrain(self.family.pk)
+        record = self._record("bus", "transport")
+        self.assertEqual(model.token_counts["bus"]["transport"], 1)
+        record.category = "food"
+        record.save()
+        self.assertEqual(model.token_counts["bus"]["transport"], 0)
+        self.assertEqual(model.token_counts["bus"]["food"], 1)
+        record.delete()
+        self.assertEqual(model.documents["food"], 0)
+
+    def test_records_outside_the_training_window_are_ignored(self):
+        old = self._record("taxi", "transport")
+        self._record("bus", "transport")
+        self._record("train", "transport")
+        with mock.patch.object(categorizer, "GLOBAL_TRAINING_LIMIT", 2):
+            model = categorizer.retrain(categorizer.GLOBAL)
+        self.assertGreater(model.min_id, old.pk)
+        old.delete()
+        self.assertEqual(model.documents["transport"], 2)
+
+    def test_suggest_does_not_train_in_the_request(self):
+        self._record("bus", "transport")
+        with mock.patch.object(categorizer, "_retrain_in_background") as background:
+            self.assertEqual(categorizer.suggest(self.family.pk, "bus"), [])
+        background.assert_any_call(self.family.pk)
+        background.assert_any_call(categorizer.GLOBAL)
+
+        categorizer.retrain(self.family.pk)
+        with mock.patch.object(categorizer, "_retrain_in_background") as background:
+            [(category, _)] = categorizer.suggest(self.family.pk, "bus")
+        self.assertEqual(category, "transport")
+        background.assert_called_once_with(categorizer.GLOBAL)
+
+    def test_one_training_per_model_at_a_time(self):
+        with mock.patch.object(categorizer.threading, "Thread") as thread:
+            categorizer._retrain_in_background(self.family.pk)
+            categorizer._retrain_in_background(self.family.pk)
+        self.assertEqual(thread.call_count, 1)
+        categorizer._training.clear()
+
+
+class JobTests(TestCase):
+    def test_stale_job_on_its_last_attempt_fails(self):
+        job = jobs.enqueue("storage.delete", max_attempts=2, path="")
+        stale = timezone.now() - timedelta(hours=1)
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.STATUS_RUNNING, attempts=2, locked_at=stale, locked_by="gone:1"
+        )
+        self.assertEqual(jobs.claim("worker", 10), [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+        self.assertIsNone(job.locked_at)
+
+    def test_stale_job_with_attempts_left_is_reclaimed(self):
+        job = jobs.enqueue("storage.delete", max_attempts=3, path="")
+        stale = timezone.now() - timedelta(hours=1)
+        Job.objects.filter(pk=job.pk).update(
+            status=Job.STATUS_RUNNING, attempts=1, locked_at=stale, locked_by="gone:1"
+        )
+        [claimed] = jobs.claim("worker", 10)
+        self.assertEqual((claimed.pk, claimed.attempts), (job.pk, 2))
+
+
+class JobWorkerTests(TransactionTestCase):
+    def test_worker_survives_a_job_that_breaks_it(self):
+        broken = jobs.enqueue("storage.delete", path="")
+        fine = jobs.enqueue("storage.delete", path="")
+
+        def run(job_id):
+            if job_id == broken.pk:
+                raise RuntimeError("worker died")
+            return jobs.run(job_id)
+
+        stderr = StringIO()
+        with mock.patch("expense.management.commands.run_jobs.run", run):
+            call_command(
+                "run_jobs", once=True, pool="thread", workers=1, stdout=StringIO(), stderr=stderr
+            )
+        self.assertIn(f"Job {broken.pk}", stderr.getvalue())
+        self.assertEqual(Job.objects.get(pk=fine.pk).status, Job.STATUS_DONE)
+
+
+class ReplicaTestCase(SimpleTestCase):
+    """Runs with ``replica1`` configured, a second alias for the test database."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        connections.settings["replica1"] = {**connections.settings["default"]}
+
+    @classmethod
+    def tearDownClass(cls):
+        del connections.settings["replica1"]
+        super().tearDownClass()
+
+    def setUp(self):
+        self.addCleanup(routers.restore_pin, routers.set_pin(0.0))
+
+
+class ReplicaRouterTests(ReplicaTestCase):
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(routers.replicas(), ["replica1"])
+        self.assertEqual(routers.ReplicaRouter().db_for_read(Record), "replica1")
+
+    def test_writes_pin_reads_to_the_primary(self):
+        replica_router = routers.ReplicaRouter()
+        self.assertEqual(replica_router.db_for_write(Record), "default")
+        self.assertTrue(routers.is_pinned())
+        self.assertEqual(replica_router.db_for_read(Record), "default")
+
+    @override_settings(DATABASE_STICKY_SECONDS=5)
+    def test_pin_expires(self):
+        routers.pin_to_primary()
+        self.assertAlmostEqual(routers.pinned_until(), time.time() + 5, delta=1)
+        routers.set_pin(time.time() - 1)
+        self.assertEqual(routers.ReplicaRouter().db_for_read(Record), "replica1")
+
+    def test_reads_in_a_transaction_stay_on_the_primary(self):
+        with mock.patch.object(connections["default"], "in_atomic_block", True):
+            self.assertEqual(routers.ReplicaRouter().db_for_read(Record), "default")
+
+
+@override_settings(
+    DATABASE_ROUTERS=["expense.routers.ReplicaRouter"], DATABASE_STICKY_SECONDS=5
+)
+class ReplicaStickinessMiddlewareTests(ReplicaTestCase):
+    def call(self, view, cookie=None):
+        request = RequestFactory().get("/")
+        if cookie is not None:
+            request.COOKIES[middleware.STICKY_COOKIE] = cookie
+        return middleware.ReplicaStickinessMiddleware(view)(request)
+
+    def reading(self, request):
+        return HttpResponse(router.db_for_read(Record))
+
+    def writing(self, request):
+        return HttpResponse(router.db_for_write(Record))
+
+    def test_a_write_sets_the_cookie(self):
+        response = self.call(self.writing)
+        cookie = response.cookies[middleware.STICKY_COOKIE]
+        self.assertAlmostEqual(float(cookie.value), time.time() + 5, delta=1)
+        self.assertEqual(cookie["max-age"], 5)
+        # The pin ends with the request.
+        self.assertFalse(routers.is_pinned())
+
+    def test_reads_after_a_write_go_to_the_primary(self):
+        cookie = self.call(self.writing).cookies[middleware.STICKY_COOKIE].value
+        response = self.call(self.reading, cookie)
+        self.assertEqual(response.content, b"default")
+        # Reads don't extend the window.
+        self.assertNotIn(middleware.STICKY_COOKIE, response.cookies)
+
+    def test_expired_or_malformed_cookie_is_ignored(self):
+        self.assertEqual(self.call(self.reading, f"{time.time() - 1:.3f}").content, b"replica1")
+        self.assertEqual(self.call(self.reading, "soon").content, b"replica1")
+        self.assertEqual(self.call(self.reading).content, b"replica1")
+
+    def test_does_nothing_without_replicas(self):
+        del connections.settings["replica1"]
+        try:
+            response = self.call(self.writing)
+        finally:
+            connections.settings["replica1"] = {**connections.settings["default"]}
+        self.assertNotIn(middleware.STICKY_COOKIE, response.cookies)
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(PROFILE_DIR=directory.name))
+        self.reports = Path(directory.name)
+        self.staff = User.objects.create_user("ops", "ops@example.com", "x", is_staff=True)
+        self.user = User.objects.create_user("member", "member@example.com", "x")
+
+    def test_staff_opt_in_is_profiled(self):
+        self.client.force_login(self.staff)
+        response = self.client.get("/families/", {profiling.QUERY_PARAM: "1"})
+        report_id = response["X-Profile-Id"]
+        self.assertTrue(self.client.get("/families/", HTTP_X_PROFILE="1").has_header("X-Profile-Id"))
+
+        report = self.client.get(f"/profiles/{report_id}/").json()
+        self.assertEqual((report["path"], report["user_id"]), ("/families/?_profile=1", self.staff.pk))
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(f"/profiles/{report_id}/").status_code, 403)
+
+    def test_staff_without_the_opt_in_is_not_profiled(self):
+        self.client.force_login(self.staff)
+        self.assertFalse(self.client.get("/families/").has_header("X-Profile-Id"))
+        for params in ({"profile": "1"}, {"q": profiling.QUERY_PARAM}):
+            self.assertFalse(self.client.get("/families/", params).has_header("X-Profile-Id"))
+        self.assertEqual(list(self.reports.iterdir()), [])
+
+    def test_non_staff_are_not_profiled(self):
+        for user in (self.user, None):
+            if user is None:
+                self.client.logout()
+            else:
+                self.client.force_login(user)
+            response = self.client.get("/families/", {profiling.QUERY_PARAM: "1"})
+            self.assertFalse(response.has_header("X-Profile-Id"))
+            response = self.client.get("/families/", HTTP_X_PROFILE="1")
+            self.assertFalse(response.has_header("X-Profile-Id"))
+        self.assertEqual(list(self.reports.iterdir()), [])
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        family = Family.objects.create(name="Counted")
+        for i in range(3):
+            Record.objects.create(family=family, name=f"r{i}", amount=i)
+
+    def count(self, queryset, estimate):
+        with mock.patch.object(admin, "estimated_row_count", return_value=estimate):
+            return admin.EstimatedCountPaginator(queryset.order_by("id"), 50).count
+
+    def test_small_table_is_counted_exactly(self):
+        self.assertEqual(self.count(Record.objects.all(), admin.EXACT_COUNT_LIMIT - 1), 3)
+
+    def test_large_unfiltered_table_uses_the_estimate(self):
+        self.assertEqual(self.count(Record.objects.all(), 123456), 123456)
+
+    def test_filtered_changelist_is_counted_exactly(self):
+        self.assertEqual(self.count(Record.objects.filter(name="r1"), 123456), 1)
+
+
+class RecategorizeTests(TestCase):
+    def setUp(self):
+        categorizer._family_models.clear()
+        categorizer._global_model = None
+        self.addCleanup(categorizer._family_models.clear)
+        self.user = User.objects.create_user("admin", "admin@example.com", "x", is_staff=True)
+        self.families = [Family.objects.create(name=name) for name in ("A", "B")]
+        for family in self.families:
+            family.add_member(self.user)
+            Record.objects.create(family=family, who=self.user, name="bus", amount=3, category="food")
+            Record.objects.create(
+                family=family, name="taxi", amount=9, category="transport",
+                created_at=timezone.now() - timedelta(days=40),
+            )
+            Record.objects.create(family=family, who=self.user, name="rent", amount=50, category="rent")
+
+    def totals(self):
+        # Emptied rows are kept by the running totals but not rebuilt.
+        return sorted(
+            BudgetTotal.objects.exclude(total=0).values_list(
+                "family_id", "period", "category", "member_id", "total"
+            )
+        )
+
+    def test_recategorize_matches_per_record_writes(self):
+        model = categorizer.retrain(self.families[0].pk)
+        request = RequestFactory().post("/")
+        request.user = self.user
+        record_admin = admin.RecordAdmin(Record, django_admin.site)
+        queryset = Record.objects.exclude(name="rent")
+        with mock.patch.object(events, "get_broker") as get_broker, mock.patch.object(
+            record_admin, "message_user"
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                record_admin.recategorize(request, queryset, "health")
+
+        running = self.totals()
+        BudgetTotal.objects.all().delete()
+        budgets.rebuild_totals("default")
+        self.assertEqual(running, self.totals())
+        self.assertEqual(Record.objects.filter(category="health").count(), 4)
+
+        self.assertEqual(model.token_counts["bus"]["food"], 0)
+        self.assertEqual(model.token_counts["bus"]["health"], 1)
+        self.assertEqual(model.documents["health"], 2)
+
+        published = {
+            call.args[0]: call.args[1] for call in get_broker.return_value.publish.call_args_list
+        }
+        self.assertEqual(set(published), {family.pk for family in self.families})
+        self.assertEqual(published[self.families[0].pk]["type"], "record.updated")
+        self.assertEqual(len(published[self.families[0].pk]["record_ids"]), 2)
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        ratelimit._store = None
+
+    def tearDown(self):
+        ratelimit._store = None
+
+    @override_settings(
+        RATE_LIMIT_ENABLED=True,
+        RATE_LIMITS={
+            "api": {"rate": "2/m", "keys": ["user"]},
+            "suggestions": {"rate": "3/m", "keys": ["user"]},
+        },
+    )
+    def test_typing_does_not_use_up_the_api_bucket(self):
+        user = User.objects.create_user("typist", "typist@example.com", "x")
+        family = Family.objects.create(name="Typing")
+        family.add_member(user)
+        self.client.force_login(user)
+        suggestions = f"/families/{family.pk}/category-suggestions/?name=bus"
+        for _ in range(3):
+            self.assertEqual(self.client.get(suggestions).status_code, 200)
+        self.assertEqual(self.client.get(suggestions).status_code, 429)
+        self.assertEqual(self.client.get(f"/families/{family.pk}/").status_code, 200)
+
+    def test_memory_store_prunes_idle_buckets_from_the_front(self):
+        store = ratelimit.MemoryStore()
+        with mock.patch.object(ratelimit, "MEMORY_STORE_MAX_KEYS", 2):
+            store.take("old", 5, 1, 0)
+            store.take("recent", 5, 1, 3000)
+            store.take("new", 5, 1, 4000)
+        self.assertEqual(list(store.buckets), ["recent", "new"])
+
+    def test_memory_store_rejects_an_empty_bucket(self):
+        store = ratelimit.MemoryStore()
+        self.assertEqual(store.take("key", 1, 1 / 60, 0), 0)
+        self.assertAlmostEqual(store.take("key", 1, 1 / 60, 0), 60)
+
+
+@override_settings(COMPRESSION_ENABLED=True, COMPRESSION_MIN_SIZE=100)
+class CompressionMiddlewareTests(SimpleTestCase):
+    body = b'{"records": []}' * 20
+
+    def call(self, response, accept="gzip, br"):
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING=accept)
+        return middleware.CompressionMiddleware(lambda request: response)(request)
+
+    @skipIf(middleware.brotli is None, "brotli is not installed")
+    def test_negotiation_prefers_brotli_then_gzip(self):
+        self.assertIs(middleware.negotiate_encoder("gzip, br"), middleware.BrotliEncoder)
+        self.assertIs(middleware.negotiate_encoder("br;q=0.5, gzip"), middleware.GzipEncoder)
+        self.assertIs(middleware.negotiate_encoder("br;q=0, *"), middleware.GzipEncoder)
+        self.assertIsNone(middleware.negotiate_encoder("identity"))
+        self.assertIsNone(middleware.negotiate_encoder(""))
+
+    def test_compresses_large_bodies(self):
+        response = self.call(HttpResponse(self.body, content_type="application/json"), "gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+        self.assertEqual(int(response["Content-Length"]), len(response.content))
+        self.assertEqual(zlib.decompress(response.content, 31), self.body)
+
+    def test_identity_when_nothing_is_accepted(self):
+        response = self.call(HttpResponse(self.body, content_type="application/json"), "identity")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response.content, self.body)
+
+    def test_skips_small_bodies(self):
+        response = self.call(HttpResponse(b"{}", content_type="application/json"))
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response.content, b"{}")
+
+    def test_skips_event_streams(self):
+        response = self.call(
+            StreamingHttpResponse(iter([b"data: 1\n\n"]), content_type="text/event-stream")
+        )
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(b"".join(response.streaming_content), b"data: 1\n\n")
+
+    def test_streams_are_flushed_chunk_by_chunk(self):
+        chunks = [b"date,amount\n", b"2026-01-01,12.50\n" * 10, b"2026-01-02,3.00\n"]
+        response = self.call(StreamingHttpResponse(iter(chunks), content_type="text/csv"), "gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertFalse(response.has_header("Content-Length"))
+        decompressor = zlib.decompressobj(31)
+        for chunk, compressed in zip(chunks, response.streaming_content):
+            # Each chunk decodes as soon as it arrives.
+            self.assertEqual(decompressor.decompress(compressed), chunk)
+
+    @skipIf(middleware.brotli is None, "brotli is not installed")
+    async def test_async_streams_are_compressed(self):
+        async def chunks():
+            yield b"a" * 200
+            yield b"b" * 200
+
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="br")
+
+        async def view(request):
+            return StreamingHttpResponse(chunks(), content_type="text/plain")
+
+        response = await middleware.CompressionMiddleware(view)(request)
+        self.assertEqual(response["Content-Encoding"], "br")
+        compressed = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(middleware.brotli.decompress(compressed), b"a" * 200 + b"b" * 200)
+
+
+class RecordPageTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user("pages", "pages@example.com", "x")
+        self.family = Family.objects.create(name="Pages")
+        self.record = Record.objects.create(
+            family=self.family, who=user, name="groceries", amount=1
+        )
+
+    @override_settings(CACHE_SHARED=False)
+    def test_pages_are_not_cached_without_a_shared_cache(self):
+        self.assertIn("groceries", record_pages.render_page([self.family]))
+        # As another process would: no signal reaches this one.
+        Record.objects.filter(pk=self.record.pk).update(name="market")
+        self.assertIn("market", record_pages.render_page([self.family]))
+
+    @override_settings(CACHE_SHARED=False)
+    def test_records_without_a_member(self):
+        Record.objects.filter(pk=self.record.pk).update(who=None)
+        self.assertIn("Unknown", record_pages.render_page([self.family]))
+
+    @override_settings(CACHE_SHARED=True)
+    def test_writes_drop_cached_pages(self):
+        self.assertIn("groceries", record_pages.render_page([self.family]))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.record.name = "market"
+            self.record.save()
+        self.assertIn("market", record_pages.render_page([self.family]))
+
+
+SHARD = "shard_test"
+
+
+@override_settings(
+    SHARDS=["default", SHARD], DATABASE_ROUTERS=["expense.routers.ShardRouter"]
+)
+class ShardedTestCase(TransactionTestCase):
+    """Runs with a second shard, a test database created for the class."""
+
+    # Resolved in setUpClass, once the shard's alias exists
+    databases = "__all__"
+
+    @classmethod
+    def setUpClass(cls):
+        default = connections.settings["default"]
+        connections.settings[SHARD] = {
+            **default,
+            "TEST": {**default["TEST"], "NAME": f"{default['NAME']}_shard"},
+        }
+        super().setUpClass()
+        cls._shard_name = connections[SHARD].settings_dict["NAME"]
+        connections[SHARD].creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections[SHARD].creation.destroy_test_db(cls._shard_name, verbosity=0)
+        super().tearDownClass()
+        del connections[SHARD]
+        del connections.settings[SHARD]
+
+    def setUp(self):
+        # Directory lookups are cached.
+        sharding.cache.clear()
+
+
+class ShardingTests(ShardedTestCase):
+    def family_on(self, alias, name, *members):
+        with sharding.use_shard(alias):
+            family = Family.objects.create(name=name)
+        family.members.add(*members)
+        return family
+
+    def test_move_family(self):
+        user = User.objects.create_user("mover", "mover@example.com", "x")
+        family = self.family_on("default", "Moving", user)
+        schedule = RecurringRecord.objects.create(
+            family=family, who=user, name="rent", amount=100, schedule="0 0 1 * *"
+        )
+        Record.objects.create(family=family, who=user, name="rent", amount=100, recurring=schedule)
+        budget = Budget.objects.create(family=family, category="food", amount=10)
+        Record.objects.create(family=family, who=user, name="lunch", amount=12, category="food")
+        self.assertTrue(budget.alerts.exists())
+
+        self.assertEqual(sharding.move_family(family.pk, SHARD), 2)
+
+        self.assertEqual(sharding.family_shard(family.pk), SHARD)
+        self.assertEqual(FamilyShard.objects.get(id=family.pk).shard, SHARD)
+        moved = Family.objects.using(SHARD).get(id=family.pk)
+        self.assertEqual((moved.pid, moved.member_count), (family.pid, 1))
+        self.assertEqual(list(moved.members.values_list("id", flat=True)), [user.pk])
+        self.assertEqual(User.objects.using(SHARD).get(id=user.pk).password, "!")
+        records = Record.objects.using(SHARD).filter(family_id=family.pk)
+        self.assertEqual(sorted(records.values_list("name", flat=True)), ["lunch", "rent"])
+        new_schedule = RecurringRecord.objects.using(SHARD).get(family_id=family.pk)
+        self.assertEqual(records.get(name="rent").recurring_id, new_schedule.pk)
+        new_budget = Budget.objects.using(SHARD).get(family_id=family.pk)
+        self.assertTrue(BudgetAlert.objects.using(SHARD).filter(budget=new_budget).exists())
+        self.assertEqual(
+            BudgetTotal.objects.using(SHARD).get(family_id=family.pk, category="", member_id=0).total,
+            112,
+        )
+
+        for model in (Record, RecurringRecord, Budget, BudgetTotal):
+            self.assertFalse(model.objects.using("default").filter(family_id=family.pk).exists())
+        self.assertFalse(BudgetAlert.objects.using("default").exists())
+        self.assertFalse(Family.objects.using("default").filter(id=family.pk).exists())
+        self.assertFalse(
+            Family.members.through.objects.using("default").filter(family_id=family.pk).exists()
+        )
+        self.assertTrue(ShardMembership.objects.filter(family_id=family.pk, user=user).exists())
+
+    def test_moving_to_the_same_shard_does_nothing(self):
+        family = self.family_on(SHARD, "Staying")
+        self.assertEqual(sharding.move_family(family.pk, SHARD), 0)
+        self.assertTrue(Family.objects.using(SHARD).filter(id=family.pk).exists())
+
+    def test_locate_and_collect_search_the_users_shards(self):
+        user = User.objects.create_user("spread", "spread@example.com", "x")
+        stranger = User.objects.create_user("stranger", "stranger@example.com", "x")
+        near = self.family_on("default", "Near", user)
+        far = self.family_on(SHARD, "Far", user)
+        with sharding.use_shard(SHARD):
+            record = Record.objects.create(family=far, who=user, name="far away", amount=1)
+
+        families = sharding.collect(user, Family.objects.filter(members=user))
+        self.assertEqual(sorted(f.pk for f in families), sorted([near.pk, far.pk]))
+        self.assertEqual({f._state.db for f in families}, {"default", SHARD})
+
+        mine = Record.objects.filter(id=record.pk, family__members=user)
+        found = sharding.locate(user, mine)
+        self.assertEqual((found.name, found._state.db), ("far away", SHARD))
+        self.assertIsNone(
+            sharding.locate(stranger, Record.objects.filter(id=record.pk, family__members=stranger))
+        )
+
+    def test_family_views_find_the_shard_without_the_middleware(self):
+        user = User.objects.create_user("direct", "direct@example.com", "x")
+        family = self.family_on(SHARD, "Far", user)
+        request = RequestFactory().get(f"/families/{family.pk}/budgets/")
+        request.user = user
+        with override_settings(RATE_LIMIT_ENABLED=False):
+            response = views.budget_collection_api(request, family_id=family.pk)
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(SHARDS=["default", "shard1"])
+class ShardRouterTests(SimpleTestCase):
+    def test_migrations(self):
+        router = routers.ShardRouter()
+        self.assertTrue(router.allow_migrate("shard1", "expense", "record"))
+        self.assertTrue(router.allow_migrate("default", "expense", "familyshard"))
+        self.assertFalse(router.allow_migrate("shard1", "expense", "familyshard"))
+        # Replicas are left to ReplicaRouter.
+        self.assertIsNone(router.allow_migrate("replica1", "expense", "record"))
+
+
+@override_settings(DUPLICATE_WINDOW_SECONDS=60)
+class DuplicateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("twice", "twice@example.com", "x")
+        self.family = Family.objects.create(name="Dupes")
+        self.family.add_member(self.user)
+        # Ten seconds before a window boundary
+        self.start = datetime(2026, 1, 1, 0, 59, 50, tzinfo=dt_timezone.utc)
+
+    def record(self, seconds, name="Coffee", amount=4.5, **fields):
+        return Record.objects.create(
+            family=self.family,
+            name=name,
+            amount=amount,
+            created_at=self.start + timedelta(seconds=seconds),
+            **fields,
+        )
+
+    def duplicate_of(self, seconds, name="Coffee", amount=4.5):
+        candidate = Record(
+            family=self.family,
+            name=name,
+            amount=amount,
+            created_at=self.start + timedelta(seconds=seconds),
+        )
+        return duplicates.find_duplicate(candidate)
+
+    def post(self, **extra):
+        return self.client.post(
+            "/records/",
+            {
+                "family_id": self.family.pk,
+                "name": "Coffee",
+                "amount": 4.5,
+                "category": "food",
+                "description": "",
+                **extra,
+            },
+            content_type="application/json",
+        )
+
+    def test_repeated_post_is_rejected_with_the_original(self):
+        self.client.force_login(self.user)
+        first = self.post()
+        second = self.post()
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 409)
+        self.assertEqual(second.json()["duplicate_of"]["id"], first.json()["id"])
+        self.assertEqual(Record.objects.filter(family=self.family).count(), 1)
+
+    def test_allow_duplicate_saves_a_real_repeat(self):
+        self.client.force_login(self.user)
+        self.post()
+        self.assertEqual(self.post(allow_duplicate=True).status_code, 201)
+        self.assertEqual(Record.objects.filter(family=self.family).count(), 2)
+
+    def test_window_spans_bucket_boundaries(self):
+        stored = self.record(0)
+        self.assertNotEqual(
+            duplicates._bucket(stored.created_at),
+            duplicates._bucket(stored.created_at + timedelta(seconds=15)),
+        )
+        self.assertEqual(self.duplicate_of(15, name="  coffee "), stored)
+        self.assertEqual(self.duplicate_of(60), stored)
+        self.assertEqual(self.duplicate_of(-60), stored)
+        self.assertIsNone(self.duplicate_of(61))
+        self.assertIsNone(self.duplicate_of(-61))
+        self.assertIsNone(self.duplicate_of(15, amount=4.6))
+        self.assertIsNone(self.duplicate_of(15, name="Tea"))
+
+    def test_clusters_survive_pruning(self):
+        for seconds, name in (
+            (0, "x"), (5, "y"), (10, "z"), (50, "x"), (110, "x"),
+            (500, "w"), (505, "v"), (540, "x"), (560, "x"), (600, "y"),
+        ):
+            self.record(seconds, name=name)
+        with mock.patch.object(duplicates, "BATCH_SIZE", 3):
+            pruned = duplicates.find_clusters(self.family.pk)
+        expected = [[0, 50, 110], [540, 560]]
+        self.assertEqual(
+            [[(row["created_at"] - self.start).seconds for row in cluster] for cluster in pruned],
+            expected,
+        )
+        self.assertEqual(duplicates.find_clusters(self.family.pk), pruned)
+
+    def test_backfill_fingerprints_old_records(self):
+        old = self.record(0)
+        self.record(30)
+        Record.objects.update(fingerprint="")
+        self.assertIsNone(self.duplicate_of(10))
+
+        stdout, stderr = StringIO(), StringIO()
+        call_command("find_duplicates", "--backfill", stdout=stdout, stderr=stderr)
+        self.assertIn("Fingerprinted 2 records.", stderr.getvalue())
+        (line,) = stdout.getvalue().splitlines()
+        self.assertEqual(json.loads(line)["family_id"], self.family.pk)
+        old.refresh_from_db()
+        self.assertEqual(old.fingerprint, duplicates.fingerprint(old))
+        self.assertIsNotNone(self.duplicate_of(10))
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("retrier", "retrier@example.com", "x")
+        self.client.force_login(self.user)
+
+    def post(self, name, key):
+        return self.client.post(
+            "/families/",
+            {"name": name},
+            content_type="application/json",
+            headers={idempotency.HEADER: key},
+        )
+
+    def test_repeated_key_replays_the_first_response(self):
+        first = self.post("Replayed", "create-1")
+        second = self.post("Replayed", "create-1")
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(Family.objects.filter(name="Replayed").count(), 1)
+
+    def test_key_reused_for_a_different_body_is_rejected(self):
+        self.assertEqual(self.post("First", "create-2").status_code, 201)
+        response = self.post("Second", "create-2")
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(Family.objects.filter(name="Second").exists())
+
+    def test_keys_are_per_user(self):
+        self.assertEqual(self.post("Mine", "create-3").status_code, 201)
+        other = User.objects.create_user("other", "other@example.com", "x")
+        self.client.force_login(other)
+        response = self.post("Mine", "create-3")
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(Family.objects.filter(name="Mine").count(), 2)
+
+
+class IdempotencyRaceTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("racer", "racer@example.com", "x")
+        self.started, self.release = threading.Event(), threading.Event()
+        self.calls = 0
+
+        @idempotency.idempotent
+        def view(request):
+            self.calls += 1
+            self.started.set()
+            self.release.wait(10)
+            return JsonResponse({"call": self.calls}, status=201)
+
+        self.view = view
+
+    def request(self):
+        request = RequestFactory().post(
+            "/things/", {"name": "x"}, content_type="application/json",
+            headers={idempotency.HEADER: "race"},
+        )
+        request.user = self.user
+        return request
+
+    def call_in_thread(self, responses):
+        def call():
+            try:
+                responses.append(self.view(self.request()))
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=call)
+        thread.start()
+        return thread
+
+    def wait_for_lock_waiter(self):
+        # The second request queues on the first one's key row.
+        for _ in range(100):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT count(*) FROM pg_stat_activity "
+                    "WHERE wait_event_type = 'Lock' AND datname = current_database()"
+                )
+                if cursor.fetchone()[0]:
+                    return
+            time.sleep(0.05)
+        self.fail("The second request never waited for the first.")
+
+    def test_second_request_waits_and_replays(self):
+        first, second = [], []
+        threads = [self.call_in_thread(first)]
+        self.assertTrue(self.started.wait(5))
+        threads.append(self.call_in_thread(second))
+        self.wait_for_lock_waiter()
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(first[0].status_code, 201)
+        self.assertEqual(second[0].status_code, 201)
+        self.assertEqual(second[0]["Idempotent-Replayed"], "true")
+        self.assertEqual(second[0].content, first[0].content)
+
+    @override_settings(IDEMPOTENCY_WAIT_SECONDS=0.2)
+    def test_second_request_gives_up_with_409(self):
+        first, second = [], []
+        threads = [self.call_in_thread(first)]
+        self.assertTrue(self.started.wait(5))
+        threads.append(self.call_in_thread(second))
+        threads[1].join()
+        self.release.set()
+        threads[0].join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second[0].status_code, 409)
+        self.assertEqual(second[0]["Retry-After"], "1")
+        self.assertEqual(first[0].status_code, 201)
+
+
+class StatementTests(TransactionTestCase):
+    # Statements render in a worker pool, whose threads must see the records.
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media = media.name
+        overrides = override_settings(MEDIA_ROOT=self.media)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = User.objects.create_user("payer", "payer@example.com", "x", first_name="Pat")
+        # Created after the month, but it has spending in it
+        self.family = Family.objects.create(name="Statemented", currency="HKD")
+        self.family.add_member(self.user)
+        september = timezone.make_aware(datetime(2026, 9, 10, 12))
+        for name, amount, category, who in (
+            ("groceries", 30, "food", self.user),
+            ("bus pass", 12.5, "transport", self.user),
+            ("gift", 7.5, "", None),
+        ):
+            Record.objects.create(
+                family=self.family, name=name, amount=amount, category=category, who=who,
+                created_at=september,
+            )
+        # Another month, left out
+        Record.objects.create(
+            family=self.family, name="rent", amount=500, category="rent",
+            created_at=september + timedelta(days=30),
+        )
+
+    def generate(self, *args):
+        stdout = StringIO()
+        call_command(
+            "generate_statements", "--month", "2026-09", "--pool", "thread", "--workers", "2",
+            *args, stdout=stdout,
+        )
+        return stdout.getvalue()
+
+    def files(self):
+        directory = f"{self.media}/statements/{self.family.pid}"
+        return sorted(path.name for path in Path(directory).iterdir())
+
+    def test_statement_totals_match_the_records(self):
+        self.assertIn("rendered 1 statements", self.generate())
+        statement = Statement.objects.get(family=self.family)
+        self.assertEqual(f"{statement.period:%Y-%m}", "2026-09")
+        self.assertEqual((statement.total, statement.record_count), (50, 3))
+
+        with statement.file.open("rb") as file:
+            html = file.read().decode()
+        for row in (
+            "<strong>50.00</strong>",
+            '<td>Food</td><td class="num">30.00</td><td class="num">60%</td>',
+            '<td>Transport</td><td class="num">12.50</td><td class="num">25%</td>',
+            '<td>Uncategorized</td><td class="num">7.50</td><td class="num">15%</td>',
+            '<td>Pat</td><td class="num">42.50</td>',
+            '<td>Unassigned</td><td class="num">7.50</td>',
+        ):
+            self.assertIn(row, html)
+        self.assertNotIn("rent", html)
+
+    def test_rerun_is_idempotent(self):
+        self.generate()
+        first = Statement.objects.get(family=self.family)
+        self.assertIn("rendered 0 statements", self.generate())
+        self.assertEqual(Statement.objects.get(family=self.family).file.name, first.file.name)
+        self.assertEqual(len(self.files()), 1)
+
+        # Forced, the new file replaces the old one.
+        self.assertIn("rendered 1 statements", self.generate("--force"))
+        statement = Statement.objects.get(family=self.family)
+        self.assertEqual((statement.total, statement.record_count), (50, 3))
+        self.assertEqual(self.files(), [statement.file.name.rsplit("/", 1)[1]])
+
+    def test_current_month_is_refused(self):
+        with self.assertRaises(CommandError):
+            call_command("generate_statements", "--month", f"{timezone.localdate():%Y-%m}")
+
+    def test_members_can_list_and_open_statements(self):
+        self.generate()
+        self.client.force_login(self.user)
+        (listed,) = self.client.get(f"/families/{self.family.pk}/statements/").json()["statements"]
+        self.assertEqual((listed["period"], listed["total"]), ("2026-09", 50))
+        response = self.client.get(listed["url"])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"<strong>50.00</strong>", b"".join(response.streaming_content))
+
+        stranger = User.objects.create_user("nosy", "nosy@example.com", "x")
+        self.client.force_login(stranger)
+        self.assertEqual(self.client.get(listed["url"]).status_code, 404)
+
+
+class FamilyMemberTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f"member{i}", f"member{i}@example.com", "x") for i in range(5)
+        ]
+        self.family = Family.objects.create(name="Members")
+
+    def test_add_members_is_all_or_none(self):
+        self.assertEqual(self.family.add_members(self.users[:2]), self.users[:2])
+        self.assertIsNone(self.family.add_members(self.users[2:3]))
+        self.family.refresh_from_db()
+        self.assertEqual(self.family.member_count, 2)
+        self.assertEqual(self.family.members.count(), 2)
+
+    def test_capacity_follows_the_stored_level(self):
+        Family.objects.filter(pk=self.family.pk).update(level=2)
+        # self.family still says level 1
+        self.assertEqual(len(self.family.add_members(self.users[:4])), 4)
+        self.assertEqual(self.family.member_count, 4)
+
+    def test_deleting_a_user_frees_their_place(self):
+        self.family.add_members(self.users[:2])
+        self.users[0].delete()
+        self.family.refresh_from_db()
+        self.assertEqual(self.family.member_count, 1)
+        self.assertTrue(self.family.add_member(self.users[2])[0])
+
+
+class FamilyCapacityRaceTests(TransactionTestCase):
+    def test_concurrent_invites_respect_capacity(self):
+        family = Family.objects.create(name="Race")
+        family.add_member(User.objects.create_user("owner", "owner@example.com", "x"))
+        users = [
+            User.objects.create_user(f"racer{i}", f"racer{i}@example.com", "x") for i in range(8)
+        ]
+        barrier = threading.Barrier(len(users))
+        results = []
+
+        def invite(user):
+            try:
+                barrier.wait()
+                results.append(Family.objects.get(pk=family.pk).add_member(user)[0])
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=invite, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count(True), 1)
+        family.refresh_from_db()
+        self.assertEqual(family.member_count, 2)
+        self.assertEqual(family.members.count(), 2)
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        overrides = override_settings(SNAPSHOT_DIR=snapshot_dir.name)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.family = Family.objects.create(name="Ledger", currency="HKD")
+        self.records = [
+            Record.objects.create(family=self.family, name=name, amount=amount, category=category)
+            for name, amount, category in (
+                ("rice", 12, "food"),
+                ("bus", 4, "transport"),
+                ("cinema", 80, "entertainment"),
+            )
+        ]
+
+    def contents(self, opened):
+        """Rows of a ledger as tuples, with the strings decoded."""
+        strings = opened.strings
+        return [
+            (
+                *(int(opened[name][i]) for name in ("id", "ts", "month", "category", "member")),
+                float(opened["amount"][i]),
+                strings["currency"][opened["currency"][i]],
+                strings["name"][opened["name"][i]],
+            )
+            for i in range(len(opened))
+        ]
+
+    def assertRefreshMatchesRebuild(self):
+        ledger.refresh(self.family.pk)
+        refreshed = ledger.open_ledger(self.family.pk)
+        rows, names = self.contents(refreshed), sorted(refreshed.strings["name"])
+        rebuilt = ledger.build(self.family.pk)
+        self.assertEqual(rows, self.contents(rebuilt))
+        # No strings left over from renamed or deleted records
+        self.assertEqual(names, sorted(rebuilt.strings["name"]))
+
+    def test_refresh_after_insert(self):
+        ledger.build(self.family.pk)
+        Record.objects.create(family=self.family, name="taxi", amount=30, category="transport")
+        self.assertRefreshMatchesRebuild()
+
+    def test_refresh_after_update(self):
+        ledger.build(self.family.pk)
+        bus = self.records[1]
+        bus.name, bus.amount, bus.category, bus.currency = "tram", 3, "", "USD"
+        bus.save()
+        self.assertRefreshMatchesRebuild()
+
+    def test_refresh_after_delete(self):
+        ledger.build(self.family.pk)
+        self.records[2].delete()
+        self.assertRefreshMatchesRebuild()
+
+    def test_summary(self):
+        summary = ledger.summarize(ledger.load(self.family.pk), "HKD")
+        self.assertEqual((summary["count"], summary["total"]), (3, 96))
+        self.assertEqual(summary["largest"][0]["name"], "cinema")
+        self.assertEqual(
+            {c["category"]: c["total"] for c in summary["categories"]},
+            {"food": 12, "transport": 4, "entertainment": 80},
+        )
+
+    def test_writes_schedule_one_refresh_per_family(self):
+        ledger.build(self.family.pk)
+        snapshots.cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            Record.objects.create(family=self.family, name="tea", amount=5)
+        with self.captureOnCommitCallbacks(execute=True):
+            Record.objects.create(family=self.family, name="cake", amount=6)
+        job = Job.objects.get(name="snapshot.refresh")
+        self.assertEqual(job.payload, {"family_id": self.family.pk, "shard": "default"})
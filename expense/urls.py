@@ -7,6 +7,7 @@ urlpatterns = [
     path("family/", views.family_view, name="family"),
     path("add/", views.add_view, name="add"),
     path("record/", views.records_view, name="record"),
+    path("record/page/", views.records_page_view, name="records_page"),
     path("profile/", views.profile_view, name="profile"),
     # API endpoints
     path('logout/', views.logout_view, name='logout'),
@@ -19,13 +20,76 @@ urlpatterns = [
         views.family_add_member_api,
         name="family_add_member_api",
     ),
+    path(
+        "families/<int:family_id>/members/bulk/",
+        views.family_bulk_add_members_api,
+        name="family_bulk_add_members_api",
+    ),
     path(
         "families/<int:family_id>/members/<int:member_id>/",
         views.family_remove_member_api,
         name="family_remove_member_api",
     ),
+    path(
+        "families/<int:family_id>/events/",
+        views.family_events_api,
+        name="family_events_api",
+    ),
+    path(
+        "families/<int:family_id>/budgets/",
+        views.budget_collection_api,
+        name="budget_collection_api",
+    ),
+    path(
+        "families/<int:family_id>/budgets/<int:budget_id>/",
+        views.budget_detail_api,
+        name="budget_detail_api",
+    ),
+    path(
+        "families/<int:family_id>/anomalies/",
+        views.family_anomalies_api,
+        name="family_anomalies_api",
+    ),
+    path(
+        "families/<int:family_id>/duplicates/",
+        views.family_duplicates_api,
+        name="family_duplicates_api",
+    ),
+    path(
+        "families/<int:family_id>/statements/",
+        views.family_statements_api,
+        name="family_statements_api",
+    ),
+    path(
+        "families/<int:family_id>/statements/<str:month>/",
+        views.family_statement_view,
+        name="family_statement",
+    ),
+    path(
+        "families/<int:family_id>/forecast/",
+        views.family_forecast_api,
+        name="family_forecast_api",
+    ),
+    path(
+        "families/<int:family_id>/stats/",
+        views.family_stats_api,
+        name="family_stats_api",
+    ),
+    path(
+        "families/<int:family_id>/category-suggestions/",
+        views.category_suggestion_api,
+        name="category_suggestion_api",
+    ),
     path("records/", views.record_collection_api, name="record_collection_api"),
     path('api/records/<int:record_id>/', views.record_detail_api, name='record_detail_api'),
+    path("recurring/", views.recurring_collection_api, name="recurring_collection_api"),
+    path(
+        "recurring/<int:recurring_id>/",
+        views.recurring_detail_api,
+        name="recurring_detail_api",
+    ),
+    path("jobs/metrics/", views.job_metrics_api, name="job_metrics_api"),
+    path("profiles/<str:report_id>/", views.profile_report_api, name="profile_report_api"),
     path("qrcodes/upload/", views.qrcode_upload_view, name="qrcode_upload"),
     path("qrcodes/<int:qrcode_id>/delete/", views.qrcode_delete_view, name="qrcode_delete"),
 ]
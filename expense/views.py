@@ -4,15 +4,32 @@ from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
-from django.urls import reverse_lazy
+from django.conf import settings
+from django.urls import reverse, reverse_lazy
+from django.utils.http import urlencode
 from django.contrib import messages
+from django.core.handlers.asgi import ASGIRequest
 from django.db import transaction
 from django.db.models import Sum
+from django.utils import timezone
 from django.views.decorators.http import require_http_methods
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
 import json
 
-from .models import Account, Family, Record, QRCode
+from . import sharding
+from .categorizer import suggest
+from .currency import converted_amount, normalize_currency
+from .duplicates import find_clusters, find_duplicate
+from .events import family_event_stream
+from .forecasting import family_forecast, invalidate as invalidate_forecasts
+from .idempotency import idempotent
+from .jobs import enqueue, queue_stats
+from .profiling import report_paths
+from .ratelimit import rate_limit
+from .record_pages import render_page
+from .statements import parse_period
+from .budgets import budget_status, rebuild_totals
+from .models import CATEGORIES, Account, Budget, Family, Record, QRCode, RecurringRecord, Statement
 
 
 def _serialize_member(user):
@@ -26,8 +43,15 @@ def _serialize_member(user):
         return {"error": f"Failed to serialize member: {str(e)}"}
 
 
-def _serialize_family(family: Family):
+def _serialize_family(family: Family, members=None):
+    # members: the family's users, if already at hand
     try:
+        if members is None:
+            members = (
+                family.members.all()
+                if hasattr(getattr(family, "members", None), "all")
+                else []
+            )
         return {
             "id": getattr(family, "id", None),
             "pid": getattr(family, "pid", None),
@@ -35,11 +59,8 @@ def _serialize_family(family: Family):
             "level": getattr(family, "level", None),
             "max_budget": getattr(family, "max_budget", None),
             "currency": getattr(family, "currency", None),
-            "members": (
-                [_serialize_member(u) for u in getattr(family, "members", []).all()]
-                if hasattr(getattr(family, "members", None), "all")
-                else []
-            ),
+            "member_count": getattr(family, "member_count", None),
+            "members": [_serialize_member(u) for u in members],
         }
     except Exception as e:
         return {"error": f"Failed to serialize family: {str(e)}"}
@@ -66,6 +87,8 @@ def _serialize_record(record: Record):
             "family": _serialize_family(getattr(record, "family", None)),
             "name": getattr(record, "name", None),
             "amount": getattr(record, "amount", None),
+            "currency": getattr(record, "currency", None)
+            or getattr(getattr(record, "family", None), "currency", None),
             "category": getattr(record, "category", None),
             "description": getattr(record, "description", None),
             "who": _serialize_member(getattr(record, "who", None)),
@@ -75,14 +98,61 @@ def _serialize_record(record: Record):
         return {"error": f"Failed to serialize record: {str(e)}"}
 
 
+def _serialize_recurring(recurring: RecurringRecord):
+    try:
+        return {
+            "id": getattr(recurring, "id", None),
+            "pid": getattr(recurring, "pid", None),
+            "family_id": getattr(recurring, "family_id", None),
+            "name": getattr(recurring, "name", None),
+            "amount": getattr(recurring, "amount", None),
+            "category": getattr(recurring, "category", None),
+            "description": getattr(recurring, "description", None),
+            "schedule": getattr(recurring, "schedule", None),
+            "starts_at": getattr(recurring, "starts_at", None),
+            "ends_at": getattr(recurring, "ends_at", None),
+            "next_run_at": getattr(recurring, "next_run_at", None),
+            "last_run_at": getattr(recurring, "last_run_at", None),
+            "active": getattr(recurring, "active", None),
+        }
+    except Exception as e:
+        return {"error": f"Failed to serialize recurring record: {str(e)}"}
+
+
+def _serialize_budget(budget: Budget, spent=None, ratio=None):
+    try:
+        return {
+            "id": getattr(budget, "id", None),
+            "family_id": getattr(budget, "family_id", None),
+            "category": getattr(budget, "category", None),
+            "member": (
+                _serialize_member(budget.member)
+                if getattr(budget, "member_id", None)
+                else None
+            ),
+            "amount": getattr(budget, "amount", None),
+            "spent": spent,
+            "ratio": ratio,
+        }
+    except Exception as e:
+        return {"error": f"Failed to serialize budget: {str(e)}"}
+
+
+def _member_family(user, family_id):
+    """The family ``family_id`` if ``user`` is a member, on whichever shard holds it."""
+    return sharding.locate(user, Family.objects.filter(id=family_id, members=user))
+
+
 def get_or_create_account(user: User) -> Account:
     account = Account.objects.filter(user=user).first()
+    if account:
+        # Plain read, so it can be served by a replica
+        return account
 
     with transaction.atomic():
-        if not account:
-            account = Account.objects.create(
-                user=user, expired_at=datetime.now() + timedelta(days=365)
-            )
+        account = Account.objects.create(
+            user=user, expired_at=datetime.now() + timedelta(days=365)
+        )
         account.refresh_from_db()
 
     return account
@@ -97,14 +167,44 @@ def home_view(request):
     except Family.DoesNotExist:
         family = None
 
+    # A range on created_at (rather than created_at__month) only matches the
+    # current month and lets Postgres prune to a single record partition.
+    month_start = timezone.localtime().replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    records_this_month = Record.objects.filter(
+        family=family, created_at__gte=month_start
+    )
+
+    # Records in other currencies are converted to the family currency in
+    # the same aggregate query.
+    amount_in_family_currency = converted_amount(
+        family.currency if family is not None else "HKD"
+    )
+
     summary = {
-        "total_amount_this_month": 0,
+        "total_amount_this_month": records_this_month.aggregate(
+            total=Sum(amount_in_family_currency)
+        )["total"]
+        or 0,
+        "forecast_month_end": None,
+        "forecast_status": None,
     }
-    records = Record.objects.filter(
-        family=family, created_at__month=datetime.now().month
-    )
-    for record in records:
-        summary["total_amount_this_month"] += record.amount
+    if family is not None:
+        # Cached per family until the next record write
+        overall = next(
+            (
+                row
+                for row in family_forecast(family.id)["categories"]
+                if row["category"] == ""
+            ),
+            None,
+        )
+        if overall is not None:
+            summary["forecast_month_end"] = overall["month_end"]
+            summary["forecast_status"] = _forecast_status(
+                overall["month_end"], family.max_budget
+            )
 
     # QR codes for this family
     if family is not None:
@@ -114,9 +214,8 @@ def home_view(request):
 
     # Aggregate spending per member
     member_spending = (
-        Record.objects.filter(family=family, created_at__month=datetime.now().month)
-        .values("who__first_name", "who__username", "who__email")
-        .annotate(total=Sum("amount"))
+        records_this_month.values("who__first_name", "who__username", "who__email")
+        .annotate(total=Sum(amount_in_family_currency))
     )
     # Prepare for chart: labels and data
     chart_labels = []
@@ -140,6 +239,7 @@ def home_view(request):
     )
 
 
+@rate_limit("auth")
 def auth_view(request):
     tab = "login"
     if request.method == "POST":
@@ -184,8 +284,72 @@ def add_view(request):
     return render(request, "expense/add.html")
 
 
+@login_required(login_url=reverse_lazy("auth"))
 def records_view(request):
-    return render(request, "expense/records.html")
+    if settings.RECORDS_RENDERING == "client":
+        # Empty shell; records.html fetches every record from the API.
+        return render(request, "expense/records.html")
+
+    families = sorted(
+        sharding.collect(request.user, Family.objects.filter(members=request.user)),
+        key=lambda f: f.id,
+    )
+    family_pid = request.GET.get("family", "")
+    query = request.GET.get("q", "").strip()
+    listed = [f for f in families if f.pid == family_pid] if family_pid else families
+
+    month_start = timezone.localtime().replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    currency = families[0].currency if families else "HKD"
+    this_month_spent = 0
+    for alias in {sharding.family_shard(f.id) for f in listed}:
+        with sharding.use_shard(alias):
+            this_month_spent += (
+                Record.objects.filter(family__in=listed, created_at__gte=month_start)
+                .aggregate(total=Sum(converted_amount(currency)))["total"]
+                or 0
+            )
+
+    params = {key: value for key, value in (("family", family_pid), ("q", query)) if value}
+    first_page = render_page(listed, query=query, family_pid=family_pid)
+    return render(
+        request,
+        "expense/records_server.html",
+        {
+            "families": families,
+            "family_pid": family_pid,
+            "q": query,
+            "family_ids": json.dumps([f.id for f in listed]),
+            "month": month_start,
+            "currency": currency,
+            "this_month_spent": this_month_spent,
+            "first_page": first_page,
+            "first_page_url": reverse("records_page")
+            + (f"?{urlencode(params)}" if params else ""),
+        },
+    )
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("api")
+def records_page_view(request):
+    """One page of records as an HTML fragment, for the records page to append."""
+    families = Family.objects.filter(members=request.user)
+    family_pid = request.GET.get("family", "")
+    if family_pid:
+        families = families.filter(pid=family_pid)
+    try:
+        html = render_page(
+            sorted(sharding.collect(request.user, families), key=lambda f: f.id),
+            cursor=request.GET.get("cursor") or None,
+            query=request.GET.get("q", "").strip(),
+            family_pid=family_pid,
+        )
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor.")
+    return HttpResponse(html)
 
 
 def profile_view(request):
@@ -211,7 +375,9 @@ def qrcode_upload_view(request):
     created_any = False
     for file in files:
         if getattr(file, "content_type", "").startswith("image/"):
-            QRCode.objects.create(family=family, image=file, name=name)
+            qr = QRCode.objects.create(family=family, image=file, name=name)
+            # Decoding the image happens in the background
+            enqueue("qrcode.verify", qrcode_id=qr.id, shard=qr._state.db)
             created_any = True
 
     if created_any:
@@ -226,9 +392,8 @@ def qrcode_upload_view(request):
 @require_http_methods(["POST"])
 def qrcode_delete_view(request, qrcode_id: int):
     """Delete a QR code image if it belongs to a family the user is in."""
-    try:
-        qr = QRCode.objects.select_related("family").get(id=qrcode_id)
-    except QRCode.DoesNotExist:
+    qr = sharding.locate(request.user, QRCode.objects.select_related("family").filter(id=qrcode_id))
+    if qr is None:
         messages.error(request, "QR code not found.")
         return redirect("home")
 
@@ -236,11 +401,14 @@ def qrcode_delete_view(request, qrcode_id: int):
         messages.error(request, "You are not allowed to delete this QR code.")
         return redirect("home")
 
-    # Optionally delete the underlying file as well
-    if qr.image:
-        qr.image.delete(save=False)
-
-    qr.delete()
+    # The file is removed by a background job once the row is gone
+    path = qr.image.name if qr.image else None
+    # The shard's transaction commits first, so a failed delete never
+    # queues the file's removal.
+    with transaction.atomic(), sharding.atomic(qr._state.db):
+        qr.delete()
+        if path:
+            enqueue("storage.delete", path=path)
     messages.success(request, "QR code removed.")
     return redirect("home")
 
@@ -255,14 +423,16 @@ def logout_view(request):
 
 @login_required(login_url=reverse_lazy("auth"))
 @require_http_methods(["GET", "POST"])
+@rate_limit("api")
+@idempotent
 def family_collection_api(request):
     # GET: list families current user belongs to
     if request.method == "GET":
-        families = (
-            Family.objects.filter(members=request.user)
-            .prefetch_related("members")
-            .order_by("-created_at")
+        families = sharding.collect(
+            request.user,
+            Family.objects.filter(members=request.user).prefetch_related("members"),
         )
+        families.sort(key=lambda f: f.created_at, reverse=True)
         data = [_serialize_family(f) for f in families]
         return JsonResponse({"families": data}, status=200)
 
@@ -283,20 +453,19 @@ def family_collection_api(request):
     if not name:
         return HttpResponseBadRequest("Field 'name' is required.")
 
-    with transaction.atomic():
-        family = Family.objects.create(
-            name=name,
-            level=level,
-            max_budget=max_budget,
-            currency=currency,
-        )
-        family.members.add(request.user)
+    family = Family(name=name, level=level, max_budget=max_budget, currency=currency)
+    family.generate_pid()
+    # On the creator's shard (activated by ShardMiddleware), else by hash
+    with sharding.use_shard(sharding.place(family.pid)), sharding.atomic():
+        family.save()
+        family.add_members([request.user])
 
-    return JsonResponse(_serialize_family(family), status=201)
+    return JsonResponse(_serialize_family(family, members=[request.user]), status=201)
 
 
 @login_required(login_url=reverse_lazy("auth"))
 @require_http_methods(["GET", "POST", "PUT"])
+@rate_limit("api")
 def family_detail_api(request, family_id: int):
     try:
         family = Family.objects.prefetch_related("members").get(
@@ -324,7 +493,7 @@ def family_detail_api(request, family_id: int):
     max_budget = payload.get("max_budget", None)
     currency = payload.get("currency", None)
 
-    changed = False
+    changed = currency_changed = False
     if name is not None:
         name = name.strip()
         if not name:
@@ -337,6 +506,11 @@ def family_detail_api(request, family_id: int):
             changed = True
         except ValueError:
             return HttpResponseBadRequest("Field 'level' must be an integer.")
+        if family.member_count > family.max_members():
+            return JsonResponse(
+                {"detail": f"Level {family.level} allows only {family.max_members()} members; remove some first."},
+                status=400,
+            )
     if max_budget is not None:
         try:
             family.max_budget = float(max_budget)
@@ -347,17 +521,26 @@ def family_detail_api(request, family_id: int):
         currency = currency.strip()
         if not currency:
             return HttpResponseBadRequest("Field 'currency' cannot be empty.")
+        currency_changed = currency != family.currency
         family.currency = currency
         changed = True
 
     if changed:
-        family.save()
+        with sharding.atomic(family._state.db):
+            family.save()
+            if currency_changed:
+                # Budget totals are kept in the family currency.
+                rebuild_totals(family._state.db, [family.id])
+                transaction.on_commit(
+                    lambda: invalidate_forecasts([family.id]), using=family._state.db
+                )
 
     return JsonResponse(_serialize_family(family), status=200)
 
 
 @login_required(login_url=reverse_lazy("auth"))
 @require_http_methods(["POST"])
+@rate_limit("api")
 def family_add_member_api(request, family_id: int):
     # Body: { "email": "user@example.com" }
     try:
@@ -392,12 +575,74 @@ def family_add_member_api(request, family_id: int):
     if not ok:
         return JsonResponse({"detail": err}, status=400)
 
-    family.refresh_from_db()
-    return JsonResponse(_serialize_family(family), status=201)
+    members = [*family.members.all(), target_user]
+    return JsonResponse(_serialize_family(family, members=members), status=201)
+
+
+# Emails accepted by one bulk invite
+MAX_BULK_INVITES = 50
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["POST"])
+@rate_limit("api")
+@idempotent
+def family_bulk_add_members_api(request, family_id: int):
+    # Body: { "emails": ["a@example.com", "b@example.com"] }
+    # Adds every user or none of them.
+    try:
+        payload = json.loads(request.body or "{}")
+    except json.JSONDecodeError:
+        return HttpResponseBadRequest("Invalid JSON payload.")
+
+    emails = payload.get("emails")
+    if not isinstance(emails, list) or not all(isinstance(e, str) for e in emails):
+        return HttpResponseBadRequest("Field 'emails' must be a list of strings.")
+    emails = list(dict.fromkeys(e.strip() for e in emails if e.strip()))
+    if not emails:
+        return HttpResponseBadRequest("Field 'emails' is required.")
+    if len(emails) > MAX_BULK_INVITES:
+        return HttpResponseBadRequest(f"At most {MAX_BULK_INVITES} emails per request.")
+
+    try:
+        family = Family.objects.prefetch_related("members").get(
+            id=family_id, members=request.user
+        )
+    except Family.DoesNotExist:
+        return JsonResponse(
+            {"detail": "Family not found or access denied."}, status=404
+        )
+
+    users = {user.email: user for user in User.objects.filter(email__in=emails)}
+    missing = [email for email in emails if email not in users]
+    if missing:
+        return JsonResponse(
+            {"detail": "Some users do not exist.", "missing": missing}, status=404
+        )
+
+    added = family.add_members(users.values())
+    if added is None:
+        return JsonResponse(
+            {
+                "detail": f"Cannot add these members. Level {family.level} "
+                f"allows only {family.max_members()} members."
+            },
+            status=400,
+        )
+
+    members = [*family.members.all(), *added]
+    return JsonResponse(
+        {
+            **_serialize_family(family, members=members),
+            "added": [user.email for user in added],
+        },
+        status=201,
+    )
 
 
 @login_required(login_url=reverse_lazy("auth"))
 @require_http_methods(["POST", "DELETE"])
+@rate_limit("api")
 def family_remove_member_api(request, family_id: int, member_id: int):
     try:
         family = Family.objects.prefetch_related("members").get(
@@ -417,21 +662,46 @@ def family_remove_member_api(request, family_id: int, member_id: int):
     if not ok:
         return JsonResponse({"detail": err}, status=400)
 
-    family.refresh_from_db()
-    return JsonResponse(_serialize_family(family), status=200)
+    members = [user for user in family.members.all() if user.pk != target_user.pk]
+    return JsonResponse(_serialize_family(family, members=members), status=200)
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("events")
+async def family_events_api(request, family_id: int):
+    """Server-sent event stream of record and member changes for a family."""
+    if not isinstance(request, ASGIRequest):
+        # A WSGI server would buffer the endless stream in a worker thread
+        # before sending anything. 204 tells EventSource not to reconnect.
+        return HttpResponse(status=204)
+    user = await request.auser()
+    if not await Family.objects.filter(id=family_id, members=user).aexists():
+        return JsonResponse(
+            {"detail": "Family not found or access denied."}, status=404
+        )
+
+    response = StreamingHttpResponse(
+        family_event_stream(family_id), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
 
 
 @login_required(login_url=reverse_lazy("auth"))
 @require_http_methods(["GET", "POST"])
+@rate_limit("api")
+@idempotent
 def record_collection_api(request):
     # Body: { "family_id": family_id, "amount": amount, "category": category, "description": description, "created_at": created_at }
 
     if request.method == "GET":
-        records = (
-            Record.objects.filter(family__members=request.user)
-            .select_related("family")
-            .order_by("-created_at")
+        records = sharding.collect(
+            request.user,
+            Record.objects.filter(family__members=request.user).select_related("family"),
         )
+        records.sort(key=lambda r: r.created_at, reverse=True)
         data = [_serialize_record(r) for r in records]
         return JsonResponse({"records": data}, status=200)
 
@@ -452,13 +722,13 @@ def record_collection_api(request):
         record_pid = payload.get("pid")
         record = None
         if record_id:
-            record = Record.objects.filter(
-                id=record_id, family__members=request.user
-            ).first()
+            record = sharding.locate(
+                request.user, Record.objects.filter(id=record_id, family__members=request.user)
+            )
         elif record_pid:
-            record = Record.objects.filter(
-                pid=record_pid, family__members=request.user
-            ).first()
+            record = sharding.locate(
+                request.user, Record.objects.filter(pid=record_pid, family__members=request.user)
+            )
         if not record:
             return JsonResponse(
                 {"detail": "Record not found or access denied."}, status=404
@@ -467,6 +737,7 @@ def record_collection_api(request):
         name = payload.get("name", None)
         amount = payload.get("amount", None)
         category = payload.get("category", None)
+        currency = payload.get("currency", None)
         description = payload.get("description", None)
         created_at = payload.get("created_at", None)
 
@@ -483,6 +754,9 @@ def record_collection_api(request):
         if category is not None:
             record.category = category
             changed = True
+        if currency is not None:
+            record.currency = normalize_currency(currency)
+            changed = True
         if description is not None:
             record.description = description
             changed = True
@@ -516,6 +790,7 @@ def record_collection_api(request):
     name = payload.get("name", None)
     amount = payload.get("amount", None)
     category = payload.get("category", None)
+    currency = payload.get("currency", None)
     description = payload.get("description", None)
     created_at = payload.get("created_at", None)
 
@@ -529,12 +804,13 @@ def record_collection_api(request):
         return HttpResponseBadRequest("Field 'category' is required.")
 
     try:
-        with transaction.atomic():
+        with sharding.use_shard(sharding.family_shard(family_id)), sharding.atomic():
             record = Record(
                 family=Family.objects.get(id=family_id),
                 name=name,
                 amount=amount,
                 category=category,
+                currency=normalize_currency(currency),
                 description=description,
                 who=request.user,
             )
@@ -552,6 +828,17 @@ def record_collection_api(request):
                             "Field 'created_at' format invalid."
                         )
                 record.created_at = dt
+            # Double-submits and re-imports; the client may confirm a real repeat.
+            if str(payload.get("allow_duplicate", "")).lower() not in ("true", "1"):
+                duplicate = find_duplicate(record)
+                if duplicate is not None:
+                    return JsonResponse(
+                        {
+                            "detail": "A matching record was just added.",
+                            "duplicate_of": _serialize_record(duplicate),
+                        },
+                        status=409,
+                    )
             record.save()
         return JsonResponse(_serialize_record(record), status=201)
     except Exception as e:
@@ -561,12 +848,15 @@ def record_collection_api(request):
 
 @login_required(login_url=reverse_lazy("auth"))
 @require_http_methods(["GET", "PUT", "DELETE"])
+@rate_limit("api")
 def record_detail_api(request, record_id: int):
-    try:
-        record = Record.objects.select_related("family").get(
+    record = sharding.locate(
+        request.user,
+        Record.objects.select_related("family").filter(
             id=record_id, family__members=request.user
-        )
-    except Record.DoesNotExist:
+        ),
+    )
+    if record is None:
         return JsonResponse(
             {"detail": "Record not found or access denied."}, status=404
         )
@@ -586,6 +876,7 @@ def record_detail_api(request, record_id: int):
         name = payload.get("name", None)
         amount = payload.get("amount", None)
         category = payload.get("category", None)
+        currency = payload.get("currency", None)
         description = payload.get("description", None)
         created_at = payload.get("created_at", None)
 
@@ -602,6 +893,9 @@ def record_detail_api(request, record_id: int):
         if category is not None:
             record.category = category
             changed = True
+        if currency is not None:
+            record.currency = normalize_currency(currency)
+            changed = True
         if description is not None:
             record.description = description
             changed = True
@@ -626,3 +920,395 @@ def record_detail_api(request, record_id: int):
     if request.method == "DELETE":
         record.delete()
         return JsonResponse({"detail": "Record deleted."}, status=204)
+
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET", "POST"])
+@rate_limit("api")
+def recurring_collection_api(request):
+    # Body: { "family_id": family_id, "name": name, "amount": amount, "category": category, "schedule": "0 9 1 * *", "starts_at": starts_at, "ends_at": ends_at }
+
+    if request.method == "GET":
+        recurring = sharding.collect(
+            request.user, RecurringRecord.objects.filter(family__members=request.user)
+        )
+        recurring.sort(key=lambda r: r.next_run_at)
+        data = [_serialize_recurring(r) for r in recurring]
+        return JsonResponse({"recurring": data}, status=200)
+
+    try:
+        if request.content_type and "application/json" in request.content_type:
+            payload = json.loads(request.body or "{}")
+        else:
+            payload = request.POST
+    except json.JSONDecodeError:
+        return HttpResponseBadRequest("Invalid JSON payload.")
+
+    family_id = payload.get("family_id", None)
+    name = (payload.get("name") or "").strip()
+    amount = payload.get("amount", None)
+    category = payload.get("category", None)
+    schedule = (payload.get("schedule") or "").strip()
+
+    if not family_id:
+        return HttpResponseBadRequest("Field 'family_id' is required.")
+    if not name:
+        return HttpResponseBadRequest("Field 'name' is required.")
+    if not amount:
+        return HttpResponseBadRequest("Field 'amount' is required.")
+    if not schedule:
+        return HttpResponseBadRequest("Field 'schedule' is required.")
+
+    try:
+        family = Family.objects.using(sharding.family_shard(family_id)).get(
+            id=family_id, members=request.user
+        )
+    except (Family.DoesNotExist, ValueError):
+        return JsonResponse(
+            {"detail": "Family not found or access denied."}, status=404
+        )
+
+    recurring = RecurringRecord(
+        family=family,
+        who=request.user,
+        name=name,
+        amount=amount,
+        category=category or "",
+        description=payload.get("description") or "",
+        schedule=schedule,
+    )
+    for field in ("starts_at", "ends_at"):
+        value = payload.get(field, None)
+        if value:
+            from django.utils.dateparse import parse_datetime
+
+            dt = parse_datetime(value)
+            if not dt:
+                return HttpResponseBadRequest(f"Field '{field}' format invalid.")
+            setattr(recurring, field, dt)
+
+    try:
+        recurring.amount = float(recurring.amount)
+        recurring.save()
+    except ValueError as e:
+        return JsonResponse({"detail": str(e)}, status=400)
+    return JsonResponse(_serialize_recurring(recurring), status=201)
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET", "DELETE"])
+@rate_limit("api")
+def recurring_detail_api(request, recurring_id: int):
+    recurring = sharding.locate(
+        request.user,
+        RecurringRecord.objects.filter(id=recurring_id, family__members=request.user),
+    )
+    if recurring is None:
+        return JsonResponse(
+            {"detail": "Recurring record not found or access denied."}, status=404
+        )
+
+    if request.method == "GET":
+        return JsonResponse(_serialize_recurring(recurring), status=200)
+
+    # Records already created from this schedule are kept.
+    recurring.delete()
+    return JsonResponse({"detail": "Recurring record deleted."}, status=204)
+
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET", "POST"])
+@rate_limit("api")
+def budget_collection_api(request, family_id: int):
+    # Body: { "amount": amount, "category": category, "member_id": member_id }
+    family = _member_family(request.user, family_id)
+    if family is None:
+        return JsonResponse(
+            {"detail": "Family not found or access denied."}, status=404
+        )
+    with sharding.use_shard(sharding.family_shard(family.id)):
+        return _budget_collection(request, family)
+
+
+def _budget_collection(request, family):
+    if request.method == "GET":
+        # Spend comes from the running totals, not from scanning records
+        data = [
+            _serialize_budget(budget, spent, ratio)
+            for budget, spent, ratio in budget_status(family)
+        ]
+        return JsonResponse({"budgets": data}, status=200)
+
+    try:
+        if request.content_type and "application/json" in request.content_type:
+            payload = json.loads(request.body or "{}")
+        else:
+            payload = request.POST
+        amount = float(payload.get("amount") or 0)
+    except (ValueError, json.JSONDecodeError):
+        return HttpResponseBadRequest("Invalid request payload.")
+
+    if amount <= 0:
+        return HttpResponseBadRequest("Field 'amount' must be a positive number.")
+
+    category = (payload.get("category") or "").strip()
+    member_id = payload.get("member_id", None)
+    member = None
+    if member_id:
+        member = family.members.filter(id=member_id).first()
+        if member is None:
+            return JsonResponse(
+                {"detail": "Member not found in this family."}, status=404
+            )
+
+    budget = Budget.objects.create(
+        family=family, category=category, member=member, amount=amount
+    )
+    return JsonResponse(_serialize_budget(budget), status=201)
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["DELETE"])
+@rate_limit("api")
+def budget_detail_api(request, family_id: int, budget_id: int):
+    with sharding.use_shard(sharding.family_shard(family_id)):
+        deleted, _ = Budget.objects.filter(
+            id=budget_id, family_id=family_id, family__members=request.user
+        ).delete()
+    if not deleted:
+        return JsonResponse(
+            {"detail": "Budget not found or access denied."}, status=404
+        )
+    return JsonResponse({"detail": "Budget deleted."}, status=204)
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("analysis")
+def family_anomalies_api(request, family_id: int):
+    # Imported here so NumPy isn't loaded until the endpoint is used
+    from .analysis import family_anomalies
+
+    if _member_family(request.user, family_id) is None:
+        return JsonResponse(
+            {"detail": "Family not found or access denied."}, status=404
+        )
+    with sharding.use_shard(sharding.family_shard(family_id)):
+        anomalies = family_anomalies([family_id])
+    return JsonResponse(anomalies, status=200)
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("analysis")
+def family_duplicates_api(request, family_id: int):
+    if _member_family(request.user, family_id) is None:
+        return JsonResponse(
+            {"detail": "Family not found or access denied."}, status=404
+        )
+    with sharding.use_shard(sharding.family_shard(family_id)):
+        found = find_clusters(family_id)
+    clusters = [
+        {
+            "name": cluster[0]["name"],
+            "amount": cluster[0]["amount"],
+            "currency": cluster[0]["currency"],
+            # What the extra copies add to the family's totals
+            "extra_amount": cluster[0]["amount"] * (len(cluster) - 1),
+            "records": [
+                {"id": row["id"], "created_at": row["created_at"].isoformat()}
+                for row in cluster
+            ],
+        }
+        for cluster in found
+    ]
+    return JsonResponse({"clusters": clusters}, status=200)
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("api")
+def family_statements_api(request, family_id: int):
+    if _member_family(request.user, family_id) is None:
+        return JsonResponse(
+            {"detail": "Family not found or access denied."}, status=404
+        )
+    with sharding.use_shard(sharding.family_shard(family_id)):
+        stored = list(Statement.objects.filter(family_id=family_id).order_by("-period"))
+    statements = [
+        {
+            "period": f"{statement.period:%Y-%m}",
+            "currency": statement.currency,
+            "total": statement.total,
+            "record_count": statement.record_count,
+            "created_at": statement.created_at.isoformat(),
+            "url": reverse(
+                "family_statement",
+                kwargs={"family_id": family_id, "month": f"{statement.period:%Y-%m}"},
+            ),
+        }
+        for statement in stored
+    ]
+    return JsonResponse({"statements": statements}, status=200)
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("api")
+def family_statement_view(request, family_id: int, month: str):
+    """A stored monthly statement (see expense/statements.py), as rendered."""
+    try:
+        period = parse_period(month)
+    except ValueError:
+        return HttpResponseBadRequest("Month must look like 2025-01.")
+    with sharding.use_shard(sharding.family_shard(family_id)):
+        statement = Statement.objects.filter(
+            family_id=family_id, family__members=request.user, period=period
+        ).first()
+    if statement is None:
+        raise Http404("Statement not found.")
+    try:
+        file = statement.file.open("rb")
+    except FileNotFoundError:
+        raise Http404("Statement not found.")
+    response = FileResponse(file, content_type="text/html; charset=utf-8")
+    # Statements don't change once rendered, but they're the family's data.
+    response["Cache-Control"] = f"private, max-age={settings.STATEMENT_CACHE_SECONDS}"
+    return response
+
+
+def _forecast_status(forecast, limit):
+    if not limit:
+        return None
+    return "over_budget" if forecast > limit else "on_track"
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("analysis")
+def family_forecast_api(request, family_id: int):
+    try:
+        family = Family.objects.get(id=family_id, members=request.user)
+    except Family.DoesNotExist:
+        return JsonResponse(
+            {"detail": "Family not found or access denied."}, status=404
+        )
+
+    forecast = family_forecast(family.id)
+    # Limits are read fresh so budget edits show up without a record write
+    limits = dict(
+        Budget.objects.filter(family=family, member__isnull=True).values_list(
+            "category", "amount"
+        )
+    )
+    limits.setdefault("", family.max_budget)
+    data = [
+        {
+            **row,
+            "budget": limits.get(row["category"]),
+            "status": _forecast_status(row["month_end"], limits.get(row["category"])),
+        }
+        for row in forecast["categories"]
+    ]
+    return JsonResponse(
+        {"date": forecast["date"], "currency": family.currency, "categories": data},
+        status=200,
+    )
+
+
+# Histogram buckets the stats endpoint computes at most
+MAX_STATS_BINS = 200
+
+
+def _parse_day(value):
+    """Aware start of the ``YYYY-MM-DD`` day; ValueError if malformed."""
+    return timezone.make_aware(datetime.strptime(value, "%Y-%m-%d"))
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("analysis")
+def family_stats_api(request, family_id: int):
+    # Query: ?from=YYYY-MM-DD&to=YYYY-MM-DD (inclusive)&bins=20
+    # Imported here so NumPy isn't loaded until the endpoint is used
+    from .ledger import load, summarize
+
+    try:
+        family = Family.objects.get(id=family_id, members=request.user)
+    except Family.DoesNotExist:
+        return JsonResponse(
+            {"detail": "Family not found or access denied."}, status=404
+        )
+    try:
+        start = _parse_day(request.GET["from"]) if request.GET.get("from") else None
+        end = (
+            _parse_day(request.GET["to"]) + timedelta(days=1)
+            if request.GET.get("to")
+            else None
+        )
+        bins = int(request.GET.get("bins", 20))
+    except ValueError:
+        return HttpResponseBadRequest("Dates must look like 2025-01-31, bins a number.")
+    bins = max(1, min(bins, MAX_STATS_BINS))
+
+    ledger = load(family.id)
+    return JsonResponse(
+        {
+            "currency": family.currency,
+            # Snapshots trail record writes by up to SNAPSHOT_REFRESH_DELAY
+            "as_of": ledger.synced_at.isoformat(),
+            **summarize(ledger, family.currency, start, end, bins=bins),
+        },
+        status=200,
+    )
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("suggestions")
+def category_suggestion_api(request, family_id: int):
+    # Query: ?name=...&description=...
+    if _member_family(request.user, family_id) is None:
+        return JsonResponse(
+            {"detail": "Family not found or access denied."}, status=404
+        )
+    with sharding.use_shard(sharding.family_shard(family_id)):
+        suggested = suggest(
+            family_id,
+            request.GET.get("name", ""),
+            request.GET.get("description", ""),
+        )
+    suggestions = [
+        {"category": category, "label": CATEGORIES[category], "probability": probability}
+        for category, probability in suggested
+    ]
+    return JsonResponse({"suggestions": suggestions}, status=200)
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("api")
+def job_metrics_api(request):
+    if not request.user.is_staff:
+        return JsonResponse({"detail": "Staff only."}, status=403)
+    return JsonResponse(queue_stats(), status=200)
+
+
+@login_required(login_url=reverse_lazy("auth"))
+@require_http_methods(["GET"])
+@rate_limit("api")
+def profile_report_api(request, report_id: str):
+    # ?format=pstats downloads the raw profile instead of the JSON summary
+    if not request.user.is_staff:
+        return JsonResponse({"detail": "Staff only."}, status=403)
+    paths = report_paths(report_id)
+    if paths is None or not paths[0].exists():
+        return JsonResponse({"detail": "Profile not found."}, status=404)
+    summary, stats = paths
+    if request.GET.get("format") == "pstats":
+        return FileResponse(
+            open(stats, "rb"), as_attachment=True, filename=f"{report_id}.pstats"
+        )
+    return JsonResponse(json.loads(summary.read_text()), status=200)
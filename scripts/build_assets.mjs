@@ -0,0 +1,24 @@
+// Copy the pinned JavaScript bundles into static/build/vendor/.
+// File names carry the package version so templates reference exactly
+// the release in package.json; ManifestStaticFilesStorage adds a content
+// hash on top when collectstatic runs.
+import { copyFileSync, mkdirSync, readFileSync } from "node:fs";
+import { dirname, join } from "node:path";
+import { fileURLToPath } from "node:url";
+
+const root = join(dirname(fileURLToPath(import.meta.url)), "..");
+const outDir = join(root, "static", "build", "vendor");
+
+const bundles = [
+    { pkg: "chart.js", file: "dist/chart.umd.min.js", name: "chart.umd.min.js" },
+    { pkg: "alpinejs", file: "dist/cdn.min.js", name: "alpine.min.js" },
+];
+
+mkdirSync(outDir, { recursive: true });
+for (const { pkg, file, name } of bundles) {
+    const pkgDir = join(root, "node_modules", pkg);
+    const { version } = JSON.parse(readFileSync(join(pkgDir, "package.json"), "utf8"));
+    const target = join(outDir, name.replace(/\.min\.js$/, `-${version}.min.js`));
+    copyFileSync(join(pkgDir, file), target);
+    console.log(`${pkg}@${version} -> ${target}`);
+}